@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import gzip
+import json
+import time
+import zlib
+import struct
+import hashlib
+import zipfile
+from cStringIO import StringIO
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_ZSTD = 93
+ZIP_XZ = 95
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+ZIP_MAX = 0xFFFFFFFF
+READ_SIZE = 1048576
+INDEX_SUFFIX = '.idx'
+# Private extra field recording the codec of wrapped members in the central directory
+CODEC_EXTRA_ID = 0x6364
+# Codecs of zip compression methods, and the suffixes of wrapped codecs
+METHOD_CODECS = {ZIP_STORED: 'store', ZIP_DEFLATED: 'deflate', ZIP_XZ: 'xz', ZIP_ZSTD: 'zstd'}
+WRAPPED_CODECS = {'gzip': '.gz'}
+
+# File types that are already compressed and are stored as they are
+STORE_EXTENSIONS = [
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.7z', '.rar', '.lz4', '.jar', '.apk',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.aac', '.ogg', '.flac', '.m4a',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm', '.pdf', '.docx', '.xlsx', '.pptx', '.odt'
+]
+
+
+class Codec:
+    """
+    Codec class
+
+    Describes how member data is compressed: the zip compression method
+    written to the headers and a factory for compressor objects with
+    compress() and flush(). Wrapped codecs produce a self-contained
+    stream (e.g. gzip) that is stored in the zip as it is, under the
+    member name with the codec suffix appended; the codec is recorded
+    in an extra field of its central directory record.
+    """
+
+    def __init__(self, name, method, level=None, suffix='', wrapped=False):
+        self.name = name
+        self.method = method
+        self.level = level
+        self.suffix = suffix
+        self.wrapped = wrapped
+
+    def compressor(self):
+        """Return a new compressor object"""
+        level = self.level
+        if self.name == 'deflate':
+            return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15)
+        if self.name == 'gzip':
+            return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, 31)
+        if self.name == 'xz':
+            return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=6 if level is None else level)
+        if self.name == 'zstd':
+            return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+        return StoreCompressor()
+
+    def decompressor(self):
+        """Return a new decompressor object for data written by this codec"""
+        if self.name in ('deflate', 'gzip'):
+            return zlib.decompressobj(-15 if self.name == 'deflate' else 31)
+        if self.name == 'xz':
+            return lzma.LZMADecompressor()
+        if self.name == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj()
+        return StoreCompressor()
+
+
+class StoreCompressor:
+    """Compressor object of the store codec"""
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+
+def codec(name='deflate', level=None):
+    """
+    Create a codec by name
+
+        name        store, deflate, gzip, xz or zstd
+        level       compression level, codec default if None
+    """
+    if level is not None:
+        level = int(level)
+    if name == 'store':
+        return Codec(name, ZIP_STORED)
+    if name == 'deflate':
+        return Codec(name, ZIP_DEFLATED, level)
+    if name == 'gzip':
+        return Codec(name, ZIP_STORED, level, WRAPPED_CODECS[name], True)
+    if name == 'xz':
+        if lzma is None:
+            raise Exception('The xz codec requires the lzma module (backports.lzma on Python 2)')
+        return Codec(name, ZIP_XZ, level)
+    if name == 'zstd':
+        if zstandard is None:
+            raise Exception('The zstd codec requires the zstandard module')
+        return Codec(name, ZIP_ZSTD, level)
+    raise Exception('Unknown codec ' + str(name))
+
+
+def method_codec(method):
+    """Return the codec that reads members of a zip compression method"""
+    if method not in METHOD_CODECS:
+        raise Exception('Unsupported zip compression method ' + str(method))
+    return codec(METHOD_CODECS[method])
+
+
+def file_name(entry):
+    """Return the name of the file held by a member, without the suffix of its wrapped codec"""
+    suffix = WRAPPED_CODECS.get(entry.get('codec'))
+    if suffix and entry['name'].endswith(suffix):
+        return entry['name'][:-len(suffix)]
+    return entry['name']
+
+
+class ArchiveWriter:
+    """
+    Streaming zip archive writer
+
+    Members are written strictly in order and the output is never
+    seeked, sizes and checksums follow each member in a data
+    descriptor. This allows the archive to be written to any file-like
+    object that supports write(), including pipes and upload streams.
+    Zip64 records are used as soon as any size or offset requires them.
+    """
+
+    def __init__(self, fileobj, codec=None, hash_name=None, store_extensions=None, limiter=None):
+        """
+        Constructor
+
+        Attributes:
+            fileobj             file-like object the archive is written to
+            codec               codec of file members, deflate by default
+            hash_name           hashlib algorithm for member content hashes, if any
+            store_extensions    file extensions stored without compression
+            limiter             IOLimiter files are read through, if any
+            offset              number of bytes written so far
+            members             list of written member records (see add_stream)
+        """
+        self.fp = fileobj
+        self.codec = codec or Codec('deflate', ZIP_DEFLATED)
+        self.store = Codec('store', ZIP_STORED)
+        self.store_extensions = set(e.lower() for e in (store_extensions or []))
+        self.hash_name = hash_name
+        self.limiter = limiter
+        self.offset = 0
+        self.members = []
+
+    def add_file(self, path, arcname=None, st=None):
+        """
+        Add a regular file to the archive
+
+            path        path to the file on disk
+            arcname     name of the member, defaults to path
+            st          stat result of the file, if already known
+        """
+        if st is None:
+            st = os.stat(path)
+        if arcname is None:
+            arcname = path
+        with open(path, 'rb') as source:
+            if self.limiter is not None:
+                source = self.limiter.reader(source)
+            return self.add_stream(source, arcname, st.st_mtime, st.st_mode, st.st_size)
+
+    def add_directory(self, path, arcname=None, st=None):
+        """Add a directory entry to the archive, see add_file"""
+        if st is None:
+            st = os.stat(path)
+        if arcname is None:
+            arcname = path
+        if self.arcname(arcname) == '':
+            return None
+        return self.add_stream(None, arcname, st.st_mtime, st.st_mode, 0)
+
+    def add_bytes(self, arcname, data, mtime=None, codec=None):
+        """Add a member with in-memory contents, see add_stream"""
+        if mtime is None:
+            mtime = time.time()
+        return self.add_stream(StringIO(data), arcname, mtime, 0100644, len(data), codec)
+
+    def add_stream(self, source, arcname, mtime, mode, size_hint, codec=None):
+        """
+        Compress a readable stream into a new member
+
+            source      file-like object to read, None for directories
+            arcname     name of the member
+            mtime       modification time stored with the member
+            mode        unix mode stored in the external attributes
+            size_hint   expected size, used to decide on zip64 records
+            codec       codec of the member, chosen by its name if None
+        """
+        is_dir = source is None
+        arcname = self.arcname(arcname)
+        if is_dir or (codec is None and os.path.splitext(arcname)[1].lower() in self.store_extensions):
+            codec = self.store
+        elif codec is None:
+            codec = self.codec
+        arcname += '/' if is_dir else codec.suffix
+        method = codec.method
+        zip64 = size_hint * 1.05 > ZIP64_LIMIT
+        name = arcname.encode('utf-8') if isinstance(arcname, unicode) else arcname
+        flags = 0x08
+        try:
+            name.decode('ascii')
+        except UnicodeDecodeError:
+            # Only names that are valid UTF-8 may be flagged as such, others are left as they are
+            try:
+                name.decode('utf-8')
+                flags |= 0x800
+            except UnicodeDecodeError:
+                pass
+
+        dostime, dosdate = self.dos_time(mtime)
+        extra = ''
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        header_offset = self.offset
+        self.__write(struct.pack(
+            '<4s5H3L2H', 'PK\003\004', 45 if zip64 else 20, flags, method,
+            dostime, dosdate, 0, ZIP_MAX if zip64 else 0, ZIP_MAX if zip64 else 0,
+            len(name), len(extra)
+        ))
+        self.__write(name)
+        self.__write(extra)
+
+        data_offset = self.offset
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        digest = None
+        if not is_dir:
+            compressor = codec.compressor()
+            h = hashlib.new(self.hash_name) if self.hash_name else None
+            while True:
+                data = source.read(READ_SIZE)
+                if not data:
+                    break
+                file_size += len(data)
+                if not codec.wrapped:
+                    crc = zlib.crc32(data, crc)
+                if h is not None:
+                    h.update(data)
+                data = compressor.compress(data)
+                compress_size += len(data)
+                if codec.wrapped:
+                    crc = zlib.crc32(data, crc)
+                self.__write(data)
+            data = compressor.flush()
+            compress_size += len(data)
+            if codec.wrapped:
+                crc = zlib.crc32(data, crc)
+            self.__write(data)
+            if h is not None:
+                digest = h.hexdigest()
+        crc &= 0xFFFFFFFF
+        # The zip headers of wrapped members describe the stored stream
+        zip_size = compress_size if codec.wrapped else file_size
+
+        if zip64:
+            self.__write(struct.pack('<4sLQQ', 'PK\007\010', crc, compress_size, zip_size))
+        elif zip_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+            raise IOError('File ' + arcname + ' grew past the zip64 limit while being archived')
+        else:
+            self.__write(struct.pack('<4s3L', 'PK\007\010', crc, compress_size, zip_size))
+
+        member = {
+            'name': arcname,
+            'method': method,
+            'flags': flags,
+            'zip64': zip64,
+            'time': dostime,
+            'date': dosdate,
+            'crc': crc,
+            'csize': compress_size,
+            'size': zip_size,
+            'file_size': file_size,
+            'codec': codec.name,
+            'mode': mode,
+            'header_offset': header_offset,
+            'data_offset': data_offset,
+            'mtime': mtime,
+            'hash': digest,
+        }
+        self.members.append(member)
+        return member
+
+    def close(self):
+        """Write the central directory and end of archive records"""
+        cd_offset = self.offset
+        for m in self.members:
+            name = m['name'].encode('utf-8') if isinstance(m['name'], unicode) else m['name']
+            fields = []
+            file_size = m['size']
+            compress_size = m['csize']
+            header_offset = m['header_offset']
+            if m['zip64'] or file_size > ZIP64_LIMIT:
+                fields.append(file_size)
+                file_size = ZIP_MAX
+            if m['zip64'] or compress_size > ZIP64_LIMIT:
+                fields.append(compress_size)
+                compress_size = ZIP_MAX
+            if header_offset > ZIP64_LIMIT:
+                fields.append(header_offset)
+                header_offset = ZIP_MAX
+            extra = ''
+            if fields:
+                extra = struct.pack('<HH' + 'Q' * len(fields), 1, 8 * len(fields), *fields)
+            if m['codec'] in WRAPPED_CODECS:
+                extra += struct.pack('<HH', CODEC_EXTRA_ID, len(m['codec'])) + str(m['codec'])
+            version = 45 if fields else 20
+            external = (m['mode'] & 0xFFFF) << 16
+            if m['name'].endswith('/'):
+                external |= 0x10
+            self.__write(struct.pack(
+                '<4s6H3L5H2L', 'PK\001\002', (3 << 8) | version, version, m['flags'],
+                m['method'], m['time'], m['date'], m['crc'], compress_size, file_size,
+                len(name), len(extra), 0, 0, 0, external, header_offset
+            ))
+            self.__write(name)
+            self.__write(extra)
+
+        cd_size = self.offset - cd_offset
+        count = len(self.members)
+        if count > ZIP_FILECOUNT_LIMIT or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+            zip64_offset = self.offset
+            self.__write(struct.pack(
+                '<4sQ2H2L4Q', 'PK\006\006', 44, (3 << 8) | 45, 45, 0, 0,
+                count, count, cd_size, cd_offset
+            ))
+            self.__write(struct.pack('<4sLQL', 'PK\006\007', 0, zip64_offset, 1))
+            count = min(count, ZIP_FILECOUNT_LIMIT)
+            cd_size = min(cd_size, ZIP_MAX)
+            cd_offset = min(cd_offset, ZIP_MAX)
+        self.__write(struct.pack('<4s4H2LH', 'PK\005\006', 0, 0, count, count, cd_size, cd_offset, 0))
+
+    def __write(self, data):
+        """Write to the output and keep track of the current offset"""
+        if data:
+            self.fp.write(data)
+            self.offset += len(data)
+
+    @staticmethod
+    def arcname(path):
+        """Normalize a path to a zip member name"""
+        name = os.path.normpath(path).replace(os.sep, '/')
+        while name.startswith('./') or name.startswith('/'):
+            name = name[1:] if name.startswith('/') else name[2:]
+        return '' if name == '.' else name
+
+    @staticmethod
+    def dos_time(mtime):
+        """Convert a timestamp to zip (DOS) time and date fields"""
+        t = time.localtime(mtime)
+        if t.tm_year < 1980:
+            t = time.localtime(315532800)
+        dostime = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+        dosdate = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+        return dostime, dosdate
+
+
+def read_members(path):
+    """
+    Read the member records of a zip archive on disk
+
+    Records have the keys of ArchiveWriter records needed to read the
+    members back: name, method, codec, crc, csize, size, mode, mtime and
+    the offsets of the local header and of the member data.
+    """
+    records = []
+    with open(path, 'rb') as f:
+        for info in zipfile.ZipFile(f).infolist():
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<2H', f.read(30)[26:30])
+            records.append({
+                'name': info.filename,
+                'method': info.compress_type,
+                'codec': extra_codec(info.extra) or METHOD_CODECS.get(info.compress_type),
+                'crc': info.CRC,
+                'csize': info.compress_size,
+                'size': info.file_size,
+                'mode': info.external_attr >> 16,
+                'mtime': time.mktime(info.date_time + (0, 0, -1)),
+                'header_offset': info.header_offset,
+                'data_offset': info.header_offset + 30 + name_length + extra_length,
+                'hash': None,
+            })
+    return records
+
+
+def extra_codec(extra):
+    """Return the codec recorded in the extra field of a central directory record, None if there is none"""
+    while len(extra) >= 4:
+        field, length = struct.unpack('<HH', extra[:4])
+        if field == CODEC_EXTRA_ID:
+            return extra[4:4 + length]
+        extra = extra[4 + length:]
+    return None
+
+
+def index_entries(members, base=0):
+    """
+    Reduce member records to snapshot index entries
+
+    Data offsets are shifted by base, so members of a child archive
+    stored in the master archive point straight into the master.
+    """
+    return [{
+        'name': m['name'],
+        'method': m['method'],
+        'codec': m['codec'],
+        'offset': base + m['data_offset'],
+        'csize': m['csize'],
+        'size': m['size'],
+        'crc': m['crc'],
+        'mode': m['mode'],
+        'mtime': m['mtime'],
+        'hash': m.get('hash'),
+    } for m in members]
+
+
+def write_index(path, entries, **info):
+    """
+    Write a snapshot index, a gzipped JSON document
+
+    Member names and deleted paths are bytes that need not be valid
+    UTF-8, they are stored escaped with string_escape.
+
+        path        index file, <archive>.idx by convention
+        entries     list of index entries of all members
+        info        archive, time, kind, base and deleted of the snapshot
+    """
+    entries = [dict(entry, name=escape_name(entry['name'])) for entry in entries]
+    if 'deleted' in info:
+        info['deleted'] = [escape_name(p) for p in info['deleted']]
+    data = dict(info, version=2, members=entries)
+    f = gzip.open(path + '.tmp', 'wb')
+    try:
+        json.dump(data, f, separators=(',', ':'))
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+
+def read_index(data):
+    """Parse the contents of a snapshot index, member names and deleted paths are returned as bytes"""
+    index = json.loads(gzip.GzipFile(fileobj=StringIO(data)).read())
+    unescape = lambda name: name.encode('utf-8').decode('string_escape')
+    for entry in index['members']:
+        entry['name'] = unescape(entry['name'])
+        entry['codec'] = entry.get('codec') or METHOD_CODECS.get(entry['method'])
+    if 'deleted' in index:
+        index['deleted'] = [unescape(p) for p in index['deleted']]
+    return index
+
+
+def escape_name(name):
+    """Escape a member name, read back as unicode if flagged as UTF-8, for a JSON document"""
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return name.encode('string_escape')
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import stat
+import json
+import time
+import hashlib
+import threading
+import LocalCopy
+
+
+class ArchiveCache:
+    """
+    ArchiveCache class
+
+    Keeps the archives of first-level children between runs, keyed by
+    child name and fingerprint, so unchanged children do not have to
+    be compressed again. The cache is bounded by size, least recently
+    used archives are evicted first.
+    """
+
+    def __init__(self, path, max_size, limiter=None):
+        """
+        Constructor
+
+        Attributes:
+            path        directory holding cached archives and the index
+            max_size    maximum total size of cached archives in bytes
+            limiter     IOLimiter archives are copied through, if any
+            index       child name -> fingerprint, file, size, last use
+        """
+        self.path = path
+        self.max_size = max_size
+        self.limiter = limiter
+        self.index_file = path + '/index.json'
+        self.index = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if os.path.isfile(self.index_file):
+            # Child names are bytes, escaped so any name survives JSON
+            with open(self.index_file) as f:
+                self.index = dict((child.encode('utf-8').decode('string_escape'), entry)
+                                  for child, entry in json.load(f).items())
+
+    def get(self, child, fingerprint, target):
+        """
+        Place the cached archive of child at target
+
+        Returns True on a cache hit, False if the child has no cached
+        archive with a matching fingerprint.
+        """
+        with self.lock:
+            entry = self.index.get(child)
+            if entry is None or entry['fingerprint'] != fingerprint:
+                return False
+            cached = self.path + '/' + entry['file']
+            if not os.path.isfile(cached):
+                del self.index[child]
+                return False
+            entry['used'] = time.time()
+        self.link(cached, target)
+        return True
+
+    def put(self, child, fingerprint, archive):
+        """Store the archive of child under its current fingerprint"""
+        name = hashlib.sha1(child.encode('utf-8') if isinstance(child, unicode) else child).hexdigest() + '.zip'
+        cached = self.path + '/' + name
+        with self.lock:
+            if os.path.isfile(cached):
+                os.remove(cached)
+            self.link(archive, cached)
+            self.index[child] = {
+                'fingerprint': fingerprint,
+                'file': name,
+                'size': os.path.getsize(cached),
+                'used': time.time(),
+            }
+
+    def save(self):
+        """Evict least recently used archives and write the index"""
+        with self.lock:
+            total = sum(e['size'] for e in self.index.values())
+            for child, entry in sorted(self.index.items(), key=lambda i: i[1]['used']):
+                if total <= self.max_size:
+                    break
+                if os.path.isfile(self.path + '/' + entry['file']):
+                    os.remove(self.path + '/' + entry['file'])
+                total -= entry['size']
+                del self.index[child]
+
+            with open(self.index_file + '.tmp', 'w') as f:
+                json.dump(dict((child.encode('string_escape'), entry) for child, entry in self.index.items()), f)
+            os.rename(self.index_file + '.tmp', self.index_file)
+
+    def link(self, source, target):
+        """Hard link source to target, copy when they are on different filesystems"""
+        try:
+            os.link(source, target)
+        except OSError:
+            LocalCopy.copy_file(source, target, limiter=self.limiter)
+
+    @staticmethod
+    def fingerprint(entries, settings=''):
+        """
+        Compute a cheap fingerprint of a directory tree
+
+        Takes the (path, stat result) entries of the tree, see
+        Scanner.scan, and a string describing the settings archives
+        are written with, so archives written with other settings are
+        not reused. Returns a tuple of the fingerprint string
+        (recursive maximum mtime, file count, total size and a hash of
+        the settings) and the total size in bytes.
+        """
+        max_mtime = 0
+        count = 0
+        total = 0
+        for path, st in entries:
+            max_mtime = max(max_mtime, st.st_mtime)
+            if not stat.S_ISDIR(st.st_mode):
+                count += 1
+                total += st.st_size
+        return '%d-%d-%d-%s' % (int(max_mtime * 1000000), count, total, hashlib.sha1(settings).hexdigest()[:12]), total
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import glob
+import json
+import time
+import shutil
+import threading
+
+
+class Checkpoint:
+    """
+    Checkpoint class
+
+    Progress of a snapshot run kept in the state directory, so a run
+    that died halfway is continued by the next one instead of starting
+    over. The state file is small and rewritten atomically on every
+    change: the identity of the run, the finished master archive with
+    its hashes, the destinations it was transferred to and the part
+    ETags of unfinished S3 multipart uploads. Finished children, which
+    carry their member records and manifest entries, are appended to
+    a journal next to it instead, one JSON object per line. Child
+    names are bytes that need not be valid UTF-8, they are journaled
+    escaped with string_escape; escaping paths in the rest of the
+    record is up to the caller.
+    """
+
+    def __init__(self, path):
+        """
+        Constructor
+
+        Attributes:
+            path        state file, the journal is <path>.journal
+            run         identity of the run: time, source, engine, kind, previous, file patterns
+            children    journal records of finished children by child name
+            master      hashes and results of the finished master archive, None before
+            done        destinations (local paths, buckets, dedup locations) already finished
+            uploads     bucket/key -> upload id, part size and {part number: etag} of S3 uploads
+        """
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.run = None
+        self.children = {}
+        self.master = None
+        self.done = []
+        self.uploads = {}
+        self.journal = None
+        self.journal_size = 0
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Read the checkpoint of the last run, returns False if there is none"""
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        # JSON returns text, the run was recorded with byte strings (paths and names are UTF-8 there)
+        self.run = dict((field, [v.encode('utf-8') for v in value] if isinstance(value, list) else
+                         value.encode('utf-8') if isinstance(value, unicode) else value)
+                        for field, value in data['run'].items())
+        self.master = data['master']
+        self.done = [destination.encode('utf-8') for destination in data['done']]
+        self.uploads = dict((key.encode('utf-8'), upload) for key, upload in data['uploads'].items())
+        for upload in self.uploads.values():
+            upload['parts'] = dict((int(n), etag) for n, etag in upload['parts'].items())
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    # The last line is torn if the run died while writing it
+                    if not line.endswith('\n'):
+                        break
+                    record = json.loads(line)
+                    record['child'] = record['child'].encode('utf-8').decode('string_escape')
+                    self.children[record['child']] = record
+                    self.journal_size += len(line)
+        return True
+
+    def matches(self, max_age, **run):
+        """Check if the loaded checkpoint belongs to a run with these fields, started less than max_age seconds ago"""
+        if self.run is None or time.time() - int(self.run['time']) > max_age:
+            return False
+        return all(self.run.get(field) == value for field, value in run.items())
+
+    def start(self, **run):
+        """Start checkpointing a new run, forgetting everything recorded before"""
+        with self.lock:
+            self.run = run
+            self.children = {}
+            self.master = None
+            self.done = []
+            self.uploads = {}
+            self.save()
+            self.journal = open(self.journal_path, 'w')
+
+    def resume(self):
+        """Continue checkpointing the loaded run"""
+        with self.lock:
+            self.journal = open(self.journal_path, 'a')
+            self.journal.truncate(self.journal_size)
+
+    def add_child(self, record):
+        """Journal a finished child, record is a dict with at least a 'child' key"""
+        with self.lock:
+            self.children[record['child']] = record
+            line = json.dumps(dict(record, child=record['child'].encode('string_escape')), separators=(',', ':'))
+            self.journal.write(line + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def finish_master(self, master):
+        """Record the finished master archive"""
+        with self.lock:
+            self.master = master
+            self.save()
+
+    def finish(self, destination):
+        """Record a destination the snapshot was transferred to"""
+        with self.lock:
+            self.done.append(destination)
+            self.save()
+
+    def add_part(self, bucket, key_name, upload_id, part_size, part_num, etag):
+        """Record an uploaded part of a multipart upload"""
+        with self.lock:
+            upload = self.uploads.get(bucket + '/' + key_name)
+            if upload is None or upload['id'] != upload_id:
+                upload = self.uploads[bucket + '/' + key_name] = {'id': upload_id, 'part_size': part_size,
+                                                                  'parts': {}}
+            upload['parts'][part_num] = etag
+            self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'run': self.run, 'master': self.master, 'done': self.done, 'uploads': self.uploads}, f)
+            os.rename(self.path + '.tmp', self.path)
+
+    def clear(self):
+        """Remove the checkpoint once the run is complete"""
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            for path in (self.path, self.journal_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def discard(self):
+        """Remove the checkpoint and the files left behind by its run"""
+        for pattern in (self.run or {}).get('files', []):
+            for path in glob.glob(pattern):
+                self.__remove(path)
+        self.clear()
+        self.run = None
+
+    @staticmethod
+    def __remove(path):
+        """Remove a file or a directory tree"""
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isfile(path):
+            os.remove(path)
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import gzip
+import json
+import zlib
+import Queue
+import hashlib
+import tempfile
+import threading
+from cStringIO import StringIO
+
+# Gear table of the rolling hash, derived from md5 so it never changes
+GEAR = [int(hashlib.md5(chr(i)).hexdigest()[:8], 16) for i in range(256)]
+
+
+def chunks(fp, avg_size=1048576, min_size=None, max_size=None):
+    """
+    Split a stream into content-defined chunks
+
+    Chunk boundaries are placed where a gear rolling hash of the
+    preceding bytes matches a mask, so an insertion or removal only
+    changes the chunks around it and the rest of the file still
+    deduplicates. Bytes before min_size are not hashed at all.
+
+        fp          readable file object
+        avg_size    target average chunk size, a power of two
+        min_size    smallest chunk, avg_size / 4 by default
+        max_size    largest chunk, avg_size * 4 by default
+    """
+    min_size = min_size or avg_size // 4
+    max_size = max_size or avg_size * 4
+    mask = (1 << (max(avg_size - min_size, 1).bit_length() - 1)) - 1
+    gear = GEAR
+    data = ''
+    eof = False
+    while True:
+        while not eof and len(data) < max_size:
+            block = fp.read(max_size)
+            if not block:
+                eof = True
+            data += block
+        if not data:
+            return
+        if len(data) <= min_size:
+            yield data
+            return
+
+        end = min(len(data), max_size)
+        # Only the bits under the mask are tested and they never depend on higher ones
+        h = 0
+        cut = min_size
+        for b in bytearray(buffer(data, min_size, end - min_size)):
+            cut += 1
+            h = ((h << 1) + gear[b]) & mask
+            if not h:
+                break
+        yield data[:cut]
+        data = data[cut:]
+
+
+class LocalChunkStore:
+    """Chunk store in a locally accessible (mountable) directory"""
+
+    def __init__(self, path):
+        self.path = path
+        for directory in (path + '/chunks', path + '/indexes'):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def has(self, digest):
+        return os.path.isfile(self.__chunk_path(digest))
+
+    def put(self, digest, data):
+        path = self.__chunk_path(digest)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        self.__write(path, zlib.compress(data))
+
+    def get(self, digest):
+        with open(self.__chunk_path(digest), 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def put_index(self, name, data):
+        self.__write(self.path + '/indexes/' + name, data)
+
+    def get_index(self, name):
+        with open(self.path + '/indexes/' + name, 'rb') as f:
+            return f.read()
+
+    def list_indexes(self, prefix):
+        return sorted(n for n in os.listdir(self.path + '/indexes') if n.startswith(prefix) and n.endswith('.gz'))
+
+    def close(self):
+        pass
+
+    def __chunk_path(self, digest):
+        return self.path + '/chunks/' + digest[:2] + '/' + digest
+
+    @staticmethod
+    def __write(path, data):
+        """
+        Write data to path through a temporary file of its own
+
+        Several writers (threads or concurrent backups sharing the
+        store) may put the same chunk at once, so every one of them
+        gets a unique temporary file. As chunks are named by their
+        content, a destination that already exists is as good as ours.
+        """
+        fd, temp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp creates files readable by the owner only
+            os.chmod(temp, 0644)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            if os.path.isfile(temp):
+                os.remove(temp)
+            if not os.path.isfile(path):
+                raise
+
+
+class S3ChunkStore:
+    """Chunk store in an S3 bucket, under an optional key prefix"""
+
+    def __init__(self, bucket, prefix='', connect=None, throttle=None):
+        import boto
+        self.connect = connect or boto.connect_s3
+        self.throttle = throttle
+        self.bucket_name = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.local = threading.local()
+        conn = self.connect()
+        if conn.lookup(bucket) is None:
+            conn.create_bucket(bucket)
+
+    def has(self, digest):
+        return self.__bucket().get_key(self.__chunk_key(digest)) is not None
+
+    def put(self, digest, data):
+        data = zlib.compress(data)
+        if self.throttle is not None:
+            self.throttle.consume(len(data))
+        self.__bucket().new_key(self.__chunk_key(digest)).set_contents_from_string(data)
+
+    def get(self, digest):
+        return zlib.decompress(self.__bucket().get_key(self.__chunk_key(digest)).get_contents_as_string())
+
+    def put_index(self, name, data):
+        self.__bucket().new_key(self.prefix + 'indexes/' + name).set_contents_from_string(data)
+
+    def get_index(self, name):
+        return self.__bucket().get_key(self.prefix + 'indexes/' + name).get_contents_as_string()
+
+    def list_indexes(self, prefix):
+        keys = self.__bucket().list(prefix=self.prefix + 'indexes/' + prefix)
+        return sorted(k.name[len(self.prefix + 'indexes/'):] for k in keys if k.name.endswith('.gz'))
+
+    def close(self):
+        pass
+
+    def __bucket(self):
+        """Bucket handle on a connection owned by the calling thread"""
+        if getattr(self.local, 'bucket', None) is None:
+            self.local.bucket = self.connect().get_bucket(self.bucket_name, validate=False)
+        return self.local.bucket
+
+    def __chunk_key(self, digest):
+        return self.prefix + 'chunks/' + digest[:2] + '/' + digest
+
+
+def open_store(location, throttle=None):
+    """Open a chunk store from a path or an s3://bucket/prefix location, throttle limits S3 uploads"""
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[5:].partition('/')
+        return S3ChunkStore(bucket, prefix, throttle=throttle)
+    return LocalChunkStore(location)
+
+
+class Deduplicator:
+    """
+    Deduplicator class
+
+    Stores files in a chunk store and records a snapshot as a small
+    gzipped JSON index referencing the chunks of every file. Chunks
+    are keyed by their sha256 and stored only once, chunks already
+    referenced by the previous index of the same source are not even
+    looked up in the store. Files whose size and mtime match the
+    previous index keep its chunk list and are not read at all, the
+    others are chunked by a pool of threads.
+
+    Paths in indexes are escaped with string_escape, like in manifests.
+    """
+
+    def __init__(self, store, name, avg_size=1048576, workers=4, log=None, chunkers=1):
+        """
+        Constructor
+
+        Attributes:
+            store       chunk store (LocalChunkStore or S3ChunkStore)
+            name        snapshot name prefix, <source_name>-
+            avg_size    target average chunk size in bytes
+            workers     number of threads storing new chunks
+            log         callable(level, message) receiving events
+            chunkers    number of threads reading and chunking files
+            previous    path -> index entry of the previous snapshot
+        """
+        self.store = store
+        self.name = name
+        self.avg_size = avg_size
+        self.workers = max(int(workers), 1)
+        self.chunkers = max(int(chunkers), 1)
+        self.log = log or (lambda level, message: None)
+        self.files = []
+        self.known = set()
+        self.previous = {}
+        self.stored = 0
+        self.stored_bytes = 0
+        self.total_bytes = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Load the previous snapshot and start chunking and storing"""
+        previous = self.store.list_indexes(self.name)
+        if previous:
+            index = self.load_index(self.store, previous[-1])
+            for entry in index['files']:
+                self.known.update(entry['chunks'])
+                self.previous[entry['path']] = entry
+        self.queue = Queue.Queue(self.workers * 2)
+        self.files_queue = Queue.Queue(self.chunkers * 2)
+        self.errors = []
+        self.pool = []
+        self.chunk_pool = []
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.__worker)
+            worker.daemon = True
+            worker.start()
+            self.pool.append(worker)
+        for i in range(self.chunkers):
+            worker = threading.Thread(target=self.__chunker)
+            worker.daemon = True
+            worker.start()
+            self.chunk_pool.append(worker)
+
+    def add_file(self, path, st, name=None):
+        """
+        Add a file to the snapshot, unchanged files keep their chunks and others are queued for chunking
+
+            path        path to the file on disk
+            st          stat result of the file
+            name        path recorded in the index, defaults to path
+        """
+        if self.errors:
+            raise self.errors[0]
+        name = name or path
+        entry = self.previous.get(name)
+        if entry is not None and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            with self.lock:
+                self.files.append(dict(entry, mode=st.st_mode))
+                self.total_bytes += st.st_size
+                self.reused += 1
+            return
+        self.files_queue.put((path, st, name))
+
+    def finish(self, time):
+        """Wait for all files and chunks and write the snapshot index"""
+        for worker in self.chunk_pool:
+            self.files_queue.put(None)
+        for worker in self.chunk_pool:
+            worker.join()
+        for worker in self.pool:
+            self.queue.put(None)
+        for worker in self.pool:
+            worker.join()
+        if self.errors:
+            raise self.errors[0]
+
+        files = [dict(entry, path=entry['path'].encode('string_escape'))
+                 for entry in sorted(self.files, key=lambda e: e['path'])]
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        json.dump({'name': self.name, 'time': time, 'avg_size': self.avg_size, 'files': files}, f)
+        f.close()
+        index_name = self.name + time + '.json.gz'
+        self.store.put_index(index_name, buf.getvalue())
+        return index_name
+
+    def __chunker(self):
+        """Chunk queued files until a None task is received, unreadable files are left out of the index"""
+        while True:
+            task = self.files_queue.get()
+            if task is None:
+                return
+            path, st, name = task
+            if self.errors:
+                continue
+            try:
+                self.__chunk_file(path, st, name)
+            except (IOError, OSError) as e:
+                self.log('error', 'Unable to store ' + name + ': ' + str(e))
+            except Exception as e:
+                self.log('error', 'Unable to store ' + name + ': ' + str(e))
+                self.errors.append(e)
+
+    def __chunk_file(self, path, st, name):
+        """Chunk a file and queue its new chunks for storing"""
+        digests = []
+        with open(path, 'rb') as f:
+            for chunk in chunks(f, self.avg_size):
+                digest = hashlib.sha256(chunk).hexdigest()
+                digests.append(digest)
+                with self.lock:
+                    self.total_bytes += len(chunk)
+                    new = digest not in self.known
+                    self.known.add(digest)
+                if new:
+                    self.queue.put((digest, chunk))
+                if self.errors:
+                    return
+        with self.lock:
+            self.files.append({
+                'path': name,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'mode': st.st_mode,
+                'chunks': digests,
+            })
+
+    def __worker(self):
+        """Store queued chunks that are not in the store yet"""
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            digest, chunk = task
+            try:
+                if not self.errors and not self.store.has(digest):
+                    self.store.put(digest, chunk)
+                    with self.lock:
+                        self.stored += 1
+                        self.stored_bytes += len(chunk)
+            except Exception as e:
+                self.log('error', 'Unable to store chunk ' + digest + ': ' + str(e))
+                self.errors.append(e)
+
+    @staticmethod
+    def load_index(store, name):
+        """Read a snapshot index from a chunk store, paths are returned as bytes"""
+        index = json.loads(gzip.GzipFile(fileobj=StringIO(store.get_index(name))).read())
+        for entry in index['files']:
+            entry['path'] = entry['path'].encode('utf-8').decode('string_escape')
+        return index
+
+    @staticmethod
+    def file_data(store, entry):
+        """Read the contents of an index entry chunk by chunk, raises IOError on a corrupt chunk"""
+        size = 0
+        for digest in entry['chunks']:
+            data = store.get(digest)
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise IOError('Chunk ' + digest + ' of ' + entry['path'] + ' is corrupt')
+            size += len(data)
+            yield data
+        if size != entry['size']:
+            raise IOError('Size of ' + entry['path'] + ' is ' + str(size) + ' instead of ' + str(entry['size']))
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import sys
+import stat
+import json
+import time
+import errno
+import ctypes
+import struct
+import threading
+import ctypes.util
+from Scanner import Scanner, Rules
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 02000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 65536
+# Seconds between checks whether a source is due for a snapshot
+CHECK_INTERVAL = 5
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_init1.argtypes = [ctypes.c_int]
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    _inotify_rm_watch = _libc.inotify_rm_watch
+    _inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (OSError, AttributeError):
+    _inotify_init1 = None
+
+
+def available():
+    """Tell whether inotify can be used on this system"""
+    return _inotify_init1 is not None
+
+
+def state_dir(config):
+    """State directory of a backup.json entry, as Snapshot uses it"""
+    source = config['source']
+    name = os.path.basename(os.path.normpath(source))
+    return config.get('state_dir') or os.path.abspath(os.path.join(source, os.pardir)) + '/.' + name + '-state'
+
+
+class ChangeJournal:
+    """
+    ChangeJournal class
+
+    Set of the paths of a source changed since its last snapshot, with
+    the size of every changed file as far as it is known. Every path
+    is appended to the journal file as a JSON line when it first
+    changes, so the changes a daemon saw outlive it. Paths are
+    escaped with string_escape, like in manifests.
+
+    A batch of changes is taken out of the journal for a snapshot and
+    kept in <path>.batch until it is shipped, changes made meanwhile
+    go to a new journal. A journal holding more than max_changes paths
+    overflows: it no longer records paths and the next snapshot scans
+    the whole source.
+    """
+
+    def __init__(self, path, max_changes=100000):
+        """
+        Constructor
+
+        Attributes:
+            path        path of the journal file
+            max_changes number of paths above which the journal overflows
+            changes     dict of changed path -> size in bytes
+            bytes       total size of the changed files
+            overflowed  too many changes were made to record them
+            batch       paths taken for the snapshot in progress, None if there is none
+            rescan      the batch needs a scan of the whole source
+        """
+        self.path = path
+        self.max_changes = max(int(max_changes), 1)
+        self.changes = {}
+        self.bytes = 0
+        self.overflowed = False
+        self.batch = None
+        self.rescan = False
+        self.fp = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read the journal and the batch left by a previous daemon, returns the number of paths recorded in them"""
+        paths = set()
+        for path in (self.path + '.batch', self.path):
+            if not os.path.isfile(path):
+                continue
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line is torn if the daemon died while writing it
+                        continue
+                    if 'path' in record:
+                        paths.add(record['path'].encode('utf-8').decode('string_escape'))
+        return len(paths)
+
+    def clear(self):
+        """Forget all changes and remove the journal files"""
+        with self.lock:
+            self.__close()
+            for path in (self.path, self.path + '.batch'):
+                if os.path.isfile(path):
+                    os.remove(path)
+            self.changes = {}
+            self.bytes = 0
+            self.overflowed = False
+            self.batch = None
+            self.rescan = False
+
+    def add(self, path, size=None):
+        """Record a changed path, size is the size of a changed file if known"""
+        with self.lock:
+            if self.overflowed:
+                return
+            known = path in self.changes
+            if size is not None or not known:
+                self.bytes += (size or 0) - (self.changes.get(path) or 0)
+                self.changes[path] = size or 0
+            if known:
+                return
+            if len(self.changes) > self.max_changes:
+                self.__overflow()
+            else:
+                self.__append({'path': path.encode('string_escape'), 'size': size or 0})
+
+    def overflow(self):
+        """Stop recording paths, the next snapshot has to scan the whole source"""
+        with self.lock:
+            if not self.overflowed:
+                self.__overflow()
+
+    def take(self):
+        """
+        Take the changes for a snapshot
+
+        Returns the sorted list of changed paths, or None if the whole
+        source has to be scanned. While a batch is not shipped, the same
+        batch is returned again.
+        """
+        with self.lock:
+            if self.batch is None:
+                self.__close()
+                if os.path.isfile(self.path):
+                    os.rename(self.path, self.path + '.batch')
+                self.batch = sorted(self.changes)
+                self.rescan = self.overflowed
+                self.changes = {}
+                self.bytes = 0
+                self.overflowed = False
+            return None if self.rescan else self.batch
+
+    def shipped(self):
+        """Forget the batch once its snapshot is shipped"""
+        with self.lock:
+            if os.path.isfile(self.path + '.batch'):
+                os.remove(self.path + '.batch')
+            self.batch = None
+            self.rescan = False
+
+    def __overflow(self):
+        self.overflowed = True
+        self.changes = {}
+        self.bytes = 0
+        self.__append({'overflow': True})
+
+    def __append(self, record):
+        if self.fp is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.fp = open(self.path, 'a')
+        self.fp.write(json.dumps(record) + '\n')
+        self.fp.flush()
+
+    def __close(self):
+        if self.fp is not None:
+            os.fsync(self.fp.fileno())
+            self.fp.close()
+            self.fp = None
+
+
+class Watcher:
+    """
+    Watcher class
+
+    Watches the children of a source directory with inotify and
+    records changed paths in a change journal. Every directory the
+    rules of the source do not leave out gets a watch. Directories
+    that are created or moved in get watches as they appear and are
+    recorded as a whole, as files may land in them before their watch
+    is added. An overflow of the inotify queue overflows the journal.
+
+    If a directory cannot be watched, usually because the limit of
+    fs.inotify.max_user_watches is reached, or reading the events
+    fails, the watcher is incomplete and every snapshot of the source
+    has to scan all of it.
+    """
+
+    def __init__(self, root, rules, journal, log=None):
+        """
+        Constructor
+
+        Attributes:
+            root        source directory
+            rules       Rules of the source, left out paths are not watched
+            journal     ChangeJournal changes are recorded in
+            log         callable(level, message) receiving events
+            watches     dict of watch descriptor -> watched path, '' for root
+            complete    all directories could be watched
+        """
+        # Paths are recorded as bytes, as snapshots walk them
+        if isinstance(root, unicode):
+            root = root.encode(sys.getfilesystemencoding() or 'utf-8')
+        self.root = root
+        self.rules = rules
+        self.journal = journal
+        self.log = log or (lambda level, message: None)
+        self.scanner = Scanner(root, rules, 1, self.log)
+        self.watches = {}
+        self.complete = True
+        self.lock = threading.Lock()
+        self.fd = _inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, 'Unable to initialize inotify: ' + os.strerror(code))
+
+    def start(self):
+        """Watch root and all directories of its children, then record their changes in a thread"""
+        self.__watch('')
+        for child in self.scanner.children():
+            self.__watch_tree(child)
+        self.log('info', 'Watching ' + str(len(self.watches)) + ' directories of ' + self.root)
+        worker = threading.Thread(target=self.__run)
+        worker.daemon = True
+        worker.start()
+
+    def __run(self):
+        """Read and handle inotify events until reading them fails"""
+        try:
+            self.__read()
+        except Exception as e:
+            # Changes are no longer recorded, every snapshot from now on scans the whole source
+            self.log('error', 'Unable to watch ' + self.root + ': ' + str(e) + ', every snapshot scans all of it')
+            self.complete = False
+            self.journal.overflow()
+
+    def __read(self):
+        """Read inotify events and record the changes they report"""
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                try:
+                    self.__event(wd, mask, name)
+                except Exception as e:
+                    self.log('error', 'Unable to record a change of ' + name + ': ' + str(e))
+                    self.journal.overflow()
+
+    def __event(self, wd, mask, name):
+        """Record the change an event reports"""
+        if mask & IN_Q_OVERFLOW:
+            self.log('warning', 'Changes of ' + self.root + ' were lost, the next snapshot scans all of it')
+            self.journal.overflow()
+            return
+        if mask & IN_IGNORED:
+            with self.lock:
+                self.watches.pop(wd, None)
+            return
+        directory = self.watches.get(wd)
+        if directory is None or not name:
+            return
+        path = directory + '/' + name if directory else name
+        is_dir = bool(mask & IN_ISDIR)
+        # Files in root are not part of any child
+        if not directory and not is_dir:
+            return
+        if self.rules.excluded(path, is_dir):
+            return
+        if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+            self.__watch_tree(path)
+        elif is_dir and mask & IN_MOVED_FROM:
+            self.__unwatch_tree(path)
+
+        size = None
+        if not is_dir and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            try:
+                size = os.lstat(os.path.join(self.root, path)).st_size
+            except OSError:
+                pass
+        self.journal.add(path, size)
+
+    def __watch_tree(self, path):
+        """Watch a directory and all directories below it"""
+        entries, errors = self.scanner.scan(path)
+        for entry, st in entries:
+            if stat.S_ISDIR(st.st_mode):
+                self.__watch(entry)
+
+    def __watch(self, path):
+        """Watch a single directory"""
+        wd = _inotify_add_watch(self.fd, os.path.join(self.root, path), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            # Directories removed while they were being watched need no watch
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                return
+            if self.complete:
+                self.log('error', 'Unable to watch ' + os.path.join(self.root, path) + ': ' + os.strerror(code) +
+                         ', every snapshot scans all of ' + self.root)
+            self.complete = False
+            return
+        with self.lock:
+            self.watches[wd] = path
+
+    def __unwatch_tree(self, path):
+        """Stop watching a directory and all directories below it"""
+        with self.lock:
+            for wd, watched in self.watches.items():
+                if watched == path or watched.startswith(path + '/'):
+                    _inotify_rm_watch(self.fd, wd)
+                    del self.watches[wd]
+
+
+class Daemon:
+    """
+    Daemon class
+
+    Keeps incremental snapshots of all sources up to date without
+    rediscovering changes by scanning. Watchers record the changes of
+    every source in a change journal in its state directory. A
+    snapshot of the changed paths is made as soon as the changed files
+    of a source add up to max_bytes, or interval after its last
+    snapshot if anything changed at all.
+
+    On startup the watches are set up first and every source is
+    snapshotted with a scan of the whole source, as the changes made
+    while no daemon was running are unknown. Overflowed journals and
+    sources that could not be watched completely are scanned whole
+    again. A batch whose snapshot failed is retried interval later.
+
+    Snapshots are taken far more often than by single runs, so
+    full_every of the sources is replaced by the number of snapshots
+    full_days of intervals amount to.
+    """
+
+    def __init__(self, configs, scheduler, interval=900, max_bytes=67108864, max_changes=100000, full_days=7):
+        """
+        Constructor
+
+        Attributes:
+            configs     list of backup.json entries of the sources
+            scheduler   callable returning a new Scheduler, snapshots that are due together share one
+            interval    seconds after the last snapshot of a source its changes are shipped
+            max_bytes   size of changed files in bytes that is shipped right away
+            max_changes number of changed paths above which a journal overflows
+            full_days   days of snapshots taken every interval between full snapshots
+            full_every  number of incremental snapshots between full snapshots, replaces that of the configs
+            sources     list of dicts of config, journal, watcher and time of the last snapshot
+        """
+        self.scheduler = scheduler
+        self.interval = float(interval)
+        self.max_bytes = int(max_bytes)
+        self.full_every = max(int(float(full_days) * 86400 / self.interval), 1)
+        self.sources = []
+        for config in configs:
+            config = dict(config, incremental=True, full_every=self.full_every)
+            if config.get('engine', 'stream') not in ('stream', 'volume'):
+                raise Exception('The daemon needs the stream or volume engine for ' + config['source'])
+            journal = ChangeJournal(state_dir(config) + '/changes.journal', max_changes)
+            rules = Rules(config.get('exclude'), config.get('include'), config.get('skip_caches', True))
+            self.sources.append({
+                'config': config,
+                'journal': journal,
+                'watcher': Watcher(config['source'], rules, journal, self.log),
+                'shipped': 0,
+            })
+
+    def run(self):
+        """Watch all sources and ship their changes until interrupted"""
+        for source in self.sources:
+            left = source['journal'].load()
+            if left:
+                self.log('info', str(left) + ' changes of ' + source['config']['source'] +
+                         ' recorded by the last daemon are covered by the startup scan')
+            source['journal'].clear()
+            source['watcher'].start()
+        self.__ship(self.sources, True)
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            due = [source for source in self.sources if self.__due(source)]
+            if due:
+                self.__ship(due)
+
+    def log(self, level, message):
+        if level in ('error', 'warning', 'info'):
+            print level.upper() + ': ' + message
+
+    def __due(self, source):
+        """Tell whether a source is due for a snapshot"""
+        journal = source['journal']
+        elapsed = time.time() - source['shipped'] >= self.interval
+        if journal.overflowed:
+            return True
+        if journal.batch is not None or not source['watcher'].complete:
+            return elapsed
+        return bool(journal.changes) and (elapsed or journal.bytes >= self.max_bytes)
+
+    def __ship(self, sources, full=False):
+        """Snapshot sources at the same time, full scans all of them"""
+        scheduler = self.scheduler()
+        for source in sources:
+            changes = None
+            if not full:
+                changes = source['journal'].take()
+                if not source['watcher'].complete:
+                    changes = None
+            self.log('info', 'Snapshot of ' + source['config']['source'] + ' with ' +
+                     ('a full scan' if changes is None else str(len(changes)) + ' changed paths'))
+            scheduler.add(source['config'], changes=changes)
+        failed = set(path for path, error in scheduler.run())
+        for source in sources:
+            source['shipped'] = time.time()
+            if not full and source['config']['source'] not in failed:
+                source['journal'].shipped()
@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Local file copies
+~~~~~~~~~~~~~~~~~
+Whole-file copies that let the kernel or the filesystem do the work
+(reflinks, copy_file_range, sendfile), fan-out copies writing one
+source to several destinations at once and rsync-style delta copies
+against the previous snapshot already present at a destination.
+"""
+
+__author__ = 'vstrackovski'
+
+import os
+import json
+import mmap
+import time
+import zlib
+import Queue
+import errno
+import ctypes
+import shutil
+import hashlib
+import threading
+import ctypes.util
+import Throttle
+
+FICLONE = 0x40049409
+ADLER_MOD = 65521
+COPY_SIZE = 8388608
+SIGNATURE_SUFFIX = '.blocks'
+# Delta copies stop scanning byte by byte once this many blocks in a row
+# are not found in the basis and try only whole blocks until one is
+DELTA_WINDOW = 16
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    _copy_file_range = _libc.copy_file_range
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [
+        ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int,
+        ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint
+    ]
+except (OSError, AttributeError):
+    _copy_file_range = None
+
+try:
+    _sendfile = _libc.sendfile64
+    _sendfile.restype = ctypes.c_ssize_t
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t]
+except (NameError, AttributeError):
+    _sendfile = None
+
+
+def reflink(src_fd, dst_fd):
+    """Share all blocks of src_fd with dst_fd (btrfs, xfs), returns False if unsupported"""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def copy_range(src_fd, src_offset, dst_fd, dst_offset, length):
+    """
+    Copy length bytes between file descriptors at the given offsets
+
+    Uses copy_file_range where available, which stays in the kernel and
+    becomes a server-side copy or a reflink on filesystems supporting
+    it, and falls back to reading and writing through userspace.
+    """
+    if _copy_file_range is not None:
+        off_in = ctypes.c_longlong(src_offset)
+        off_out = ctypes.c_longlong(dst_offset)
+        while length > 0:
+            copied = _copy_file_range(src_fd, ctypes.byref(off_in), dst_fd, ctypes.byref(off_out),
+                                      min(length, COPY_SIZE), 0)
+            if copied < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                    break
+                raise OSError(err, os.strerror(err))
+            if copied == 0:
+                raise IOError('Unexpected end of file while copying')
+            length -= copied
+            src_offset += copied
+            dst_offset += copied
+        if length == 0:
+            return
+
+    while length > 0:
+        os.lseek(src_fd, src_offset, os.SEEK_SET)
+        data = os.read(src_fd, min(length, COPY_SIZE))
+        if not data:
+            raise IOError('Unexpected end of file while copying')
+        os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+        write_all(dst_fd, data)
+        length -= len(data)
+        src_offset += len(data)
+        dst_offset += len(data)
+
+
+def send_range(src_fd, src_offset, dst_fd, length):
+    """
+    Copy length bytes from src_fd to the current position of dst_fd in the kernel
+
+    Tries copy_file_range and sendfile, returns the number of bytes that
+    could not be copied this way (0 on success, length if unsupported).
+    """
+    if _copy_file_range is not None:
+        off_in = ctypes.c_longlong(src_offset)
+        while length > 0:
+            copied = _copy_file_range(src_fd, ctypes.byref(off_in), dst_fd, None, min(length, COPY_SIZE), 0)
+            if copied <= 0:
+                break
+            length -= copied
+        src_offset = off_in.value
+    if _sendfile is not None:
+        off_in = ctypes.c_longlong(src_offset)
+        while length > 0:
+            copied = _sendfile(dst_fd, src_fd, ctypes.byref(off_in), min(length, COPY_SIZE))
+            if copied <= 0:
+                break
+            length -= copied
+    return length
+
+
+def fanout_copy(src, dsts, fsync=False, verify=False, digest=None, limiter=None):
+    """
+    Copy src to several destination files at the same time
+
+    With in-kernel copies (copy_file_range, sendfile) every destination
+    is written by its own thread from the page cache, so the source is
+    read from disk once. Without them a single reader thread reads the
+    source once and hands every block to one writer thread per
+    destination. Files are written to <dst>.part and renamed when done.
+    With a limiter the source is always read by the reader thread, so
+    the copy can be paced and its pages dropped from the page cache.
+
+        src         file to copy
+        dsts        list of destination file paths
+        fsync       flush every destination to stable storage
+        verify      re-read every destination and compare its sha256
+        digest      sha256 of src if already known, computed when needed otherwise
+        limiter     IOLimiter reads and writes go through, if any
+
+    Returns a dict of destination -> (seconds, bytes, exception or None).
+    """
+    size = os.path.getsize(src)
+    results = {}
+    digest = [digest]
+    zero_copy = limiter is None and (_copy_file_range is not None or _sendfile is not None)
+    queues = dict((dst, Queue.Queue(8)) for dst in dsts)
+
+    def write(dst):
+        started = time.time()
+        ended = [zero_copy]
+        try:
+            fd = os.open(dst + '.part', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                if zero_copy:
+                    src_fd = os.open(src, os.O_RDONLY)
+                    try:
+                        left = send_range(src_fd, 0, fd, size)
+                        if left:
+                            copy_range(src_fd, size - left, fd, size - left, left)
+                    finally:
+                        os.close(src_fd)
+                else:
+                    offset = 0
+                    window = None
+                    while True:
+                        block = queues[dst].get()
+                        if block is None or isinstance(block, Exception):
+                            ended[0] = True
+                            if block is not None:
+                                raise block
+                            break
+                        if limiter is not None:
+                            limiter.write(len(block))
+                        write_all(fd, block)
+                        offset += len(block)
+                        if limiter is not None and limiter.drop_cache:
+                            window = limiter.written(fd, offset, len(block), window)
+                if fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+            shutil.copystat(src, dst + '.part')
+            if verify and file_hash(dst + '.part', limiter) != source_hash():
+                raise IOError('Verification of ' + dst + ' failed, it differs from ' + src)
+            os.rename(dst + '.part', dst)
+            results[dst] = (time.time() - started, size, None)
+        except Exception as e:
+            if os.path.isfile(dst + '.part'):
+                os.remove(dst + '.part')
+            results[dst] = (time.time() - started, 0, e)
+            while not ended[0]:
+                block = queues[dst].get()
+                ended[0] = block is None or isinstance(block, Exception)
+
+    lock = threading.Lock()
+
+    def source_hash():
+        with lock:
+            if digest[0] is None:
+                digest[0] = file_hash(src, limiter)
+            return digest[0]
+
+    pool = [threading.Thread(target=write, args=(dst,)) for dst in dsts]
+    for worker in pool:
+        worker.daemon = True
+        worker.start()
+
+    if not zero_copy:
+        h = hashlib.sha256()
+        try:
+            with open(src, 'rb') as f:
+                if limiter is not None:
+                    f = limiter.reader(f)
+                while True:
+                    block = f.read(COPY_SIZE)
+                    if verify and digest[0] is None:
+                        h.update(block)
+                    if not block and verify and digest[0] is None:
+                        digest[0] = h.hexdigest()
+                    for dst in dsts:
+                        queues[dst].put(block or None)
+                    if not block:
+                        break
+        except (IOError, OSError) as e:
+            for dst in dsts:
+                queues[dst].put(e)
+
+    for worker in pool:
+        worker.join()
+    return results
+
+
+def file_hash(path, limiter=None):
+    """Compute the sha256 of a file through a memory map, or read through a limiter if given"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if limiter is not None:
+            f = limiter.reader(f)
+            while True:
+                block = f.read(COPY_SIZE)
+                if not block:
+                    return h.hexdigest()
+                h.update(block)
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, COPY_SIZE):
+                    h.update(m[offset:offset + COPY_SIZE])
+            finally:
+                m.close()
+    return h.hexdigest()
+
+
+def write_all(fd, data):
+    """Write all of data to a file descriptor"""
+    view = memoryview(data)
+    while len(view):
+        view = view[os.write(fd, view):]
+
+
+def copy_file(src, dst, fsync=False, limiter=None):
+    """
+    Copy src to dst, including permission bits and times like shutil.copy2
+
+    The copy is a reflink when both files are on a filesystem that
+    supports it, an in-kernel copy otherwise. With a limiter the file
+    is read and written through it instead.
+    """
+    tmp = dst + '.part'
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            if limiter is not None:
+                _limited_copy(src_fd, dst_fd, limiter)
+            elif not reflink(src_fd, dst_fd):
+                copy_range(src_fd, 0, dst_fd, 0, os.fstat(src_fd).st_size)
+            if fsync:
+                os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    except BaseException:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src, tmp)
+    os.rename(tmp, dst)
+
+
+def _limited_copy(src_fd, dst_fd, limiter):
+    """Copy a whole file between file descriptors through a limiter"""
+    reader = limiter.reader(os.fdopen(os.dup(src_fd), 'rb'))
+    writer = limiter.writer(os.fdopen(os.dup(dst_fd), 'wb'))
+    try:
+        while True:
+            block = reader.read(COPY_SIZE)
+            if not block:
+                break
+            writer.write(block)
+    finally:
+        reader.close()
+        writer.close()
+
+
+def signature(data, block_size):
+    """Weak (adler32) and strong (md5) checksums of every whole block of data"""
+    blocks = []
+    for offset in xrange(0, len(data) - block_size + 1, block_size):
+        block = data[offset:offset + block_size]
+        blocks.append([zlib.adler32(block) & 0xFFFFFFFF, hashlib.md5(block).hexdigest()])
+    return blocks
+
+
+def write_signature(path, block_size, blocks):
+    """Store the block signature of a file next to it"""
+    with open(path + SIGNATURE_SUFFIX + '.tmp', 'w') as f:
+        json.dump({'block_size': block_size, 'blocks': blocks}, f, separators=(',', ':'))
+    os.rename(path + SIGNATURE_SUFFIX + '.tmp', path + SIGNATURE_SUFFIX)
+
+
+def read_signature(path):
+    """Read the block signature stored next to a file, None if there is none"""
+    try:
+        with open(path + SIGNATURE_SUFFIX) as f:
+            sig = json.load(f)
+        return sig['block_size'], sig['blocks']
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def delta_copy(src, dst, basis, block_size=131072, fsync=False, limiter=None):
+    """
+    Copy src to dst reusing the blocks of basis, the way rsync does
+
+    Only the block signature of basis is read. src is scanned with a
+    rolling adler32 checksum; every block of src found in basis, at
+    any offset, is copied from basis within the destination filesystem
+    and only the remaining bytes are written. The signature of dst is
+    stored next to it for the next run.
+
+    The rolling checksum is slow, so once DELTA_WINDOW blocks of src in
+    a row are not found, only the block at every block_size bytes is
+    looked up until one is found, then the byte by byte scan resumes.
+    Without a usable basis src is copied with copy_file.
+
+        src         file to copy
+        dst         destination file path
+        basis       earlier version of the file at the destination, if any
+        block_size  size of the blocks matched against basis
+        fsync       flush dst to stable storage
+        limiter     IOLimiter reads and writes are accounted to, if any; with its
+                    drop_cache pages of all three files are dropped behind the copy
+
+    Returns a tuple of (bytes written, bytes reused from basis).
+    """
+    sig = read_signature(basis) if basis is not None else None
+    src_fd = os.open(src, os.O_RDONLY)
+    size = os.fstat(src_fd).st_size
+    data = mmap.mmap(src_fd, size, access=mmap.ACCESS_READ) if size else ''
+    drop = limiter is not None and limiter.drop_cache
+    if drop:
+        Throttle.drop_cache(src_fd, 0, 0, Throttle.POSIX_FADV_SEQUENTIAL)
+    try:
+        if sig is None or sig[0] != block_size:
+            copy_file(src, dst, fsync, limiter)
+            write_signature(dst, block_size, signature(data, block_size))
+            return size, 0
+
+        table = {}
+        for index, (weak, strong) in enumerate(sig[1]):
+            table.setdefault(weak, []).append((strong, index))
+
+        tmp = dst + '.part'
+        basis_fd = os.open(basis, os.O_RDONLY)
+        dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            written, reused = _apply_delta(data, size, table, block_size, basis_fd, dst_fd, limiter,
+                                           DELTA_WINDOW * block_size)
+            if fsync:
+                os.fsync(dst_fd)
+            if drop:
+                Throttle.write_back(dst_fd, 0, 0, True)
+                Throttle.drop_cache(dst_fd)
+                Throttle.drop_cache(basis_fd)
+        except BaseException:
+            os.close(dst_fd)
+            os.remove(tmp)
+            raise
+        finally:
+            os.close(basis_fd)
+        os.close(dst_fd)
+        shutil.copystat(src, tmp)
+        os.rename(tmp, dst)
+        write_signature(dst, block_size, signature(data, block_size))
+        return written, reused
+    finally:
+        if size:
+            data.close()
+        # The signature is the last pass over src
+        if drop:
+            Throttle.drop_cache(src_fd)
+        os.close(src_fd)
+
+
+def _apply_delta(data, size, table, block_size, basis_fd, dst_fd, limiter, window):
+    """Write src (data) to dst_fd as literal bytes and ranges copied from basis_fd"""
+    written = 0
+    reused = 0
+    out = 0
+    literal = 0
+    p = 0
+    a = b = None
+    run = None
+    accounted = 0
+    # Write-back window of dst, dropped from the page cache behind the writes like LimitedFile does
+    behind = [None]
+
+    def drop_behind(out, length):
+        if limiter is not None and limiter.drop_cache:
+            behind[0] = limiter.written(dst_fd, out, length, behind[0])
+
+    def flush_run(run, out):
+        if run is not None:
+            if limiter is not None:
+                limiter.read(run[1])
+                limiter.write(run[1])
+            copy_range(basis_fd, run[0], dst_fd, out, run[1])
+            out += run[1]
+            drop_behind(out, run[1])
+        return out
+
+    def write_literal(start, end, out):
+        os.lseek(dst_fd, out, os.SEEK_SET)
+        for offset in xrange(start, end, COPY_SIZE):
+            chunk = data[offset:min(end, offset + COPY_SIZE)]
+            if limiter is not None:
+                limiter.write(len(chunk))
+            write_all(dst_fd, chunk)
+            out += len(chunk)
+            drop_behind(out, len(chunk))
+        return out
+
+    while p + block_size <= size:
+        if limiter is not None and p + block_size > accounted:
+            limiter.read(min(COPY_SIZE, size - accounted))
+            accounted += COPY_SIZE
+        if p - literal >= window:
+            # Nothing was found for a while, try whole blocks only
+            weak = zlib.adler32(data[p:p + block_size]) & 0xFFFFFFFF
+            a = None
+            step = block_size
+        else:
+            if a is None:
+                weak = zlib.adler32(data[p:p + block_size]) & 0xFFFFFFFF
+                a, b = weak & 0xFFFF, weak >> 16
+            else:
+                out_byte = ord(data[p - 1])
+                in_byte = ord(data[p + block_size - 1])
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                weak = (b << 16) | a
+            step = 1
+        candidates = table.get(weak)
+        match = None
+        if candidates is not None:
+            strong = hashlib.md5(data[p:p + block_size]).hexdigest()
+            for candidate, index in candidates:
+                if candidate == strong:
+                    match = index
+                    break
+
+        if match is None:
+            p += step
+            continue
+
+        if literal < p:
+            out = flush_run(run, out)
+            run = None
+            out = write_literal(literal, p, out)
+            written += p - literal
+
+        # Extend the current run while blocks follow each other in basis
+        offset = match * block_size
+        if run is not None and run[0] + run[1] == offset:
+            run[1] += block_size
+        else:
+            out = flush_run(run, out)
+            run = [offset, block_size]
+        reused += block_size
+        p += block_size
+        literal = p
+        a = None
+
+    out = flush_run(run, out)
+    if literal < size:
+        if limiter is not None and accounted < size:
+            limiter.read(size - accounted)
+        write_literal(literal, size, out)
+        written += size - literal
+    return written, reused
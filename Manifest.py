@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import gzip
+
+
+class Manifest:
+    """
+    Manifest class
+
+    Keeps the state of every file of a source as recorded by the last
+    snapshot: size, modification time in nanoseconds, inode and an
+    optional content hash. Manifests are stored as gzipped, tab
+    separated text, one file per line, preceded by a header line.
+
+    Header fields:
+        time        time of the snapshot that produced the manifest
+        base        time of the full snapshot the chain started with
+        chain       number of incremental snapshots since base
+    """
+
+    HEADER = '#dir-copy-manifest'
+    VERSION = '1'
+
+    def __init__(self, time, base=None, chain=0):
+        self.time = time
+        self.base = base if base is not None else time
+        self.chain = chain
+        self.entries = {}
+
+    def add(self, path, st, digest=None):
+        """Record a file by its stat result and optional content hash"""
+        self.entries[path] = [st.st_size, self.mtime_ns(st), st.st_ino, digest]
+
+    def changed(self, path, st):
+        """Check whether a file differs from the recorded state"""
+        entry = self.entries.get(path)
+        if entry is None:
+            return True
+        return entry[0] != st.st_size or entry[1] != self.mtime_ns(st) or entry[2] != st.st_ino
+
+    def digest(self, path):
+        """Return the recorded content hash of a file, if any"""
+        entry = self.entries.get(path)
+        return entry[3] if entry is not None else None
+
+    def deleted(self, current):
+        """List files recorded here that are missing from the current manifest"""
+        return sorted(p for p in self.entries if p not in current.entries)
+
+    def save(self, path):
+        """Write the manifest to path, replacing any previous version atomically"""
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = path + '.tmp'
+        f = gzip.open(tmp, 'wb')
+        try:
+            f.write('\t'.join([self.HEADER, self.VERSION, self.time, self.base, str(self.chain)]) + '\n')
+            for p in sorted(self.entries):
+                size, mtime, inode, digest = self.entries[p]
+                f.write('\t'.join([
+                    p.encode('string_escape'), str(size), str(mtime), str(inode), digest or ''
+                ]) + '\n')
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a manifest from path, returns None if there is none"""
+        if not os.path.isfile(path):
+            return None
+        f = gzip.open(path, 'rb')
+        try:
+            header = f.readline().rstrip('\n').split('\t')
+            if len(header) != 5 or header[0] != cls.HEADER or header[1] != cls.VERSION:
+                raise Exception('Unsupported manifest format in ' + path)
+            manifest = cls(header[2], header[3], int(header[4]))
+            for line in f:
+                p, size, mtime, inode, digest = line.rstrip('\n').split('\t')
+                manifest.entries[p.decode('string_escape')] = [int(size), int(mtime), int(inode), digest or None]
+        finally:
+            f.close()
+        return manifest
+
+    @staticmethod
+    def mtime_ns(st):
+        """Modification time of a stat result in nanoseconds"""
+        return int(round(st.st_mtime * 1000000)) * 1000
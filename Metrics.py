@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+
+BUFFER_SIZE = 65536
+
+
+class Metrics:
+    """
+    Metrics class
+
+    Structured record of a snapshot run. Events and timed spans are
+    written as JSON lines to a log file that is kept open and buffered,
+    errors flush it right away. Spans are also summed per phase (and
+    destination) for export in the Prometheus text format, e.g. to the
+    textfile collector of the node exporter.
+    """
+
+    def __init__(self, path, labels=None, exported=('source',)):
+        """
+        Constructor
+
+        Attributes:
+            path        JSON lines log file
+            labels      fields added to every line (e.g. source and snapshot)
+            exported    labels also attached to exported metrics, run-specific ones would
+                        create new series on every run
+            phases      dict of (phase, destination) -> summed seconds, bytes and count
+        """
+        self.path = path
+        self.labels = labels or {}
+        self.exported = exported
+        self.phases = {}
+        self.started = time.time()
+        self.fp = None
+        self.lock = threading.Lock()
+
+    def event(self, level, message, **fields):
+        """Log a message"""
+        fields.update(level=level, message=message)
+        self.__write(fields, level in ('error', 'fatal'))
+
+    def span(self, phase, **labels):
+        """Return a context manager timing a phase, see Span"""
+        return Span(self, phase, labels)
+
+    def record(self, phase, seconds, bytes_in=0, bytes_out=0, error=None, **labels):
+        """Record a finished phase of a known duration"""
+        line = dict(labels, phase=phase, seconds=round(seconds, 6), bytes_in=bytes_in, bytes_out=bytes_out)
+        moved = max(bytes_in, bytes_out)
+        if moved:
+            line['mb_per_second'] = round(moved / 1048576.0 / max(seconds, 0.000001), 3)
+        if error is not None:
+            line['error'] = error
+        key = (phase, labels.get('destination', ''))
+        with self.lock:
+            totals = self.phases.setdefault(key, {'seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0, 'count': 0})
+            totals['seconds'] += seconds
+            totals['bytes_in'] += bytes_in
+            totals['bytes_out'] += bytes_out
+            totals['count'] += 1
+        self.__write(line, error is not None)
+
+    def flush(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+    def write_textfile(self, path, success):
+        """Export the phase totals of this run in the Prometheus text format, replacing path atomically"""
+        base = ','.join('%s="%s"' % (k, escape(v)) for k, v in sorted(self.labels.items()) if k in self.exported)
+        lines = []
+        for metric, field, text in (
+                ('dir_copy_phase_seconds', 'seconds', 'Time spent in a phase during the last run'),
+                ('dir_copy_phase_bytes_in', 'bytes_in', 'Bytes read in a phase during the last run'),
+                ('dir_copy_phase_bytes_out', 'bytes_out', 'Bytes written in a phase during the last run'),
+                ('dir_copy_phase_count', 'count', 'Number of times a phase ran during the last run')):
+            lines.append('# HELP ' + metric + ' ' + text)
+            lines.append('# TYPE ' + metric + ' gauge')
+            for (phase, destination), totals in sorted(self.phases.items()):
+                labels = base + (',' if base else '') + 'phase="' + escape(phase) + '"'
+                if destination:
+                    labels += ',destination="' + escape(destination) + '"'
+                lines.append('%s{%s} %s' % (metric, labels, repr(totals[field])))
+        for metric, value, text in (
+                ('dir_copy_last_run_timestamp_seconds', self.started, 'Start time of the last run'),
+                ('dir_copy_last_run_duration_seconds', time.time() - self.started, 'Duration of the last run'),
+                ('dir_copy_last_run_success', 1 if success else 0, 'Whether the last run succeeded')):
+            lines.append('# HELP ' + metric + ' ' + text)
+            lines.append('# TYPE ' + metric + ' gauge')
+            lines.append('%s{%s} %s' % (metric, base, repr(value)))
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(path + '.tmp', path)
+
+    def __write(self, line, flush=False):
+        line.update(self.labels)
+        line['time'] = round(time.time(), 6)
+        # Messages and labels carry file names, which are bytes that need not be valid UTF-8
+        for key, value in line.items():
+            if isinstance(value, str):
+                line[key] = value.decode('utf-8', 'replace')
+        data = json.dumps(line, sort_keys=True) + '\n'
+        with self.lock:
+            if self.fp is None:
+                self.fp = open(self.path, 'a', BUFFER_SIZE)
+            self.fp.write(data)
+            if flush:
+                self.fp.flush()
+
+
+class Span:
+    """Times a phase; bytes_in and bytes_out can be added while it runs"""
+
+    def __init__(self, metrics, phase, labels):
+        self.metrics = metrics
+        self.phase = phase
+        self.labels = labels
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, bytes_in=0, bytes_out=0):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.metrics.record(self.phase, time.time() - self.started, self.bytes_in, self.bytes_out,
+                            repr(value) if kind is not None else None, **self.labels)
+
+
+def escape(value):
+    """Escape a Prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Profiler:
+    """
+    Profiler class
+
+    Runs cProfile in the calling thread and in every thread started
+    while it is active, and merges all profiles into one stats file
+    that can be read with pstats or snakeviz.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.setprofile(self.__bootstrap)
+        self.main = cProfile.Profile()
+        self.main.enable()
+
+    def stop(self):
+        """Stop profiling and write the merged stats, returns them"""
+        self.main.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(self.main)
+        with self.lock:
+            for profile in self.profiles:
+                stats.add(profile)
+        stats.dump_stats(self.path)
+        return stats
+
+    def __bootstrap(self, frame, event, arg):
+        """Profile function of new threads, replaces itself with a cProfile profiler"""
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import Queue
+import threading
+
+ABORT = object()
+
+
+class Pipeline:
+    """
+    Pipeline class
+
+    A write-only file object that cuts everything written to it into
+    fixed-size parts and hands every part to a number of consumers
+    running in their own threads. Each consumer reads from a bounded
+    queue, so the writer blocks once the slowest consumer falls depth
+    parts behind and memory use stays bounded.
+    """
+
+    def __init__(self, part_size, depth=4):
+        """
+        Constructor
+
+        Attributes:
+            part_size   size of parts handed to consumers in bytes
+            depth       number of parts queued per consumer
+            errors      list of (consumer name, exception) tuples
+        """
+        self.part_size = max(int(part_size), 1)
+        self.depth = max(int(depth), 1)
+        self.buffer = []
+        self.buffered = 0
+        self.consumers = []
+        self.errors = []
+        self.closed = False
+
+    def add_consumer(self, name, target):
+        """
+        Start a consumer thread
+
+            name        name of the consumer used in error reports
+            target      callable receiving a readable file object
+        """
+        reader = PipeReader(Queue.Queue(self.depth))
+        worker = threading.Thread(target=self.__consume, args=(name, target, reader))
+        worker.daemon = True
+        worker.start()
+        self.consumers.append((name, reader, worker))
+
+    def write(self, data):
+        """Buffer data and emit every completed part"""
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.part_size:
+            data = ''.join(self.buffer)
+            while len(data) >= self.part_size:
+                self.__emit(data[:self.part_size])
+                data = data[self.part_size:]
+            self.buffer = [data]
+            self.buffered = len(data)
+
+    def close(self):
+        """Emit the last part, wait for all consumers and raise their first error"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.buffered:
+            self.__emit(''.join(self.buffer))
+        self.buffer = []
+        for name, reader, worker in self.consumers:
+            reader.queue.put(None)
+        self.__join()
+        if self.errors:
+            raise self.errors[0][1]
+
+    def abort(self):
+        """Stop all consumers, they see the stream fail instead of ending"""
+        if self.closed:
+            return
+        self.closed = True
+        for name, reader, worker in self.consumers:
+            reader.queue.put(ABORT)
+        self.__join()
+
+    def __emit(self, part):
+        """Queue a part for every consumer"""
+        for name, reader, worker in self.consumers:
+            reader.queue.put(part)
+
+    def __join(self):
+        for name, reader, worker in self.consumers:
+            worker.join()
+
+    def __consume(self, name, target, reader):
+        """Run a consumer and keep draining its queue if it stops early"""
+        try:
+            target(reader)
+        except Exception as e:
+            self.errors.append((name, e))
+        reader.drain()
+
+
+class PipeReader:
+    """Readable file object over the part queue of one consumer"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.data = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        """Read up to size bytes, blocking until they are produced"""
+        while not self.eof and (size < 0 or len(self.data) < size):
+            part = self.queue.get()
+            if part is ABORT:
+                self.eof = True
+                raise IOError('Snapshot pipeline was aborted')
+            if part is None:
+                self.eof = True
+                break
+            self.data += part
+        if size < 0:
+            size = len(self.data)
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def drain(self):
+        """Discard everything until the end of the stream"""
+        while not self.eof:
+            part = self.queue.get()
+            if part is None or part is ABORT:
+                self.eof = True
+        self.data = ''
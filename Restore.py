@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import re
+import mmap
+import zlib
+import Queue
+import fnmatch
+import threading
+import Archive
+import LocalCopy
+from ChunkStore import Deduplicator
+
+INDEX_PATTERN = re.compile(r'^(\d+)-(master|incr)\.zip' + re.escape(Archive.INDEX_SUFFIX) + '$')
+DEDUP_INDEX_PATTERN = re.compile(r'^(\d+)\.json\.gz$')
+RANGE_SIZE = 8388608
+TOMBSTONES = '.dir-copy-tombstones'
+
+
+class LocalLocation:
+    """Snapshots at a local destination, archives are read through memory maps"""
+
+    def __init__(self, path):
+        self.path = path
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def list(self, prefix):
+        return sorted(n for n in os.listdir(self.path) if n.startswith(prefix))
+
+    def read(self, name):
+        with open(self.path + '/' + name, 'rb') as f:
+            return f.read()
+
+    def read_range(self, name, offset, length):
+        with self.lock:
+            if name not in self.maps:
+                with open(self.path + '/' + name, 'rb') as f:
+                    self.maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            m = self.maps[name]
+        return m[offset:offset + length]
+
+    def check(self, name, info):
+        """Compare an archive with the size and sha256 recorded in its index, returns a problem or None"""
+        path = self.path + '/' + name
+        if not os.path.isfile(path):
+            return 'archive is missing'
+        if os.path.getsize(path) != info['size']:
+            return 'size is ' + str(os.path.getsize(path)) + ' instead of ' + str(info['size'])
+        if LocalCopy.file_hash(path) != info['sha256']:
+            return 'sha256 does not match'
+        return None
+
+    def close(self):
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
+
+
+class S3Location:
+    """Snapshots in an S3 bucket, archives are read with ranged GET requests"""
+
+    def __init__(self, bucket, prefix='', connect=None):
+        import boto
+        self.connect = connect or boto.connect_s3
+        self.bucket_name = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.local = threading.local()
+
+    def list(self, prefix):
+        keys = self.__bucket().list(prefix=self.prefix + prefix)
+        return sorted(k.name[len(self.prefix):] for k in keys)
+
+    def read(self, name):
+        return self.__bucket().new_key(self.prefix + name).get_contents_as_string()
+
+    def read_range(self, name, offset, length):
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+        return self.__bucket().new_key(self.prefix + name).get_contents_as_string(headers=headers)
+
+    def check(self, name, info):
+        """Compare an archive with the size and ETag recorded in its index, returns a problem or None"""
+        key = self.__bucket().get_key(self.prefix + name)
+        if key is None:
+            return 'archive is missing'
+        if key.size != info['size']:
+            return 'size is ' + str(key.size) + ' instead of ' + str(info['size'])
+        if key.etag.strip('"') != info['etag']:
+            return 'ETag is ' + key.etag.strip('"') + ' instead of ' + info['etag']
+        return None
+
+    def close(self):
+        pass
+
+    def __bucket(self):
+        """Bucket handle on a connection owned by the calling thread"""
+        if getattr(self.local, 'bucket', None) is None:
+            self.local.bucket = self.connect().get_bucket(self.bucket_name, validate=False)
+        return self.local.bucket
+
+
+def open_location(location):
+    """Open snapshots at a local destination path or an s3://bucket/prefix location"""
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[5:].partition('/')
+        return S3Location(bucket, prefix)
+    return LocalLocation(location)
+
+
+def matches(name, patterns):
+    """Tell whether a member name is selected by file, child directory or glob patterns"""
+    if not patterns:
+        return True
+    name = name.rstrip('/')
+    for pattern in patterns:
+        pattern = pattern.strip('/')
+        if name == pattern or name.startswith(pattern + '/') or fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+class Restore:
+    """
+    Restore class
+
+    Restores files from snapshots without downloading whole archives.
+    The index written next to every archive lists the offset and size
+    of the data of every member, including the members of child
+    archives packed in a master archive, so every file is read with a
+    single range request (or a slice of a memory map) and decompressed
+    on its own. Incremental snapshots are restored by applying the
+    chain from its full snapshot in order, dropping deleted files. The
+    index of a snapshot made of volumes only lists the volumes, their
+    own indexes are read in its place. Members of wrapped codecs are
+    unpacked to the name of the file they hold.
+    """
+
+    def __init__(self, location, source_name, workers=4, log=None):
+        """
+        Constructor
+
+        Attributes:
+            location    LocalLocation or S3Location holding the snapshots
+            source_name name of the source directory
+            workers     number of files restored at the same time
+            log         callable(level, message) receiving events
+            restored    number of restored files
+        """
+        self.location = location
+        self.source_name = source_name
+        self.workers = max(int(workers), 1)
+        self.log = log or (lambda level, message: None)
+        self.restored = 0
+        self.lock = threading.Lock()
+
+    def snapshots(self):
+        """Return a dict of time -> (kind, index name) of all indexed snapshots"""
+        prefix = self.source_name + '-'
+        result = {}
+        for name in self.location.list(prefix):
+            match = INDEX_PATTERN.match(name[len(prefix):])
+            if match is not None:
+                result[match.group(1)] = (match.group(2), name)
+        return result
+
+    def chain(self, snapshot_time=None):
+        """
+        Return the index names needed to restore a snapshot, oldest first
+
+            snapshot_time   time of the snapshot, the newest at or before
+                            it is used; the newest of all if None
+        """
+        snapshots = self.snapshots()
+        times = sorted((t for t in snapshots if snapshot_time is None or int(t) <= int(snapshot_time)), key=int)
+        if not times:
+            raise Exception('No snapshot of ' + self.source_name + ' found')
+        chain = []
+        for t in reversed(times):
+            kind, name = snapshots[t]
+            chain.insert(0, name)
+            if kind == 'master':
+                return chain
+        raise Exception('The full snapshot of the chain of ' + times[-1] + ' is missing')
+
+    def files(self, snapshot_time=None):
+        """Return a dict of file name -> (archive name, index entry) of a snapshot, entries are named by file"""
+        files = {}
+        for name in self.chain(snapshot_time):
+            index = Archive.read_index(self.location.read(name))
+            for archive, entry in self.members(index):
+                path = Archive.file_name(entry)
+                if path != TOMBSTONES:
+                    files[path] = (archive, dict(entry, name=path))
+            for path in index.get('deleted', []):
+                files.pop(path, None)
+        return files
+
+    def members(self, index):
+        """Return a list of (archive name, index entry) of a snapshot index, reading the indexes of its volumes"""
+        if 'volumes' not in index:
+            return [(index['archive'], entry) for entry in index['members']]
+        members = []
+        for volume in index['volumes']:
+            members.extend((volume['archive'], entry)
+                           for entry in Archive.read_index(self.location.read(volume['index']))['members'])
+        return members
+
+    def restore(self, target, patterns=None, snapshot_time=None):
+        """
+        Restore selected files of a snapshot to a directory
+
+            target          directory files are restored to, as <child>/<path>
+            patterns        list of files, child directories or globs, everything if empty
+            snapshot_time   time of the snapshot, see chain
+
+        Returns the number of restored files.
+        """
+        selected = [(archive, entry) for name, (archive, entry) in self.files(snapshot_time).items()
+                    if matches(name, patterns)]
+        # Directories first, then the largest files so the pool does not end on a long tail
+        selected.sort(key=lambda item: (not item[1]['name'].endswith('/'), -item[1]['csize']))
+        self.log('info', 'Restoring ' + str(len(selected)) + ' members to ' + target)
+
+        tasks = Queue.Queue()
+        for item in selected:
+            tasks.put(item)
+        errors = []
+        pool = []
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.__worker, args=(tasks, target, errors))
+            worker.daemon = True
+            worker.start()
+            pool.append(worker)
+        for worker in pool:
+            worker.join()
+        self.location.close()
+        if errors:
+            raise errors[0]
+        return self.restored
+
+    def __worker(self, tasks, target, errors):
+        while not errors:
+            try:
+                archive, entry = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.__extract(archive, entry, target)
+            except Exception as e:
+                self.log('error', 'Unable to restore ' + entry['name'] + ': ' + str(e))
+                errors.append(e)
+
+    def member_data(self, archive, entry):
+        """
+        Read and decompress the data of a member, the stream of a wrapped
+        codec is decompressed as well. Raises IOError if the data cannot
+        be decompressed or, once it is complete, if its crc does not match.
+        """
+        data = self.__stored_data(archive, entry)
+        if entry.get('codec') in Archive.WRAPPED_CODECS:
+            data = self.__decompress(Archive.codec(entry['codec']).decompressor(), data, archive, entry)
+        return data
+
+    def __stored_data(self, archive, entry):
+        """Read and decompress the data of a member as the zip headers describe it, checking its crc"""
+        crc = 0
+        for data in self.__decompress(Archive.method_codec(entry['method']).decompressor(),
+                                      self.__read(archive, entry), archive, entry):
+            crc = zlib.crc32(data, crc)
+            yield data
+        if crc & 0xFFFFFFFF != entry['crc']:
+            raise IOError('Checksum of ' + entry['name'] + ' in ' + archive + ' does not match')
+
+    def __read(self, archive, entry):
+        """Read the compressed data of a member in ranges"""
+        offset = entry['offset']
+        left = entry['csize']
+        while left > 0:
+            data = self.location.read_range(archive, offset, min(left, RANGE_SIZE))
+            if not data:
+                raise IOError('Unexpected end of ' + archive + ' while reading ' + entry['name'])
+            offset += len(data)
+            left -= len(data)
+            yield data
+
+    @staticmethod
+    def __decompress(decompressor, chunks, archive, entry):
+        """Pass chunks through a decompressor, its errors are raised as IOError"""
+        try:
+            for data in chunks:
+                yield decompressor.decompress(data)
+            # lzma decompressors have no flush, zstandard ones return None when there is nothing left
+            if hasattr(decompressor, 'flush'):
+                yield decompressor.flush() or ''
+        except IOError:
+            raise
+        except Exception as e:
+            raise IOError('Unable to decompress ' + entry['name'] + ' in ' + archive + ': ' + str(e))
+
+    def __extract(self, archive, entry, target):
+        """Read, decompress and check the data of a single member"""
+        name = entry['name']
+        parts = name.rstrip('/').split('/')
+        if name.startswith('/') or '..' in parts:
+            raise IOError('Refusing to restore ' + name + ' outside of ' + target)
+        path = os.path.join(target, *parts)
+        if name.endswith('/'):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    if not os.path.isdir(path):
+                        raise
+            return
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        try:
+            with open(path + '.part', 'wb') as f:
+                for data in self.member_data(archive, entry):
+                    f.write(data)
+        except IOError:
+            if os.path.isfile(path + '.part'):
+                os.remove(path + '.part')
+            raise
+        os.rename(path + '.part', path)
+        if entry['mode'] & 07777:
+            os.chmod(path, entry['mode'] & 07777)
+        os.utime(path, (entry['mtime'], entry['mtime']))
+        with self.lock:
+            self.restored += 1
+
+
+class DedupRestore(Restore):
+    """
+    DedupRestore class
+
+    Restores files from the snapshots of a deduplicating destination.
+    The index of every snapshot lists all of its files with their
+    chunks, so a snapshot is restored from its own index alone and
+    every chunk is checked against its sha256. Directories are not
+    recorded in these indexes, empty ones are not restored.
+    """
+
+    def __init__(self, store, source_name, workers=4, log=None):
+        """
+        Constructor
+
+        Attributes:
+            store       LocalChunkStore or S3ChunkStore holding the snapshots
+            source_name name of the source directory
+            workers     number of files restored at the same time
+            log         callable(level, message) receiving events
+        """
+        Restore.__init__(self, store, source_name, workers, log)
+
+    def snapshots(self):
+        """Return a dict of time -> ('master', index name) of all snapshots"""
+        prefix = self.source_name + '-'
+        result = {}
+        for name in self.location.list_indexes(prefix):
+            match = DEDUP_INDEX_PATTERN.match(name[len(prefix):])
+            if match is not None:
+                result[match.group(1)] = ('master', name)
+        return result
+
+    def files(self, snapshot_time=None):
+        """Return a dict of path -> (None, index entry) of a snapshot, entries have the keys restores use"""
+        index = Deduplicator.load_index(self.location, self.chain(snapshot_time)[-1])
+        return dict((entry['path'], (None, dict(entry, name=entry['path'], csize=entry['size'])))
+                    for entry in index['files'])
+
+    def member_data(self, archive, entry):
+        """Read the chunks of a file, raises IOError if one is corrupt"""
+        return Deduplicator.file_data(self.location, entry)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import re
+import json
+import time
+import datetime
+
+KEY_PATTERN = re.compile(r'^(\d+)-(master|incr)(?:\.\d+)?\.zip')
+DELETE_BATCH = 1000
+
+
+class Catalog:
+    """
+    Catalog class
+
+    Local record of the snapshots of one source in one S3 bucket, so
+    that retention and size reports do not need to list the bucket.
+    Snapshots are keyed by their time and hold every key belonging to
+    them (the archive and its sidecars) with its size. The bucket is
+    listed again, under the <source_name>- prefix only, when the
+    catalog is missing or older than max_age seconds.
+    """
+
+    def __init__(self, path, bucket, source_name, max_age=604800):
+        """
+        Constructor
+
+        Attributes:
+            path        catalog file
+            bucket      name of the S3 bucket
+            prefix      key prefix of the snapshots of the source
+            max_age     seconds after which the bucket is listed again
+            refreshed   time of the last listing of the bucket
+            snapshots   dict of time -> {'kind': master/incr, 'keys': {key name: size}}
+        """
+        self.path = path
+        self.bucket = bucket
+        self.prefix = source_name + '-'
+        self.max_age = max_age
+        self.refreshed = 0
+        self.snapshots = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('bucket') == bucket and data.get('prefix') == self.prefix:
+                self.refreshed = data['refreshed']
+                self.snapshots = data['snapshots']
+
+    def stale(self):
+        return time.time() - self.refreshed > self.max_age
+
+    def refresh(self, bucket):
+        """Rebuild the catalog from a listing of the snapshot prefix of a boto bucket"""
+        self.snapshots = {}
+        for key in bucket.list(prefix=self.prefix):
+            self.add(key.name, key.size)
+        self.refreshed = time.time()
+
+    def add(self, key_name, key_size):
+        """Record a key, returns False if it is not part of a snapshot of this source"""
+        match = KEY_PATTERN.match(key_name[len(self.prefix):]) if key_name.startswith(self.prefix) else None
+        if match is None:
+            return False
+        snapshot = self.snapshots.setdefault(match.group(1), {'kind': match.group(2), 'keys': {}})
+        snapshot['keys'][key_name] = key_size
+        return True
+
+    def remove(self, snapshot_time):
+        """Forget a snapshot and return the names of its keys"""
+        return sorted(self.snapshots.pop(snapshot_time, {'keys': {}})['keys'])
+
+    def size(self):
+        """Total size of all catalogued keys in bytes"""
+        return sum(sum(s['keys'].values()) for s in self.snapshots.values())
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'bucket': self.bucket, 'prefix': self.prefix, 'refreshed': self.refreshed,
+                       'snapshots': self.snapshots}, f)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def chains(snapshots):
+    """
+    Group snapshots into chains
+
+    A chain is a full snapshot followed by the incremental snapshots
+    taken until the next full one; incrementals depend on every earlier
+    member of their chain, so chains are only ever kept or removed as a
+    whole. Incrementals without a full snapshot before them form chains
+    of their own and are expired first.
+
+        snapshots   dict of time -> kind ('master' or 'incr')
+
+    Returns a list of lists of snapshot times, oldest chain first.
+    """
+    result = []
+    for snapshot_time in sorted(snapshots, key=int):
+        if snapshots[snapshot_time] == 'master' or not result:
+            result.append([])
+        result[-1].append(snapshot_time)
+    return result
+
+
+def expired(snapshots, pinned, keep_last=2, keep_daily=0, keep_weekly=0):
+    """
+    Select snapshots to remove with a grandfather-father-son policy
+
+        snapshots   dict of time -> kind ('master' or 'incr')
+        pinned      chains with snapshots at or after this time are always kept
+        keep_last   number of newest chains kept
+        keep_daily  number of days for which the newest chain is kept
+        keep_weekly number of weeks for which the newest chain is kept
+
+    Chains are dated by their first snapshot. Returns the times of the
+    snapshots of all other chains, oldest first.
+    """
+    all_chains = chains(snapshots)
+    kept = set(id(c) for c in all_chains[-keep_last:] if keep_last > 0)
+    for period, count in ((daily_period, keep_daily), (weekly_period, keep_weekly)):
+        seen = []
+        for chain in reversed(all_chains):
+            label = period(chain[0])
+            if label not in seen:
+                if len(seen) >= count:
+                    break
+                seen.append(label)
+                kept.add(id(chain))
+    result = []
+    for chain in all_chains:
+        if id(chain) not in kept and (pinned is None or int(chain[-1]) < int(pinned)):
+            result.extend(chain)
+    return result
+
+
+def daily_period(snapshot_time):
+    return datetime.datetime.utcfromtimestamp(int(snapshot_time)).strftime('%Y-%m-%d')
+
+
+def weekly_period(snapshot_time):
+    return '%04d-%02d' % datetime.datetime.utcfromtimestamp(int(snapshot_time)).isocalendar()[:2]
+
+
+def delete_keys(bucket, names):
+    """Remove keys from a boto bucket with multi-object deletes, returns the names that failed"""
+    failed = []
+    for i in range(0, len(names), DELETE_BATCH):
+        result = bucket.delete_keys(names[i:i + DELETE_BATCH], quiet=True)
+        failed.extend(error.key for error in result.errors)
+    return failed
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import re
+import stat
+import errno
+import Queue
+import threading
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Directories skipped unless skip_caches is disabled, in .gitignore syntax
+CACHE_PATTERNS = [
+    'node_modules/',
+    'bower_components/',
+    '__pycache__/',
+    '.cache/',
+    '.tox/',
+    '.pytest_cache/',
+    '.mypy_cache/',
+    '.sass-cache/',
+    '**/.gradle/caches/',
+]
+
+# Directories holding a CACHEDIR.TAG starting with this line are caches too
+# (see http://www.brynosaurus.com/cachedir/)
+CACHEDIR_TAG = 'CACHEDIR.TAG'
+CACHEDIR_SIGNATURE = 'Signature: 8a477f597d28d172789f06886806bc55'
+
+
+def translate(pattern):
+    """
+    Translate a .gitignore pattern to a regular expression
+
+    Returns a tuple of the compiled expression, matched against paths
+    relative to the scanned root, a flag telling whether the pattern
+    re-includes paths (!pattern) and a flag telling whether it only
+    matches directories (pattern/). None is returned for blank lines
+    and comments.
+    """
+    pattern = pattern.rstrip('\n')
+    if not pattern.strip() or pattern.startswith('#'):
+        return None
+    negate = pattern.startswith('!')
+    if negate or pattern.startswith('\\'):
+        pattern = pattern[1:]
+    pattern = pattern.rstrip(' ')
+    directory = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    # A slash anywhere but at the end anchors the pattern to the root
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = pattern.find(']', i + 2 if pattern.startswith('[!', i) or pattern.startswith('[^', i) else i + 1)
+            if end == -1:
+                regex += '\\['
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                regex += '[' + body.replace('\\', '\\\\') + ']'
+                i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+
+    regex = ('^' if anchored else '^(?:.*/)?') + regex + '$'
+    return re.compile(regex), negate, directory
+
+
+class Rules:
+    """
+    Rules class
+
+    Decides which paths are left out of a scan with .gitignore-style
+    patterns. Like in .gitignore the last matching pattern wins, a
+    pattern ending with / only matches directories and a pattern
+    containing a slash is anchored to the root; paths inside an
+    excluded directory cannot be re-included since the directory is
+    not read at all.
+    """
+
+    def __init__(self, exclude=None, include=None, skip_caches=True):
+        """
+        Constructor
+
+        Attributes:
+            exclude     patterns of paths left out of the scan
+            include     patterns of paths kept even if an exclude pattern matches them
+            skip_caches leave out cache directories (CACHE_PATTERNS and CACHEDIR.TAG)
+            rules       compiled (expression, negate, directory) tuples in order
+        """
+        self.skip_caches = skip_caches
+        patterns = (CACHE_PATTERNS if skip_caches else []) + list(exclude or [])
+        patterns += ['!' + p for p in include or []]
+        self.rules = [rule for rule in (translate(p) for p in patterns) if rule is not None]
+
+    def excluded(self, path, is_dir):
+        """Check if path, relative to the root, is left out"""
+        result = False
+        for regex, negate, directory in self.rules:
+            if (is_dir or not directory) and regex.match(path):
+                result = not negate
+        return result
+
+
+class Scanner:
+    """
+    Scanner class
+
+    Lists the files of the children of a source directory once, so
+    archiving, manifests and verification work from the same listing
+    instead of walking the tree each. Directories are read with
+    scandir (os.listdir and lstat without it) from an explicit stack,
+    optionally by several threads at the same time, which pays off on
+    network filesystems where every directory read is a round trip.
+
+    Entries are reported in the order of a sorted top-down os.walk,
+    with paths relative to the root. Like os.walk, symbolic links to
+    directories are not followed, symbolic links to files are. Only
+    directories and regular files are reported, FIFOs, sockets and
+    devices are skipped and logged.
+    """
+
+    def __init__(self, root, rules=None, threads=1, log=None):
+        """
+        Constructor
+
+        Attributes:
+            root        directory whose children are scanned
+            rules       Rules deciding which paths are left out, none by default
+            threads     number of threads reading directories
+            log         callable(level, message) receiving events
+            excluded    number of paths left out so far
+            skipped     number of FIFOs, sockets and devices skipped so far
+        """
+        self.root = root
+        self.rules = rules or Rules(skip_caches=False)
+        self.threads = max(int(threads), 1)
+        self.log = log or (lambda level, message: None)
+        self.excluded = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def children(self):
+        """Return the sorted names of the directories in root that are not left out"""
+        names = []
+        for name in os.listdir(self.root):
+            if os.path.isdir(os.path.join(self.root, name)):
+                if self.rules.excluded(name, True) or self.__cache_dir(name):
+                    self.__exclude(name)
+                else:
+                    names.append(name)
+        return sorted(names)
+
+    def scan(self, child):
+        """
+        Scan a child directory
+
+        Returns a tuple of the list of (path, stat result) of the child,
+        its directories and files, and the list of (path, error) of the
+        paths that could not be read.
+        """
+        listings = {}
+        errors = []
+        if self.threads > 1:
+            self.__read_parallel(child, listings, errors)
+        else:
+            stack = [child]
+            while stack:
+                directory = stack.pop()
+                listings[directory] = listing = self.__read(directory, errors)
+                stack.extend(path for path, st in listing[0])
+
+        entries = []
+        try:
+            stack = [(child, os.stat(os.path.join(self.root, child)))]
+        except OSError as e:
+            errors.append((child, str(e)))
+            stack = []
+        while stack:
+            directory, st = stack.pop()
+            dirs, files, cache = listings.pop(directory, ([], [], False))
+            if cache:
+                continue
+            entries.append((directory, st))
+            entries.extend(files)
+            stack.extend(reversed(dirs))
+        return entries, sorted(errors)
+
+    def scan_paths(self, paths):
+        """
+        Scan only the given paths below root, as a change journal lists them
+
+        Directories are scanned with everything below them, paths that no
+        longer exist or are left out by the rules are skipped. Returns a
+        tuple of lists like scan, ordered by path.
+        """
+        entries = []
+        errors = []
+        paths = set(paths)
+        for path in sorted(paths):
+            parts = path.split('/')
+            # Paths below a listed directory are part of its scan
+            if any('/'.join(parts[:i]) in paths for i in range(1, len(parts))):
+                continue
+            if any(self.rules.excluded('/'.join(parts[:i]), True) for i in range(1, len(parts))):
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, path))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    errors.append((path, str(e)))
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if is_dir and os.path.islink(os.path.join(self.root, path)):
+                continue
+            if self.rules.excluded(path, is_dir):
+                self.__exclude(path)
+            elif is_dir:
+                scan = self.scan(path)
+                entries.extend(scan[0])
+                errors.extend(scan[1])
+            elif not self.__special(path, st):
+                entries.append((path, st))
+        return entries, sorted(errors)
+
+    def __read_parallel(self, child, listings, errors):
+        """Read all directories below child with a pool of threads"""
+        queue = Queue.Queue()
+        queue.put(child)
+
+        def worker():
+            while True:
+                directory = queue.get()
+                if directory is None:
+                    return
+                try:
+                    listings[directory] = listing = self.__read(directory, errors)
+                    for path, st in listing[0]:
+                        queue.put(path)
+                except Exception as e:
+                    errors.append((directory, str(e)))
+                finally:
+                    queue.task_done()
+
+        pool = []
+        for i in range(self.threads):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            pool.append(thread)
+        queue.join()
+        for thread in pool:
+            queue.put(None)
+        for thread in pool:
+            thread.join()
+
+    def __read(self, directory, errors):
+        """
+        Read a directory
+
+        Returns a tuple of the sorted lists of (path, stat result) of
+        its subdirectories and files and a flag telling whether it is
+        a tagged cache directory.
+        """
+        dirs = []
+        files = []
+        try:
+            entries = list(self.__entries(directory))
+        except OSError as e:
+            errors.append((directory, str(e)))
+            return dirs, files, False
+
+        for name, is_dir, is_link in entries:
+            if name == CACHEDIR_TAG and self.rules.skip_caches and self.__cache_dir(directory):
+                self.__exclude(directory)
+                return [], [], True
+        for name, is_dir, is_link in entries:
+            path = directory + '/' + name
+            if is_dir and is_link:
+                continue
+            if self.rules.excluded(path, is_dir):
+                self.__exclude(path)
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, path))
+            except OSError as e:
+                errors.append((path, str(e)))
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append((path, st))
+            elif not self.__special(path, st):
+                files.append((path, st))
+        dirs.sort()
+        files.sort()
+        return dirs, files, False
+
+    def __entries(self, directory):
+        """Yield name and directory and symbolic link flags of every entry in directory"""
+        path = os.path.join(self.root, directory)
+        if scandir is not None:
+            for entry in scandir(path):
+                yield entry.name, entry.is_dir(), entry.is_symlink()
+        else:
+            for name in os.listdir(path):
+                st = os.lstat(os.path.join(path, name))
+                if stat.S_ISLNK(st.st_mode):
+                    yield name, os.path.isdir(os.path.join(path, name)), True
+                else:
+                    yield name, stat.S_ISDIR(st.st_mode), False
+
+    def __cache_dir(self, directory):
+        """Check if directory holds a CACHEDIR.TAG with the standard signature"""
+        if not self.rules.skip_caches:
+            return False
+        try:
+            with open(os.path.join(self.root, directory, CACHEDIR_TAG)) as f:
+                return f.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+        except IOError:
+            return False
+
+    def __special(self, path, st):
+        """Check for FIFOs, sockets and devices, which are never archived as reading them may block forever"""
+        if stat.S_ISREG(st.st_mode):
+            return False
+        with self.lock:
+            self.skipped += 1
+        self.log('warning', 'Skipping ' + path + ', it is not a regular file')
+        return True
+
+    def __exclude(self, path):
+        """Count and log a path left out of the scan"""
+        with self.lock:
+            self.excluded += 1
+        self.log('debug', 'Excluded ' + path)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import sys
+import heapq
+import itertools
+import threading
+import traceback
+from Snapshot import Snapshot
+from Throttle import TokenBucket
+
+
+class Resource:
+    """Counting semaphore handing free slots to the waiter with the highest priority"""
+
+    def __init__(self, name, slots):
+        self.name = name
+        self.slots = max(int(slots), 1)
+        self.used = 0
+        self.waiting = []
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+
+    def acquire(self, priority=0):
+        with self.cond:
+            ticket = (-priority, next(self.order))
+            heapq.heappush(self.waiting, ticket)
+            while self.used >= self.slots or self.waiting[0] != ticket:
+                self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.used += 1
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.used -= 1
+            self.cond.notify_all()
+
+
+class Scheduler:
+    """
+    Scheduler class
+
+    Runs snapshots of several sources at the same time. Every snapshot
+    goes through three phases, archiving (cpu), local transfers (disk)
+    and S3 and dedup transfers (net), and holds a slot of the matching
+    resource only while it is in that phase, so one source is uploaded
+    while the next one is compressed. Pipeline snapshots archive and
+    ship at once and take a slot of every resource for that phase.
+
+    Jobs with a higher priority start first and get freed slots first.
+    A bandwidth cap is shared by the S3 uploads of all jobs, an I/O
+    limiter by their disk reads and writes.
+    """
+
+    def __init__(self, cpu=1, disk=1, net=2, jobs=None, bandwidth=None, limiter=None):
+        """
+        Constructor
+
+        Attributes:
+            resources   cpu, disk and net resources with their slot counts
+            jobs        number of snapshots in progress at the same time
+            throttle    token bucket of the bandwidth cap, None if uncapped
+            limiter     IOLimiter of disk reads and writes, if any
+            failed      list of (source, exception) tuples of failed jobs
+        """
+        self.resources = {
+            'cpu': Resource('cpu', cpu),
+            'disk': Resource('disk', disk),
+            'net': Resource('net', net),
+        }
+        self.jobs = max(int(jobs or cpu + disk + net), 1)
+        self.throttle = TokenBucket(bandwidth) if bandwidth else None
+        self.limiter = limiter
+        self.queue = []
+        self.order = itertools.count()
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def add(self, config, priority=None, changes=None):
+        """Queue a snapshot of a backup.json entry, its priority key is used by default, see Snapshot for changes"""
+        if priority is None:
+            priority = int(config.get('priority', 0))
+        heapq.heappush(self.queue, (-priority, next(self.order), config, changes))
+
+    def run(self):
+        """Run all queued snapshots and return the list of failed jobs"""
+        pool = []
+        for i in range(min(self.jobs, len(self.queue))):
+            worker = threading.Thread(target=self.__worker)
+            worker.daemon = True
+            worker.start()
+            pool.append(worker)
+        for worker in pool:
+            while worker.is_alive():
+                worker.join(0.5)
+        return self.failed
+
+    def __worker(self):
+        """Run queued jobs, highest priority first, until the queue is empty"""
+        while True:
+            with self.lock:
+                if not self.queue:
+                    return
+                priority, order, config, changes = heapq.heappop(self.queue)
+            try:
+                self.__run_job(config, -priority, changes)
+            except Exception as e:
+                with self.lock:
+                    self.failed.append((config['source'], e))
+                    sys.stderr.write('Snapshot of ' + config['source'] + ' failed:\n')
+                    traceback.print_exc()
+
+    def __run_job(self, config, priority, changes):
+        """Run the phases of a single snapshot, each holding its resources"""
+        snapshot = Snapshot(config['source'], config['destinations'], config, throttle=self.throttle,
+                            limiter=self.limiter, changes=changes)
+        try:
+            self.__phase(('cpu', 'disk', 'net') if snapshot.pipeline else ('cpu',), priority, snapshot.make)
+            self.__phase(('disk',), priority, snapshot.transfer_local)
+            self.__phase(('net',), priority, snapshot.transfer_remote)
+        except BaseException:
+            snapshot.report(False)
+            raise
+        snapshot.finish()
+
+    def __phase(self, names, priority, target):
+        """Call target while holding a slot of every named resource, always taken in the same order"""
+        held = []
+        try:
+            for name in names:
+                self.resources[name].acquire(priority)
+                held.append(self.resources[name])
+            target()
+        finally:
+            for resource in reversed(held):
+                resource.release()
@@ -24,17 +24,37 @@
 __author__ = 'vstrackovski'
 
 import os
+import glob
 import errno
-import subprocess
 import shutil
 import time
-import math
+import datetime
 import boto
 import sys
-from filechunkio import FileChunkIO
+import threading
+import Queue
+import stat
+import multiprocessing
+import Archive
+from Archive import ArchiveWriter
+from Manifest import Manifest
+from Cache import ArchiveCache
+from Uploader import MultipartUploader
+from Pipeline import Pipeline
+import ChunkStore
+import LocalCopy
+import Retention
+import Verify
+from Metrics import Metrics
+from Checkpoint import Checkpoint
+from Volume import VolumeWriter
+from Scanner import Scanner, Rules
+from Retention import Catalog
+from ChunkStore import Deduplicator
 from hurry.filesize import size
 from boto.exception import S3ResponseError
 from boto.exception import S3CreateError
+from boto.utils import parse_ts
 
 
 class Snapshot:
@@ -52,27 +72,165 @@ class Snapshot:
     S3 Buckets are supported as destinations.
     """
 
-    def __init__(self, source, destinations):
+    # Member of incremental archives listing files deleted since the previous run
+    TOMBSTONES = '.dir-copy-tombstones'
+
+    def __init__(self, source, destinations, options=None, throttle=None, limiter=None, changes=None):
         """
         Constructor
 
         Attributes:
             source          absolute path to directory to backup
             destinations    list of local and remote backup destinations
+            options         optional backup parameters (see readme)
+            throttle        token bucket limiting the upload rate, shared between snapshots
+            limiter         IOLimiter pacing disk reads and writes, shared between snapshots
+            changes         paths (<child>/<path>) changed since the previous snapshot, only they
+                            are scanned for an incremental snapshot; None scans the whole source
             source_root     parent directory of source
             source_name     name of source directory
             temp_dir_name   name of temporary directory
             temp_dir_path   absolute path to temporary directory
             master_file     absolute path to master file when created
+            index_file      absolute path to the index of the master file when created
+            hashes          sha256, size and multipart ETag of the master file, see Verify.HashingWriter
+            etags           part ETags of the S3 upload of the master file by bucket
+            metrics         JSON lines log and phase timings of this run
+            metrics_dir     directory of the Prometheus textfile export, if any
+            workers         number of child directories archived concurrently
+            engine          'zip' for per-child archives, 'stream' for single pass, 'volume' for size-bounded volumes
+            volume_size     target size of volumes in bytes
+            volumes         (path, hashes) of the volumes of the snapshot when created
+            state_dir       directory keeping state between runs (manifests)
+            incremental     archive only files changed since the previous run
+            full_every      number of incremental runs between full snapshots
+            manifest_hash   hashlib algorithm for manifest content hashes, if any
+            pipeline        ship archive parts to destinations while it is written
+            codec           codec of archived files, see Archive.codec
+            store_extensions file extensions stored without compression
+            chunk_size      average chunk size of deduplicating destinations
+            local_delta     transfer only changed blocks to local destinations
+            local_fsync     flush local destination copies to stable storage
+            local_verify    re-read local destination copies and compare hashes
+            cache           archive cache of unchanged children, None if disabled
+            upload_*        part size, concurrency, buffers and retries of S3 uploads
+            keep_*          retention policy of S3 buckets, see Retention.expired
+            upload_expiry   age in seconds after which unfinished uploads of other keys are cancelled
+            catalogs        catalogs of S3 buckets by bucket name
+            scanner         lists children of the source once, with the exclude rules of the source
+            scans           scans of children kept for later phases, see Scanner.scan
+            checkpoint      progress of this run for resuming it, None if disabled
+            resumed         this run continues an unfinished run with the same time
         """
+        if options is None:
+            options = {}
+
         self.time = str(int(time.time()))
+        # Sources read from backup.json are unicode, file names are walked and archived as bytes
+        if isinstance(source, unicode):
+            source = source.encode(sys.getfilesystemencoding() or 'utf-8')
         self.source = source
         self.source_root = os.path.abspath(os.path.join(source, os.pardir))
         self.source_name = os.path.basename(os.path.normpath(source))
+        self.metrics_dir = options.get('metrics_dir')
         self.destinations = destinations
+        self.master_file = None
+        self.index_file = None
+        self.hashes = None
+        self.etags = {}
+        self.volumes = []
+        self.workers = int(options.get('workers') or multiprocessing.cpu_count())
+        self.incremental = bool(options.get('incremental', False))
+        self.pipeline = bool(options.get('pipeline', False))
+        self.pipeline_depth = int(options.get('pipeline_depth', 4))
+        self.engine = options.get('engine', 'stream' if self.incremental or self.pipeline else 'zip')
+        if self.engine not in ('zip', 'stream', 'volume'):
+            raise Exception('Unknown snapshot engine ' + str(self.engine))
+        if self.incremental and self.engine == 'zip':
+            raise Exception('Incremental snapshots require the stream or volume engine')
+        if self.pipeline and self.engine != 'stream':
+            raise Exception('Pipeline mode requires the stream engine')
+        self.state_dir = options.get('state_dir') or self.source_root + '/.' + self.source_name + '-state'
+        self.full_every = int(options.get('full_every', 7))
+        self.manifest_hash = options.get('manifest_hash')
+        self.manifest_file = self.state_dir + '/manifest.gz'
+        self.previous = Manifest.load(self.manifest_file) if self.incremental else None
+        self.codec = Archive.codec(options.get('codec', 'deflate'), options.get('level'))
+        if 'store_extensions' in options:
+            self.store_extensions = options['store_extensions']
+        else:
+            self.store_extensions = Archive.STORE_EXTENSIONS if options.get('auto_store', True) else []
+        self.chunk_size = int(options.get('chunk_size', 1024)) * 1024
+        self.local_delta = bool(options.get('local_delta', False))
+        self.delta_block_size = int(options.get('delta_block_size', 128)) * 1024
+        self.volume_size = int(float(options.get('volume_size', 1024)) * 1048576)
+        self.local_fsync = bool(options.get('local_fsync', False))
+        self.local_verify = bool(options.get('local_verify', False))
+        self.upload_part_size = int(float(options.get('upload_part_size', 50)) * 1048576)
+        self.upload_concurrency = int(options.get('upload_concurrency', 4))
+        self.upload_buffers = int(options.get('upload_buffers', 0)) or None
+        self.upload_retries = int(options.get('upload_retries', 5))
+        self.throttle = throttle
+        self.limiter = limiter
+        self.keep_last = int(options.get('keep_last', 2))
+        self.keep_daily = int(options.get('keep_daily', 0))
+        self.keep_weekly = int(options.get('keep_weekly', 0))
+        self.catalog_refresh = float(options.get('catalog_refresh', 7)) * 86400
+        self.upload_expiry = float(options.get('upload_expiry', 7)) * 86400
+        self.catalogs = {}
+        self.buckets = []
+        self.cache = None
+        if options.get('cache_size'):
+            self.cache = ArchiveCache(options.get('cache_dir') or self.state_dir + '/cache',
+                                      int(options['cache_size']) * 1048576, self.limiter)
+        if self.previous is not None and self.previous.chain < self.full_every:
+            self.kind = 'incr'
+        else:
+            self.kind = 'master'
+
+        # Continue the last run if it died, it keeps its time and therefore its file names
+        self.checkpoint = None
+        self.resumed = False
+        stale = None
+        if options.get('resume', True) and not self.pipeline:
+            self.checkpoint = Checkpoint(self.state_dir + '/checkpoint.json')
+            if self.checkpoint.load():
+                if self.checkpoint.matches(float(options.get('resume_max_age', 24)) * 3600, source=self.source,
+                                           engine=self.engine, kind=self.kind,
+                                           previous=self.previous.time if self.previous is not None else None):
+                    self.time = self.checkpoint.run['time']
+                    self.resumed = True
+                else:
+                    stale = self.checkpoint.run['time']
+                    self.checkpoint.discard()
+
+        self.metrics = Metrics(self.source_root + '/' + self.source_name + '-' + self.time + '.log',
+                               {'source': self.source_name, 'snapshot': self.time})
+        if stale is not None:
+            self.log_events('warning', 'Discarded the checkpoint of unfinished run ' + stale)
         self.temp_dir_name = self.source_name + '-' + self.time
         self.temp_dir_path = self.source_root + '/' + self.temp_dir_name
-        self.master_file = None
+        if self.kind == 'incr':
+            self.manifest = Manifest(self.time, self.previous.base, self.previous.chain + 1)
+        else:
+            self.manifest = Manifest(self.time)
+        self.scanner = Scanner(source, Rules(options.get('exclude'), options.get('include'),
+                                             options.get('skip_caches', True)),
+                               options.get('scan_threads', 1), self.log_events)
+        self.scans = {}
+        self.changes = None
+        if changes is not None and self.kind == 'incr':
+            if self.destinations.get('dedup'):
+                # Deduplicating destinations index every file of the source
+                self.log_events('info', 'Scanning the whole source for deduplicating destinations')
+            else:
+                self.__use_changes(changes)
+        self.children = []
+        self.archived = []
+        self.failed = []
+        self.errors = []
+        self.deleted = []
+        self.lock = threading.RLock()
 
     def make(self):
         """Make snapshot"""
@@ -80,52 +238,231 @@ class Snapshot:
         print "Backup source path: " + self.source
         print "Backup name: " + self.source_name
         print "Backup destinations: " + str(self.destinations)
-        print "Temporary directory path: " + self.temp_dir_path
+        print "Snapshot engine: " + self.engine
+        if self.incremental:
+            print "Snapshot type: " + ('incremental' if self.kind == 'incr' else 'full')
+        if self.engine == 'zip':
+            print "Temporary directory path: " + self.temp_dir_path
         print "\n**** RUNNING BACKUP ****\n"
 
-        self.log_events('info', 'Backup from ' + self.source + ' to ' + str(self.destinations) +
-                                ' with temporary path at ' + self.temp_dir_path)
         self.log_events('info', 'Starting backup name ' + self.source_name + '-' + self.time)
-        self.__make_temp_dir()
-        self.__compress_source_dirs()
-        self.__verify_source_archives()
-        self.__make_snapshot()
+        self.__start_checkpoint()
+        if not self.destinations['local'] and not self.destinations['s3']:
+            self.log_events('info', 'No archive destinations configured, skipping master archive')
+        elif self.resumed and self.__resume_master():
+            print "Resuming with the master archive of the unfinished run"
+        elif self.engine == 'stream':
+            self.log_events('info', 'Backup from ' + self.source + ' to ' + str(self.destinations) +
+                                    ' streamed to ' + self.source_root)
+            self.__stream_snapshot()
+            self.__verify_source_archives()
+            self.__checkpoint_master()
+        elif self.engine == 'volume':
+            self.log_events('info', 'Backup from ' + self.source + ' to ' + str(self.destinations) +
+                                    ' in volumes at ' + self.source_root)
+            self.__volume_snapshot()
+            self.__verify_source_archives()
+            self.__checkpoint_master()
+        else:
+            self.log_events('info', 'Backup from ' + self.source + ' to ' + str(self.destinations) +
+                                    ' with temporary path at ' + self.temp_dir_path)
+            self.__make_temp_dir()
+            self.__compress_source_dirs()
+            self.__verify_source_archives()
+            self.__make_snapshot()
+            self.__checkpoint_master()
 
     def transfer(self):
         """Transfer snapshot"""
-        self.__transfer_snapshot_local()
-        self.__transfer_snapshot_s3()
+        self.transfer_local()
+        self.transfer_remote()
+        self.finish()
+
+    def transfer_local(self):
+        """Transfer snapshot to local destinations"""
+        if self.__archives() and not self.pipeline:
+            self.__transfer_snapshot_local()
+        for index in self.__index_files():
+            for dest in self.__local_destinations():
+                shutil.copy2(index, dest)
+
+    def transfer_remote(self):
+        """Transfer snapshot to S3 buckets and deduplicating destinations"""
+        if self.__archives() and not self.pipeline:
+            self.__transfer_snapshot_s3()
+        if self.__index_files():
+            self.__transfer_index_s3()
+        self.__transfer_snapshot_dedup()
+
+    def finish(self):
+        """Record the snapshot as the base of the next run and remove temporary files"""
+        if self.incremental:
+            self.manifest.save(self.manifest_file)
+            self.log_events('info', 'Saved manifest of ' + str(len(self.manifest.entries)) + ' files')
         self.__cleanup()
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+        self.report(True)
+
+    def report(self, success):
+        """Flush the log and export the phase timings of this run"""
+        self.log_events('info' if success else 'error', 'Backup ' + ('completed' if success else 'failed'))
+        if self.metrics_dir:
+            self.metrics.write_textfile(self.metrics_dir + '/dir-copy-' + self.source_name + '.prom', success)
+        self.metrics.close()
 
-    def __purge_s3(self, bucket, keep_older=1):
+    def __purge_s3(self, b, catalog):
         """
-        Remove older archives from the S3 bucket
+        Remove expired snapshots from the S3 bucket
 
-            bucket      S3 bucket name to purge
-            keep_older  Amount of previous archives to keep
+            b           boto bucket to purge
+            catalog     catalog of the snapshots of this source in the bucket
         """
-        c = boto.connect_s3()
-        b = c.get_bucket(bucket)
-        rs = b.list()
+        snapshots = dict((t, snapshot['kind']) for t, snapshot in catalog.snapshots.items())
+        snapshots[self.time] = self.kind
+        names = []
+        # Never remove the chain the current snapshot belongs to
+        for t in Retention.expired(snapshots, self.manifest.base, self.keep_last, self.keep_daily,
+                                   self.keep_weekly):
+            names.extend(catalog.remove(t))
+        if names:
+            failed = Retention.delete_keys(b, names)
+            self.log_events('info', 'Removed ' + str(len(names) - len(failed)) + ' expired keys from bucket ' +
+                            b.name)
+            if failed:
+                self.log_events('error', 'Unable to remove ' + ', '.join(failed) + ' from bucket ' + b.name)
+                # List the bucket again on the next run
+                catalog.refreshed = 0
+        catalog.save()
 
-        older_archives = []
-        for item in rs:
-            if self.source_name in item.name:
-                sitem = item.name.split('-')
-                mtime = sitem[len(sitem)-2]
-                if mtime < self.time:
-                    older_archives.append(item.name)
+    def __catalog(self, bucket, b=None):
+        """Load the catalog of a bucket, listing the bucket if the catalog is stale or b is new"""
+        catalog = Catalog(self.state_dir + '/catalog-' + bucket + '.json', bucket, self.source_name,
+                          self.catalog_refresh)
+        if b is None:
+            catalog.snapshots = {}
+            catalog.refreshed = time.time()
+        elif catalog.stale():
+            self.log_events('info', 'Listing snapshots of ' + self.source_name + ' in bucket ' + bucket)
+            catalog.refresh(b)
+        self.catalogs[bucket] = catalog
+        return catalog
 
-        if len(older_archives) > keep_older:
-            for o in older_archives[:-keep_older]:
-                b.delete_key(o)
+    def __record_s3(self, buckets, name, key_size):
+        """Add an uploaded key to the catalogs of the buckets"""
+        for bucket in buckets:
+            self.catalogs[bucket].add(name, key_size)
+            self.catalogs[bucket].save()
+
+    def __start_checkpoint(self):
+        """Start checkpointing this run, or continue checkpointing the resumed run"""
+        if self.checkpoint is None:
+            return
+        if self.resumed:
+            self.log_events('info', 'Resuming unfinished run ' + self.time + ' with ' +
+                            str(len(self.checkpoint.children)) + ' finished dirs')
+            print "Resuming unfinished run " + self.time + "..."
+            self.checkpoint.resume()
+            return
+        name = self.source_root + '/' + self.source_name + '-' + self.time + '-' + self.kind
+        self.checkpoint.start(time=self.time, source=self.source, engine=self.engine, kind=self.kind,
+                              previous=self.previous.time if self.previous is not None else None,
+                              files=[self.temp_dir_path, name + '.zip', name + '.zip' + Archive.INDEX_SUFFIX,
+                                     name + '.[0-9]*.zip*'])
+
+    def __checkpoint_master(self):
+        """Record the finished master archive in the checkpoint"""
+        if self.checkpoint is None:
+            return
+        self.checkpoint.finish_master({
+            'archive': os.path.basename(self.master_file) if self.master_file is not None else None,
+            'hashes': self.hashes,
+            'volumes': [{'archive': os.path.basename(path), 'hashes': hashes} for path, hashes in self.volumes],
+            'index': os.path.basename(self.index_file),
+            'children': [item.encode('string_escape') for item in self.children],
+            'archived': [item.encode('string_escape') for item in self.archived],
+            'failed': [item.encode('string_escape') for item in self.failed],
+            'deleted': [p.encode('string_escape') for p in self.deleted],
+        })
+
+    def __resume_master(self):
+        """Take the master archive of the resumed run if it was finished, returns False if it has to be made"""
+        master = self.checkpoint.master
+        if master is None:
+            return False
+        volumes = [(self.source_root + '/' + v['archive'], v['hashes']) for v in master['volumes']]
+        archives = volumes or [(self.source_root + '/' + master['archive'], master['hashes'])]
+        index = self.source_root + '/' + master['index']
+        for path, hashes in archives:
+            if not os.path.isfile(path) or os.path.getsize(path) != hashes['size'] or \
+                    not os.path.isfile(path + Archive.INDEX_SUFFIX) or not os.path.isfile(index):
+                self.log_events('warning', 'Archive ' + path + ' of the unfinished run is missing, making it again')
+                return False
+        if volumes:
+            self.volumes = volumes
+        else:
+            self.master_file, self.hashes = archives[0]
+        self.index_file = index
+        self.children, self.archived, self.failed, self.deleted = (
+            [p.encode('utf-8').decode('string_escape') for p in master[field]]
+            for field in ('children', 'archived', 'failed', 'deleted'))
+        for record in self.checkpoint.children.values():
+            self.__restore_manifest(record)
+        self.log_events('info', 'Resuming with the ' + str(len(archives)) + ' archives of the unfinished run')
+        return True
+
+    def __restore_manifest(self, record):
+        """Put the manifest entries of a journaled child back into the manifest"""
+        for path, entry in record.get('manifest', {}).iteritems():
+            self.manifest.entries[path.encode('utf-8').decode('string_escape')] = entry
+
+    def __child_manifest(self, scan):
+        """Return the manifest entries of a scanned child, with escaped paths for the journal"""
+        entries, errors = scan
+        paths = [path for path, st in entries if not stat.S_ISDIR(st.st_mode)]
+        for path, error in errors:
+            paths.append(path)
+            if self.previous is not None:
+                paths.extend(p for p in self.previous.entries if p.startswith(path + '/'))
+        return dict((p.encode('string_escape'), self.manifest.entries[p]) for p in paths if p in self.manifest.entries)
+
+    def __transferred(self, destination):
+        """Check if the resumed run already finished transferring to destination"""
+        if not self.resumed or destination not in self.checkpoint.done:
+            return False
+        self.log_events('info', 'Skipping destination ' + destination + ', the unfinished run transferred to it')
+        print "Skipping destination " + destination + ", already transferred"
+        return True
+
+    def __archives(self):
+        """Return (path, hashes) of the archives of the snapshot, the master archive or the volumes"""
+        if self.volumes:
+            return self.volumes
+        if self.master_file is not None:
+            return [(self.master_file, self.hashes)]
+        return []
+
+    def __index_files(self):
+        """Return the indexes of the snapshot, the volume indexes before the top-level index"""
+        indexes = [path + Archive.INDEX_SUFFIX for path, hashes in self.volumes]
+        if self.index_file is not None:
+            indexes.append(self.index_file)
+        return indexes
 
     def __cleanup(self):
         """Remove temporary files and directories"""
-        os.remove(self.master_file)
+        for path in [path for path, hashes in self.__archives()] + self.__index_files():
+            if path is not None and os.path.isfile(path):
+                os.remove(path)
 
     def __make_temp_dir(self):
         """Create temporary directory to local space"""
+        if self.resumed and os.path.isdir(self.temp_dir_path):
+            # Keep the child archives the unfinished run completed
+            for name in os.listdir(self.temp_dir_path):
+                if name[:-len('.zip')] not in self.checkpoint.children:
+                    os.remove(self.temp_dir_path + '/' + name)
+            return self.temp_dir_path
         os.mkdir(self.temp_dir_path)
         if not os.path.isdir(self.temp_dir_path):
             self.log_events('fatal', 'Unable to create temporary directory at ' + self.temp_dir_path)
@@ -135,59 +472,496 @@ class Snapshot:
 
     def __compress_source_dirs(self):
         """Compress individual child directories in the source directory"""
-        # CHDIR to source dir to avoid unnecessary path nesting
-        os.chdir(self.source)
-        pipe = subprocess.PIPE
-        source_count = 0
+        self.children = children = self.scanner.children()
+        fingerprints = {}
+        # Child archives depend on how their members are written as much as on the files
+        settings = repr((self.codec.name, self.codec.level, sorted(self.store_extensions), self.manifest_hash))
+        for item in children:
+            self.scans[item] = self.__scan(item)
+            fingerprints[item] = ArchiveCache.fingerprint(self.scans[item][0], settings)
+        # Largest directories go first so the pool does not end on a long tail
+        children.sort(key=lambda item: fingerprints[item][1], reverse=True)
+        queue = Queue.Queue()
+        for source_count, item in enumerate(children, 1):
+            queue.put((source_count, item, fingerprints[item][0]))
+
+        self.log_events('info', 'Archiving ' + str(len(children)) + ' dirs with ' + str(self.workers) + ' workers')
+        pool = []
+        for i in range(min(self.workers, len(children))):
+            worker = threading.Thread(target=self.__compress_worker, args=(queue,))
+            worker.daemon = True
+            worker.start()
+            pool.append(worker)
+
+        for worker in pool:
+            worker.join()
+
+        if self.cache is not None:
+            self.cache.save()
+        if self.errors:
+            raise Exception('Archiving of ' + ', '.join(sorted(item for item, e in self.errors)) +
+                            ' failed, aborting: ' + str(self.errors[0][1]))
+
+    def __compress_worker(self, queue):
+        """Archive child directories from the queue until it is empty"""
+        while True:
+            try:
+                source_count, item, fingerprint = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            archive = self.temp_dir_path + '/' + item + '.zip'
+            record = self.checkpoint.children.get(item) if self.resumed else None
+            if record is not None and record['fingerprint'] == fingerprint and os.path.isfile(archive):
+                self.__scanned(item)
+                with self.lock:
+                    self.archived.append(item)
+                self.log_events('info', 'Resuming with archive of dir #' + str(source_count) + ': ' + item)
+                self.output('Resuming with archive of dir #' + str(source_count) + ': ' + item)
+                continue
+            if self.cache is not None and self.cache.get(item, fingerprint, archive):
+                self.__scanned(item)
+                with self.lock:
+                    self.archived.append(item)
+                if self.checkpoint is not None:
+                    self.checkpoint.add_child({'child': item, 'fingerprint': fingerprint})
+                self.log_events('info', 'Reusing cached archive for dir #' + str(source_count) + ': ' + item)
+                self.output('Reusing cached archive for dir #' + str(source_count) + ': ' + item)
+                continue
 
-        for item in os.walk('.').next()[1]:
-            source_count += 1
             self.log_events('info', 'Archiving dir #' + str(source_count) + ': ' + item)
-            print('Archiving dir #' + str(source_count) + ': ' + item + '...')
-            pd = subprocess.Popen(
-                [
-                    '/usr/bin/zip',
-                    '-r',
-                    self.temp_dir_path + '/' + item,
-                    item
-                ], stdout=pipe, stderr=pipe
-            )
-            stdout, stderr = pd.communicate()
-            print stdout
+            self.output('Archiving dir #' + str(source_count) + ': ' + item + '...')
+            try:
+                with self.metrics.span('compress', child=item) as span:
+                    with open(archive, 'wb') as fp:
+                        writer = self.__writer(self.__output(fp))
+                        complete = self.__archive_child(writer, item, self.__scanned(item))[0]
+                        writer.close()
+                    span.add(sum(m['file_size'] for m in writer.members), writer.offset)
+            except Exception as e:
+                # A truncated archive must never be packed into the snapshot
+                if os.path.isfile(archive):
+                    os.remove(archive)
+                with self.lock:
+                    self.failed.append(item)
+                    self.errors.append((item, e))
+                self.log_events('error', 'Archiving dir #' + str(source_count) + ': ' + item + ' failed: ' + str(e))
+                continue
+
+            if not complete:
+                with self.lock:
+                    self.failed.append(item)
+                self.log_events('error', 'Archiving dir #' + str(source_count) + ': ' + item + ' was incomplete')
+            else:
+                with self.lock:
+                    self.archived.append(item)
+                if self.cache is not None:
+                    self.cache.put(item, fingerprint, archive)
+                if self.checkpoint is not None:
+                    self.checkpoint.add_child({'child': item, 'fingerprint': fingerprint})
+                self.log_events('info', 'Archived dir #' + str(source_count) + ': ' + item)
+
+    def __stream_snapshot(self):
+        """Walk the source once and stream all children into the master archive"""
+        self.master_file = self.source_root + '/' + self.source_name + '-' + self.time + '-' + self.kind + '.zip'
+        self.log_events('info', 'Streaming source to ' + self.kind + ' archive')
+        print "Streaming source to " + self.kind + " archive..."
+        self.children = self.scanner.children()
+
+        records = self.__resumed_children()
+        if self.pipeline:
+            fp = self.__start_pipeline()
+        elif records:
+            fp = self.__output(open(self.master_file, 'r+b'))
+        else:
+            fp = self.__output(open(self.master_file, 'wb'))
+        hashing = Verify.HashingWriter(fp, self.__uploader().part_size)
+        try:
+            with self.metrics.span('master') as span:
+                writer = self.__writer(hashing)
+                if records:
+                    self.__resume_archive(fp, hashing, writer, records)
+                self.__stream_children(writer, fp)
+                writer.close()
+                span.add(sum(m['file_size'] for m in writer.members), writer.offset)
+        except BaseException:
+            if self.pipeline:
+                fp.abort()
+            else:
+                fp.close()
+            raise
+        fp.close()
+        self.hashes = hashing.result()
+        self.__write_index(Archive.index_entries(writer.members))
+
+        print "Master archive created successfully!"
+        self.log_events('info', 'Master archive created successfully!')
+        if self.pipeline:
+            self.__verify_local([dest + '/' + os.path.basename(self.master_file)
+                                 for dest in self.destinations['local']], self.hashes['sha256'])
+            self.__verify_s3(self.buckets, os.path.basename(self.master_file), self.hashes, self.etags)
+            self.__record_s3(self.catalogs.keys(), os.path.basename(self.master_file), writer.offset)
+            for dest in self.destinations['local'] + self.destinations['s3']:
+                print "Transfer to " + dest + " completed successfully!"
+                self.log_events('info', 'Transfer to ' + dest + ' completed successfully!')
+
+    def __volume_snapshot(self):
+        """Walk the source once and pack its files into size-bounded volumes compressed in parallel"""
+        name = self.source_name + '-' + self.time + '-' + self.kind
+        self.log_events('info', 'Packing source into ' + self.kind + ' volumes of ' + size(self.volume_size) +
+                        ' with ' + str(self.workers) + ' workers')
+        print "Packing source into " + self.kind + " volumes..."
+        self.children = self.scanner.children()
+        done, failed, volumes = self.__resumed_volumes(name)
+
+        def archived(path, st, member):
+            with self.lock:
+                self.manifest.add(path, st, member['hash'])
+
+        def unreadable(path, e):
+            self.log_events('error', 'Unable to archive ' + path + ': ' + str(e))
+            with self.lock:
+                self.__keep_previous(path)
+
+        def finished(record):
+            self.log_events('info', 'Packed volume #' + str(record['number']) + ' of ' + str(len(record['paths'])) +
+                            ' members, ' + str(record['hashes']['size']) + ' bytes')
+            self.output('Packed volume #' + str(record['number']))
+            if self.checkpoint is not None:
+                with self.lock:
+                    manifest = dict((p.encode('string_escape'), self.manifest.entries[p])
+                                    for p in record['paths'] if p in self.manifest.entries)
+                self.checkpoint.add_child({
+                    'child': os.path.basename(record['path']),
+                    'number': record['number'],
+                    'hashes': record['hashes'],
+                    'paths': [p.encode('string_escape') for p in record['paths']],
+                    'failed': [p.encode('string_escape') for p in record['failed']],
+                    'manifest': manifest,
+                })
+
+        writer = VolumeWriter(self.source_root, name, self.volume_size, self.workers, self.__writer,
+                              self.__uploader().part_size,
+                              {'time': self.time, 'kind': self.kind, 'base': self.manifest.base},
+                              max([number for number, path, hashes in volumes] or [0]) + 1,
+                              archived, unreadable, finished, self.limiter, self.source)
+        added = 0
+        with self.metrics.span('master') as span:
+            for source_count, item in enumerate(self.children, 1):
+                self.log_events('info', 'Packing dir #' + str(source_count) + ': ' + item)
+                entries, errors = self.__scan(item)
+                for path, error in errors:
+                    self.log_events('error', 'Unable to archive ' + path + ': ' + error)
+                    failed.append(path)
+                    with self.lock:
+                        self.__keep_previous(path, True)
+                for path, st in entries:
+                    if path in done:
+                        continue
+                    if stat.S_ISDIR(st.st_mode):
+                        if self.kind == 'master':
+                            writer.add(path, st)
+                        continue
+                    if self.kind == 'incr' and not self.previous.changed(path, st):
+                        with self.lock:
+                            self.manifest.add(path, st, self.previous.digest(path))
+                        continue
+                    writer.add(path, st)
+                    added += st.st_size
+            for record in writer.close():
+                volumes.append((record['number'], record['path'], record['hashes']))
+                failed.extend(record['failed'])
+            span.add(added, sum(hashes['size'] for number, path, hashes in volumes))
+
+        self.volumes = [(path, hashes) for number, path, hashes in sorted(volumes)]
+        failed_children = set(path.split('/')[0] for path in failed)
+        self.failed = [item for item in self.children if item in failed_children]
+        self.archived = [item for item in self.children if item not in failed_children]
+        if self.kind == 'incr':
+            self.deleted = self.__deleted()
+            self.log_events('info', 'Incremental snapshot with ' + str(len(self.deleted)) + ' deleted files')
+
+        # The top-level index only lists the volumes, each has an index of its own
+        self.index_file = self.source_root + '/' + name + '.zip' + Archive.INDEX_SUFFIX
+        Archive.write_index(self.index_file, [], archive=name + '.zip', time=self.time, kind=self.kind,
+                            base=self.manifest.base, deleted=self.deleted, volumes=[{
+                                'archive': os.path.basename(path),
+                                'index': os.path.basename(path) + Archive.INDEX_SUFFIX,
+                                'size': hashes['size'],
+                                'sha256': hashes['sha256'],
+                                'etag': hashes['etag'],
+                            } for path, hashes in self.volumes])
+        self.log_events('info', 'Wrote index of ' + str(len(self.volumes)) + ' volumes to ' + self.index_file)
+        print str(len(self.volumes)) + " volumes created successfully!"
+
+    def __resumed_volumes(self, name):
+        """
+        Find the volumes the resumed run finished
+
+        Returns a tuple of the set of paths archived in them, the list of
+        paths that could not be archived and the list of (number, path,
+        hashes) of the volumes. Volumes the run did not finish are removed.
+        """
+        done = set()
+        failed = []
+        volumes = []
+        if not self.resumed:
+            return done, failed, volumes
+        for record in self.checkpoint.children.values():
+            path = self.source_root + '/' + record['child']
+            if os.path.isfile(path) and os.path.getsize(path) == record['hashes']['size'] and \
+                    os.path.isfile(path + Archive.INDEX_SUFFIX):
+                done.update(p.encode('utf-8').decode('string_escape') for p in record['paths'])
+                failed.extend(p.encode('utf-8').decode('string_escape') for p in record['failed'])
+                volumes.append((record['number'], path, record['hashes']))
+                self.__restore_manifest(record)
+        kept = set(path for number, path, hashes in volumes)
+        for path in glob.glob(self.source_root + '/' + name + '.[0-9]*.zip*'):
+            if path not in kept and path[:-len(Archive.INDEX_SUFFIX)] not in kept:
+                os.remove(path)
+        self.log_events('info', 'Resuming with ' + str(len(volumes)) + ' volumes of the unfinished run')
+        return done, failed, volumes
+
+    def __resumed_children(self):
+        """Return the journal records of the children the resumed run streamed, by archive offset"""
+        if not self.resumed or not self.checkpoint.children:
+            return []
+        records = sorted(self.checkpoint.children.values(), key=lambda record: record['offset'])
+        if not os.path.isfile(self.master_file) or os.path.getsize(self.master_file) < records[-1]['offset']:
+            self.log_events('warning', 'Master archive of the unfinished run is missing or short, starting over')
+            self.checkpoint.start(**self.checkpoint.run)
+            return []
+        return records
+
+    def __resume_archive(self, fp, hashing, writer, records):
+        """Cut the archive of the resumed run after its last journaled child and continue writing from there"""
+        offset = records[-1]['offset']
+        fp.truncate(offset)
+        fp.seek(0)
+        while fp.tell() < offset:
+            hashing.update(fp.read(min(1048576, offset - fp.tell())))
+        fp.seek(offset)
+        writer.offset = offset
+        for record in records:
+            writer.members.extend(dict(m, name=m['name'].encode('utf-8').decode('string_escape'))
+                                  for m in record['members'])
+            self.__restore_manifest(record)
+            (self.archived if record['complete'] else self.failed).append(record['child'])
+        self.log_events('info', 'Resuming master archive at ' + str(offset) + ' bytes after ' + str(len(records)) +
+                        ' dirs')
+
+    def __stream_children(self, writer, fp):
+        """Write all (changed) files of all children with the archive writer"""
+        changed = 0
+        for source_count, item in enumerate(self.children, 1):
+            if self.resumed and item in self.checkpoint.children:
+                continue
+            self.log_events('info', 'Archiving dir #' + str(source_count) + ': ' + item)
+            print 'Archiving dir #' + str(source_count) + ': ' + item + '...'
+            scan = self.__scan(item)
+            with self.metrics.span('compress', child=item) as span:
+                first, offset = len(writer.members), writer.offset
+                complete, child_changed = self.__archive_child(writer, item, scan)
+                span.add(sum(m['file_size'] for m in writer.members[first:]), writer.offset - offset)
+            changed += child_changed
+            if complete:
+                self.archived.append(item)
+            else:
+                self.failed.append(item)
+            if self.checkpoint is not None:
+                # Everything up to the offset in the journal has to be on disk
+                fp.flush()
+                os.fsync(fp.fileno())
+                members = [dict(m, name=Archive.escape_name(m['name'])) for m in writer.members[first:]]
+                self.checkpoint.add_child({'child': item, 'complete': complete, 'offset': writer.offset,
+                                           'members': members, 'manifest': self.__child_manifest(scan)})
+
+        if self.kind == 'incr':
+            self.deleted = deleted = self.__deleted()
+            # Stored as it is, so its name never gets a codec suffix
+            writer.add_bytes(self.TOMBSTONES, ''.join(p.encode('string_escape') + '\n' for p in deleted),
+                             codec=writer.store)
+            self.log_events('info', 'Incremental snapshot of ' + str(changed) + ' changed and ' +
+                            str(len(deleted)) + ' deleted files')
+            print str(changed) + " changed and " + str(len(deleted)) + " deleted files"
+
+    def __archive_child(self, writer, item, scan):
+        """
+        Write all (changed) files of a child directory with the archive writer
+
+        Takes the scan of the child, see Scanner.scan. Returns a tuple
+        of a flag telling whether all files were archived and the
+        number of files written.
+        """
+        entries, errors = scan
+        complete = not errors
+        changed = 0
+        for path, error in errors:
+            self.log_events('error', 'Unable to archive ' + path + ': ' + error)
+            with self.lock:
+                self.__keep_previous(path, True)
+        for path, st in entries:
+            if stat.S_ISDIR(st.st_mode):
+                if self.kind == 'master':
+                    writer.add_directory(os.path.join(self.source, path), path, st)
+                continue
+            try:
+                if self.kind == 'incr' and not self.previous.changed(path, st):
+                    with self.lock:
+                        self.manifest.add(path, st, self.previous.digest(path))
+                    continue
+                member = writer.add_file(os.path.join(self.source, path), path, st)
+                with self.lock:
+                    self.manifest.add(path, st, member['hash'])
+                changed += 1
+            except (IOError, OSError) as e:
+                complete = False
+                self.log_events('error', 'Unable to archive ' + path + ': ' + str(e))
+                with self.lock:
+                    self.__keep_previous(path)
+        return complete, changed
+
+    def __deleted(self):
+        """
+        List the files of the previous run that are gone, followed by the directories gone with them
+
+        Directories are not part of manifests, the parents of deleted
+        files that no longer exist are listed with a trailing slash
+        like their members, so restores do not bring them back empty.
+        """
+        deleted = self.previous.deleted(self.manifest)
+        parents = set()
+        for path in deleted:
+            parts = path.split('/')
+            parents.update('/'.join(parts[:i]) for i in range(1, len(parts)))
+        return deleted + [d + '/' for d in sorted(parents) if not os.path.isdir(os.path.join(self.source, d))]
+
+    def __keep_previous(self, path, below=False):
+        """Keep a path that could not be read, and with below the files below it, out of the tombstones"""
+        if self.previous is None:
+            return
+        # The size of -1 makes the next run retry them
+        if path in self.previous.entries:
+            self.manifest.entries[path] = [-1] + self.previous.entries[path][1:]
+        if below:
+            prefix = path + '/'
+            for name, entry in self.previous.entries.iteritems():
+                if name.startswith(prefix):
+                    self.manifest.entries[name] = [-1] + entry[1:]
+
+    def __use_changes(self, changes):
+        """Scan only changed paths, the previous state of all other files is kept in the manifest"""
+        self.changes = {}
+        for path in changes:
+            self.changes.setdefault(path.split('/')[0], []).append(path)
+        changed = set(changes)
+        for path, entry in self.previous.entries.iteritems():
+            parts = path.split('/')
+            if not any('/'.join(parts[:i]) in changed for i in range(1, len(parts) + 1)):
+                self.manifest.entries[path] = entry
+        self.log_events('info', 'Scanning ' + str(len(changed)) + ' changed paths')
+
+    def __scan(self, item):
+        """Scan a child directory, or return its scan if it was already scanned"""
+        if item in self.scans:
+            return self.scans[item]
+        excluded = self.scanner.excluded
+        with self.metrics.span('walk', child=item):
+            if self.changes is not None:
+                entries, errors = scan = self.scanner.scan_paths(self.changes.get(item, []))
+            else:
+                entries, errors = scan = self.scanner.scan(item)
+        self.log_events('info', 'Scanned ' + item + ': ' + str(len(entries)) + ' entries, ' +
+                        str(self.scanner.excluded - excluded) + ' excluded, ' + str(len(errors)) + ' unreadable')
+        if self.destinations.get('dedup'):
+            # Deduplicating destinations store the same files after archiving
+            self.scans[item] = scan
+        return scan
+
+    def __scanned(self, item):
+        """Return the scan of a child directory, releasing it unless a later phase needs it"""
+        if self.destinations.get('dedup'):
+            return self.scans[item]
+        return self.scans.pop(item)
+
+    def __writer(self, fp, codec=None):
+        """Create an archive writer with the configured codec"""
+        return ArchiveWriter(fp, codec or self.codec, self.manifest_hash, self.store_extensions, self.limiter)
+
+    def __output(self, fp):
+        """Pass writes to an archive through the limiter, if any"""
+        return fp if self.limiter is None else self.limiter.writer(fp)
+
+    def __start_pipeline(self):
+        """Start shipping archive parts to all destinations while the archive is written"""
+        name = os.path.basename(self.master_file)
+        pipeline = Pipeline(self.upload_part_size, self.pipeline_depth)
+        for dest in self.__local_destinations():
+            self.log_events('info', 'Streaming master archive to destination ' + dest)
+            pipeline.add_consumer(dest, lambda reader, dest=dest: self.__write_local(reader, dest, name))
+
+        buckets = self.__prepare_s3()
+        if buckets:
+            self.log_events('info', 'Streaming master archive to buckets ' + ', '.join(buckets))
+            pipeline.add_consumer('s3', lambda reader: self.__upload_stream(reader, name, buckets))
+        return pipeline
+
+    def __write_local(self, reader, dest, name):
+        """Write a pipeline stream to dest/name, the file appears only once complete"""
+        path = dest + '/' + name
+        try:
+            with open(path + '.part', 'wb') as fp, self.metrics.span('transfer_local', destination=dest):
+                shutil.copyfileobj(reader, self.__output(fp), 1048576)
+            os.rename(path + '.part', path)
+        except BaseException:
+            if os.path.isfile(path + '.part'):
+                os.remove(path + '.part')
+            raise
 
     def __make_snapshot(self):
-        """Compress all archives to master archive and remove temporary"""
+        """Pack all child archives into the master archive and remove temporary"""
         # source_root is the parent dir of source
         # it acts as a temp dir for the master snapshot
         self.master_file = self.source_root + '/' + self.source_name + '-' + self.time + '-master.zip'
         self.log_events('info', 'Creating master archive')
         print "Creating master archive..."
-        os.chdir(self.temp_dir_path)
-        pipe = subprocess.PIPE
-        pd = subprocess.Popen(
-            [
-                '/usr/bin/zip',
-                '-r',
-                self.source_root + '/' + self.source_name + '-' + self.time + '-master',
-                '.'
-            ], stdout=pipe, stderr=pipe
-        )
-        stdout, stderr = pd.communicate()
-        print stdout
+        # Child archives are already compressed, store them as they are
+        with open(self.master_file, 'wb') as fp, self.metrics.span('master') as span:
+            hashing = Verify.HashingWriter(self.__output(fp), self.__uploader().part_size)
+            writer = self.__writer(hashing, Archive.codec('store'))
+            entries = []
+            for item in sorted(os.listdir(self.temp_dir_path)):
+                member = writer.add_file(self.temp_dir_path + '/' + item, item)
+                # Index the members of the child archive at their place in the master archive
+                entries.extend(Archive.index_entries(Archive.read_members(self.temp_dir_path + '/' + item),
+                                                     member['data_offset']))
+            writer.close()
+            span.add(sum(m['file_size'] for m in writer.members), writer.offset)
+        self.hashes = hashing.result()
+        self.__write_index(entries)
         print "Removing temporary directory..."
         self.log_events('info', 'Removing temporary directory')
         shutil.rmtree(self.temp_dir_path)
         print "Master archive created successfully!"
         self.log_events('info', 'Master archive created successfully!')
 
+    def __write_index(self, entries):
+        """Write the index of the master archive next to it"""
+        self.index_file = self.master_file + Archive.INDEX_SUFFIX
+        Archive.write_index(self.index_file, entries, archive=os.path.basename(self.master_file), time=self.time,
+                            kind=self.kind, base=self.manifest.base, deleted=self.deleted,
+                            sha256=self.hashes['sha256'], size=self.hashes['size'],
+                            part_size=self.hashes['part_size'], etag=self.hashes['etag'])
+        self.log_events('info', 'Wrote index of ' + str(len(entries)) + ' members to ' + self.index_file)
+
     def __verify_source_archives(self):
         """Compare sources to archives"""
         sources = []
         archives = []
 
-        for x in os.walk(self.source).next()[1]:
+        for x in self.children:
             sources.append(x)
-            if os.path.isfile(self.temp_dir_path + '/' + x + '.zip'):
+            if x in self.archived and (self.engine != 'zip' or self.__child_archive_complete(x)):
                 archives.append(x)
 
         if len(archives) != len(sources):
@@ -195,12 +969,25 @@ class Snapshot:
             self.log_events('warning', 'Source to archive count mismatch, some directories are missing.')
             missing = self.diff(sources, archives)
             self.log_events('warning', 'The following archives are missing: ' + str(missing))
+            if self.failed:
+                self.log_events('warning', 'The following archives failed: ' + str(sorted(self.failed)))
         else:
             print "All sources archived successfully!"
             self.log_events('info', 'All sources archived successfully!')
 
-    def __transfer_snapshot_local(self):
-        """Transfer master archive to local backup destinations"""
+    def __child_archive_complete(self, item):
+        """Check that the archive of a child directory exists and is neither truncated nor corrupt"""
+        try:
+            Verify.check_archive(self.temp_dir_path + '/' + item + '.zip')
+            return True
+        except (IOError, OSError) as e:
+            self.log_events('error', 'Archive of ' + item + ' is not usable, leaving it out: ' + str(e))
+            if os.path.isfile(self.temp_dir_path + '/' + item + '.zip'):
+                os.remove(self.temp_dir_path + '/' + item + '.zip')
+            return False
+
+    def __local_destinations(self):
+        """Create missing local destinations and return them"""
         for dest in self.destinations['local']:
             if not os.path.exists(dest):
                 try:
@@ -208,70 +995,304 @@ class Snapshot:
                 except OSError as exception:
                     if exception.errno != errno.EEXIST:
                         raise
-            print "Transferring master archive to destination " + dest + "..."
-            self.log_events('info', 'Transferring master archive to destination ' + dest)
-            if self.master_file is not None:
-                shutil.copy2(self.master_file, dest)
+        return self.destinations['local']
+
+    def __transfer_snapshot_local(self):
+        """Transfer the master archive or the volumes to local backup destinations"""
+        dests = self.__local_destinations()
+        for dest in dests:
+            print "Transferring snapshot to destination " + dest + "..."
+            self.log_events('info', 'Transferring snapshot to destination ' + dest)
 
-            if not os.path.isfile(dest + '/' + self.source_name + '-' + self.time + '-master.zip'):
-                self.log_events('info', 'Error transferring master archive to destination ' + dest)
-                raise Exception('Error transferring master archive to destination ' + dest)
+        for path, hashes in self.__archives():
+            name = os.path.basename(path)
+            self.__transfer_archive_local(path, hashes, [dest for dest in dests
+                                                         if not self.__transferred(dest + '/' + name)])
 
+        for dest in dests:
             print "Transfer to "+dest+" completed successfully!"
             self.log_events('info', 'Transfer to '+dest+' completed successfully!')
 
+    def __transfer_archive_local(self, path, hashes, dests):
+        """Transfer a single archive to local backup destinations"""
+        name = os.path.basename(path)
+        # Incremental archives hold different files every run, only full ones are worth a delta
+        if self.local_delta and self.kind == 'master':
+            for dest in dests:
+                started = time.time()
+                basis = self.__delta_basis(dest, name, hashes['size'])
+                written, reused = LocalCopy.delta_copy(path, dest + '/' + name, basis, self.delta_block_size,
+                                                       self.local_fsync, self.limiter)
+                self.log_events('info', 'Wrote ' + str(written) + ' bytes and reused ' + str(reused) +
+                                ' bytes of ' + str(basis) + ' at destination ' + dest)
+                self.__log_throughput(dest, written + reused, time.time() - started, 'transfer_local')
+            self.__verify_local([dest + '/' + name for dest in dests], hashes['sha256'])
+        else:
+            results = LocalCopy.fanout_copy(path, [dest + '/' + name for dest in dests],
+                                            self.local_fsync, self.local_verify, hashes['sha256'], self.limiter)
+            for dest in dests:
+                seconds, copied, error = results[dest + '/' + name]
+                if error is not None:
+                    self.log_events('error', 'Error transferring ' + name + ' to destination ' + dest +
+                                    ': ' + str(error))
+                    self.metrics.record('transfer_local', seconds, error=str(error), destination=dest)
+                else:
+                    self.__log_throughput(dest, copied, seconds, 'transfer_local')
+
+        for dest in dests:
+            if not os.path.isfile(dest + '/' + name):
+                self.log_events('info', 'Error transferring ' + name + ' to destination ' + dest)
+                raise Exception('Error transferring ' + name + ' to destination ' + dest)
+            if self.checkpoint is not None:
+                self.checkpoint.finish(dest + '/' + name)
+
+    def __verify_local(self, paths, sha256):
+        """Re-hash copies of an archive at local destinations in parallel, if enabled"""
+        if not self.local_verify or not paths:
+            return
+        for path, digest in sorted(Verify.rehash(paths, self.workers, self.limiter).items()):
+            if digest != sha256:
+                self.log_events('error', 'Verification of ' + path + ' failed: ' + str(digest))
+                raise Exception('Verification of ' + path + ' failed, it differs from the archive')
+            self.log_events('info', 'Verified ' + path)
+
+    def __verify_s3(self, buckets, name, hashes, etags):
+        """Compare the part ETags and the ETag of an uploaded archive with its hashes"""
+        if not buckets:
+            return
+        c = boto.connect_s3()
+        for bucket in buckets:
+            parts = etags.get(bucket, {})
+            bad = [n for n, digest in enumerate(hashes['parts'], 1)
+                   if parts.get(n) is not None and parts[n].strip('"') != digest]
+            key = c.get_bucket(bucket, validate=False).get_key(name)
+            if bad or key is None or key.size != hashes['size'] or \
+                    key.etag.strip('"') != hashes['etag']:
+                self.log_events('error', 'Verification of ' + name + ' in bucket ' + bucket + ' failed, parts ' +
+                                str(bad) + ', object ' + (key.etag if key is not None else 'missing'))
+                raise Exception('Verification of ' + name + ' in bucket ' + bucket + ' failed')
+            self.log_events('info', 'Verified ' + name + ' in bucket ' + bucket)
+
+    def __log_throughput(self, dest, copied, seconds, phase):
+        """Log the transfer rate to a destination and record the transfer as a phase"""
+        self.metrics.record(phase, seconds, copied, copied, destination=dest)
+        rate = copied / max(seconds, 0.001)
+        self.log_events('info', 'Transferred ' + size(copied) + ' to destination ' + dest + ' in ' +
+                        '%.2fs' % seconds + ' (' + size(int(rate)) + '/s)')
+
+    def __delta_basis(self, dest, archive, size):
+        """
+        Find the same archive (kind and volume) of the newest earlier snapshot with a block signature at dest
+
+        A basis less than half or more than twice the size of the archive
+        has too little in common with it to be worth the rolling checksum.
+        """
+        suffix = archive[len(self.source_name + '-' + self.time):]
+        candidates = []
+        for name in os.listdir(dest):
+            if name.startswith(self.source_name + '-') and name.endswith(suffix) and \
+                    os.path.isfile(dest + '/' + name + LocalCopy.SIGNATURE_SUFFIX):
+                mtime = name[len(self.source_name) + 1:-len(suffix)]
+                if mtime.isdigit() and mtime < self.time:
+                    candidates.append((mtime, name))
+        if not candidates:
+            return None
+        basis = dest + '/' + max(candidates)[1]
+        return basis if size / 2 <= os.path.getsize(basis) <= size * 2 else None
+
     def __transfer_snapshot_s3(self):
-        """Transfer master archive to remote backup destinations"""
+        """Transfer the master archive or the volumes to remote backup destinations"""
+        buckets = self.__prepare_s3()
+        if not buckets:
+            return
+
+        self.log_events('info', 'Initiating remote upload')
+        print "Initiating remote upload..."
+        uploader = self.__uploader()
+        for path, hashes in self.__archives():
+            name = os.path.basename(path)
+            pending = [bucket for bucket in buckets if not self.__transferred('s3://' + bucket + '/' + name)]
+            etags = {}
+            if pending:
+                self.log_events('info', 'Uploading ' + name + ' (' + size(hashes['size']) + ') to buckets ' +
+                                ', '.join(pending))
+                print 'Uploading ' + name + ' (' + size(hashes['size']) + ') to buckets ' + ', '.join(pending)
+                on_part = None
+                if self.checkpoint is not None:
+                    on_part = lambda bucket, upload_id, part_num, etag, name=name: self.checkpoint.add_part(
+                        bucket, name, upload_id, uploader.part_size, part_num, etag)
+                started = time.time()
+                etags = uploader.upload(path, name, pending, self.__resumable_uploads(uploader, pending, name, hashes),
+                                        on_part)
+                for bucket in pending:
+                    self.__log_throughput('s3://' + bucket, hashes['size'], time.time() - started, 'transfer_s3')
+            self.__verify_s3(buckets, name, hashes, etags)
+            self.__record_s3(buckets, name, hashes['size'])
+            if self.checkpoint is not None:
+                for bucket in buckets:
+                    self.checkpoint.finish('s3://' + bucket + '/' + name)
+
+        for bucket in buckets:
+            print 'Transfer to bucket '+bucket+' completed successfully!'
+            self.log_events('info', 'Transfer to bucket '+bucket+' completed successfully!')
+
+    def __resumable_uploads(self, uploader, buckets, name, hashes):
+        """
+        Find the multipart uploads of an archive by the resumed run that can be continued
+
+        Returns a dict of bucket -> (upload id, {part number: etag}) of
+        the parts in S3 matching the part hashes of the archive, other
+        parts are uploaded again.
+        """
+        resume = {}
+        if not self.resumed:
+            return resume
+        for bucket in buckets:
+            upload = self.checkpoint.uploads.get(bucket + '/' + name)
+            if upload is None or upload['part_size'] != uploader.part_size:
+                continue
+            parts = uploader.uploaded_parts(bucket, name, upload['id'])
+            if parts is None:
+                self.log_events('warning', 'Upload of ' + name + ' to bucket ' + bucket + ' is gone, starting it over')
+                continue
+            resume[bucket] = (upload['id'], dict(
+                (n, etag) for n, (etag, part_size) in parts.items()
+                if n <= len(hashes['parts']) and etag.strip('"') == hashes['parts'][n - 1]))
+        return resume
+
+    def __abort_stale_uploads(self, b):
+        """
+        Cancel unfinished multipart uploads that will never be completed
+
+        Uploads of snapshots of this source are stale unless they belong
+        to the resumed run, uploads of other keys once they are older
+        than upload_expiry. Parts of unfinished uploads are billed until
+        the upload is cancelled.
+        """
+        resumed = set()
+        if self.resumed:
+            resumed = set(upload['id'] for key, upload in self.checkpoint.uploads.items()
+                          if key.startswith(b.name + '/'))
+        prefix = self.source_name + '-'
+        for mp in b.get_all_multipart_uploads():
+            if mp.id in resumed:
+                continue
+            own = mp.key_name.startswith(prefix) and Retention.KEY_PATTERN.match(mp.key_name[len(prefix):])
+            age = (datetime.datetime.utcnow() - parse_ts(mp.initiated)).total_seconds()
+            if not own and age < self.upload_expiry:
+                continue
+            try:
+                mp.cancel_upload()
+                self.log_events('info', 'Cancelled stale upload of ' + mp.key_name + ' to bucket ' + b.name)
+            except S3ResponseError, e:
+                self.log_events('error', 'Unable to cancel stale upload of ' + mp.key_name + ' to bucket ' +
+                                b.name + ': ' + str(e))
+
+    def __prepare_s3(self):
+        """Find or create configured buckets, purge them and return the usable ones"""
+        if not self.destinations['s3']:
+            return []
+
         c = boto.connect_s3()
+        buckets = []
         for bucket in self.destinations['s3']:
             try:
                 b = c.get_bucket(bucket)
-                self.__purge_s3(bucket)
                 self.log_events('info', 'Found bucket ' + bucket)
                 sys.stdout.write('Found bucket ' + bucket + ', ')
-                total_bytes = 0
-                for key in b:
-                    total_bytes += key.size
-                sys.stdout.write('currently there is ' + size(total_bytes) + ' in it.\n')
+                catalog = self.__catalog(bucket, b)
+                with self.metrics.span('purge', destination='s3://' + bucket):
+                    self.__purge_s3(b, catalog)
+                sys.stdout.write('currently there is ' + size(catalog.size()) + ' of ' + self.source_name +
+                                 ' snapshots in it.\n')
             except S3ResponseError, e:
-                if e.status == 404:
-                    self.log_events('error', 'Bucket ' + bucket + ' not found, creating now')
-                    print 'Bucket ' + bucket + ' not found, creating now...'
-                    try:
-                        b = c.create_bucket(bucket)
-                    except S3CreateError, e:
-                        self.log_events('fatal', "Failed creating bucket with name " + bucket + ", aborting.")
-                        self.log_events('fatal', e.message)
-                        print "Failed creating bucket with name " + bucket + ", aborting."
-
-            if b.get_all_multipart_uploads():
-                print "This bucket contains lost files, you should remove them."
-
-            self.log_events('info', 'Initiating remote upload')
-            print "Initiating remote upload..."
-            source_size = os.stat(self.master_file).st_size
-            mp = b.initiate_multipart_upload(os.path.basename(self.master_file))
-            chunk_size = 52428800
-            chunk_count = int(math.ceil(source_size / chunk_size))
-
-            self.log_events('info', 'Uploading '+size(source_size)+' to bucket ' + bucket)
-            print 'Uploading '+size(source_size)+' to bucket ' + bucket
-
-            for i in range(chunk_count + 1):
-                offset = chunk_size * i
-                bytes = min(chunk_size, source_size - offset)
-                with FileChunkIO(self.master_file, 'r', offset=offset, bytes=bytes) as fp:
-                    mp.upload_part_from_file(fp, part_num=i + 1)
-
-            mp.complete_upload()
-            print 'Transfer to bucket '+bucket+' completed successfully!'
-            self.log_events('info', 'Transfer to bucket '+bucket+' completed successfully!')
+                if e.status != 404:
+                    raise
+                self.log_events('error', 'Bucket ' + bucket + ' not found, creating now')
+                print 'Bucket ' + bucket + ' not found, creating now...'
+                try:
+                    b = c.create_bucket(bucket)
+                    self.__catalog(bucket)
+                except S3CreateError, e:
+                    self.log_events('fatal', "Failed creating bucket with name " + bucket + ", aborting.")
+                    self.log_events('fatal', e.message)
+                    print "Failed creating bucket with name " + bucket + ", aborting."
+                    continue
+
+            self.__abort_stale_uploads(b)
+            buckets.append(bucket)
+        self.buckets = buckets
+        return buckets
+
+    def __transfer_index_s3(self):
+        """Upload the indexes of the snapshot next to its archives in all buckets"""
+        if not self.buckets:
+            return
+        c = boto.connect_s3()
+        # The top-level index goes last, a snapshot is not listed before all its volumes are in place
+        for index in self.__index_files():
+            name = os.path.basename(index)
+            for bucket in self.buckets:
+                if self.throttle is not None:
+                    self.throttle.consume(os.path.getsize(index))
+                c.get_bucket(bucket, validate=False).new_key(name).set_contents_from_filename(index)
+                self.log_events('info', 'Uploaded index ' + name + ' to bucket ' + bucket)
+            self.__record_s3(self.buckets, name, os.path.getsize(index))
+
+    def __upload_stream(self, reader, name, buckets):
+        """Upload the master archive from a pipeline reader"""
+        with self.metrics.span('transfer_s3', destination=','.join('s3://' + b for b in buckets)):
+            self.etags = self.__uploader().upload_stream(reader, name, buckets)
+
+    def __uploader(self):
+        """Create an S3 uploader with the configured settings"""
+        return MultipartUploader(
+            part_size=self.upload_part_size,
+            concurrency=self.upload_concurrency,
+            max_buffers=self.upload_buffers,
+            retries=self.upload_retries,
+            throttle=self.throttle,
+            log=self.log_events,
+            limiter=self.limiter
+        )
+
+    def __transfer_snapshot_dedup(self):
+        """Store the source in deduplicating chunk stores"""
+        for location in self.destinations.get('dedup', []):
+            if self.__transferred('dedup:' + location):
+                continue
+            print "Storing source in chunk store " + location + "..."
+            self.log_events('info', 'Storing source in chunk store ' + location)
+            dedup = Deduplicator(ChunkStore.open_store(location, self.throttle), self.source_name + '-',
+                                 self.chunk_size, self.upload_concurrency, self.log_events, self.workers)
+            with self.metrics.span('transfer_dedup', destination=location) as span:
+                dedup.start()
+                for item in self.children or self.scanner.children():
+                    entries, errors = self.__scan(item)
+                    for path, error in errors:
+                        self.log_events('error', 'Unable to store ' + path + ': ' + error)
+                    for path, st in entries:
+                        if not stat.S_ISDIR(st.st_mode):
+                            dedup.add_file(os.path.join(self.source, path), st, path)
+                index = dedup.finish(self.time)
+                span.add(dedup.total_bytes, dedup.stored_bytes)
+
+            print ("Stored " + size(dedup.stored_bytes) + " in " + str(dedup.stored) + " new chunks out of " +
+                   size(dedup.total_bytes) + " in " + location)
+            self.log_events('info', 'Stored ' + str(dedup.stored_bytes) + ' bytes in ' + str(dedup.stored) +
+                            ' new chunks out of ' + str(dedup.total_bytes) + ' bytes, ' + str(dedup.reused) +
+                            ' unchanged files kept their chunks, index ' + index)
+            if self.checkpoint is not None:
+                self.checkpoint.finish('dedup:' + location)
 
     def log_events(self, level, message):
         """Log all events to instance log file"""
-        log_file = open(self.source_root + '/'+self.source_name+'-'+self.time+'.log', 'a')
-        log_file.write('['+level+'] ' + str(int(time.time())) + ' ' + message + '\n')
-        log_file.close()
+        self.metrics.event(level, message)
+
+    def output(self, message):
+        """Print a message without interleaving output of concurrent workers"""
+        with self.lock:
+            print message
 
     @staticmethod
     def diff(a, b):
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import time
+import ctypes
+import platform
+import threading
+import ctypes.util
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASSES = {'best-effort': 2, 'idle': 3}
+# Number of the ioprio_set syscall, which has no libc wrapper
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+# Page cache is dropped behind readers and writers in windows of this size
+DROP_SIZE = 8388608
+# Size of a single I/O request counted against an IOPS cap
+OP_SIZE = 131072
+LOAD_INTERVAL = 1.0
+MAX_BACKOFF = 30.0
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+except OSError:
+    _libc = None
+
+_fadvise = getattr(_libc, 'posix_fadvise', None)
+if _fadvise is not None:
+    _fadvise.restype = ctypes.c_int
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+
+_sync_file_range = getattr(_libc, 'sync_file_range', None)
+if _sync_file_range is not None:
+    _sync_file_range.restype = ctypes.c_int
+    _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_uint]
+
+
+def drop_cache(fd, offset=0, length=0, advice=POSIX_FADV_DONTNEED):
+    """Advise the kernel about a range of a file, by default that its pages will not be needed again"""
+    if _fadvise is None:
+        return False
+    return _fadvise(fd, offset, length, advice) == 0
+
+
+def write_back(fd, offset, length, wait=False):
+    """Start writing back a range of a file, wait also waits for it so its pages can be dropped"""
+    if _sync_file_range is None:
+        return False
+    flags = SYNC_FILE_RANGE_WRITE
+    if wait:
+        flags |= SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WAIT_AFTER
+    return _sync_file_range(fd, offset, length, flags) == 0
+
+
+def lower_priority(nice=None, ionice=None, level=7):
+    """
+    Lower the CPU and I/O priority of the process
+
+    Threads inherit the priorities of the thread that starts them, so
+    this is called before any workers are started.
+
+        nice        niceness added to the current one
+        ionice      I/O scheduling class, 'best-effort' or 'idle'
+        level       priority within the best-effort class, 0 (highest) to 7
+
+    Returns a list of the priorities that could not be set.
+    """
+    failed = []
+    if nice:
+        try:
+            os.nice(int(nice))
+        except OSError:
+            failed.append('nice')
+    if ionice:
+        number = IOPRIO_SET.get(platform.machine())
+        value = IOPRIO_CLASSES[ionice] << 13 | (int(level) if ionice == 'best-effort' else 0)
+        if _libc is None or number is None or _libc.syscall(number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+            failed.append('ionice')
+    return failed
+
+
+class TokenBucket:
+    """
+    TokenBucket class
+
+    Limits the rate at which bytes are sent, shared by all threads and
+    snapshots it is handed to. Tokens accumulate at rate per second up
+    to burst; taking more tokens than are available puts the bucket in
+    debt and the caller sleeps until the debt is paid off, so amounts
+    larger than burst are throttled correctly too.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Constructor
+
+        Attributes:
+            rate        sustained rate in bytes per second
+            burst       maximum number of tokens saved up, one second of rate by default
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Take amount tokens, sleeping as long as the rate requires"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class IOLimiter:
+    """
+    IOLimiter class
+
+    Keeps backups from getting in the way of a live server. Reads and
+    writes of archived files and archives are capped in bytes and I/O
+    requests per second, shared by all threads and snapshots it is
+    handed to, and paused while the load average is above max_load.
+    With drop_cache the pages of files read or written are dropped
+    from the page cache behind them, so a backup does not evict the
+    pages the server is using.
+    """
+
+    def __init__(self, read_rate=None, write_rate=None, iops=None, max_load=None, drop_cache=False):
+        """
+        Constructor
+
+        Attributes:
+            read_rate   read rate cap in bytes per second, if any
+            write_rate  write rate cap in bytes per second, if any
+            iops        cap of I/O requests per second, if any; every OP_SIZE bytes count as a request
+            max_load    1 minute load average above which I/O is paused, if any
+            drop_cache  drop pages of files behind readers and writers
+            paused      seconds spent waiting for the load to go down
+        """
+        self.reads = TokenBucket(read_rate) if read_rate else None
+        self.writes = TokenBucket(write_rate) if write_rate else None
+        self.ops = TokenBucket(iops) if iops else None
+        self.max_load = float(max_load) if max_load else None
+        self.drop_cache = drop_cache
+        self.paused = 0.0
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def read(self, amount):
+        """Account for amount bytes read, sleeping as long as the caps and the load require"""
+        self.backoff()
+        if self.reads is not None:
+            self.reads.consume(amount)
+        if self.ops is not None:
+            self.ops.consume(max(amount // OP_SIZE, 1))
+
+    def write(self, amount):
+        """Account for amount bytes written, see read"""
+        self.backoff()
+        if self.writes is not None:
+            self.writes.consume(amount)
+        if self.ops is not None:
+            self.ops.consume(max(amount // OP_SIZE, 1))
+
+    def backoff(self):
+        """Sleep while the load average is above max_load, waiting longer every time it is still too high"""
+        if self.max_load is None or time.time() - self.checked < LOAD_INTERVAL:
+            return
+        # One thread waits for the load at a time, the others queue up behind it
+        with self.lock:
+            delay = LOAD_INTERVAL
+            while os.getloadavg()[0] > self.max_load:
+                time.sleep(delay)
+                self.paused += delay
+                delay = min(delay * 2, MAX_BACKOFF)
+            self.checked = time.time()
+
+    def written(self, fd, end, length, previous=None):
+        """
+        Start the write-back of the length bytes of a file before end
+
+        The previous window, returned by the call before, is waited for
+        and dropped from the page cache. Returns the new window.
+        """
+        write_back(fd, end - length, length)
+        if previous is not None and write_back(fd, previous[0], previous[1], True):
+            drop_cache(fd, previous[0], previous[1])
+        return end - length, length
+
+    def reader(self, fp):
+        """Wrap a file opened for reading"""
+        return LimitedFile(fp, self)
+
+    def writer(self, fp):
+        """Wrap a file opened for writing"""
+        return LimitedFile(fp, self)
+
+
+class LimitedFile:
+    """
+    LimitedFile class
+
+    File wrapper passing the reads and writes of a file through an
+    IOLimiter. When the limiter drops the page cache, pages behind the
+    reader are dropped every DROP_SIZE bytes and at the end of the
+    file. Written pages are dirty and cannot be dropped right away,
+    every DROP_SIZE bytes their write-back is started and the pages of
+    the window before are waited for and dropped, which also keeps the
+    backup from piling up dirty pages.
+    """
+
+    def __init__(self, fp, limiter):
+        self.fp = fp
+        self.limiter = limiter
+        self.pending = 0
+        self.previous = None
+        if limiter.drop_cache:
+            drop_cache(fp.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.limiter.read(len(data))
+        if self.limiter.drop_cache:
+            self.pending += len(data)
+            if not data or self.pending >= DROP_SIZE:
+                end = self.fp.tell()
+                drop_cache(self.fp.fileno(), end - self.pending, self.pending)
+                self.pending = 0
+        return data
+
+    def write(self, data):
+        self.limiter.write(len(data))
+        self.fp.write(data)
+        if self.limiter.drop_cache:
+            self.pending += len(data)
+            if self.pending >= DROP_SIZE:
+                self.fp.flush()
+                self.previous = self.limiter.written(self.fp.fileno(), self.fp.tell(), self.pending, self.previous)
+                self.pending = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import time
+import boto
+import Queue
+import threading
+from cStringIO import StringIO
+from boto.s3.multipart import MultiPartUpload
+from boto.exception import S3ResponseError
+
+MIN_PART_SIZE = 5242880
+
+
+class MultipartUploader:
+    """
+    MultipartUploader class
+
+    Uploads a file to one or more S3 buckets with concurrent multipart
+    uploads. The file is read once, every part is uploaded to all
+    buckets before its buffer is dropped and at most max_buffers parts
+    are held in memory at any time. Failed parts are retried with
+    exponential backoff.
+
+    Each worker thread uses its own connection from connect(), pass a
+    custom factory to upload to S3 compatible endpoints or stand-ins.
+
+    Uploads of a run that died can be continued: parts already in the
+    multipart upload are read past and not uploaded again.
+    """
+
+    def __init__(self, connect=None, part_size=52428800, concurrency=4, max_buffers=None,
+                 retries=5, backoff=1.0, throttle=None, log=None, limiter=None):
+        """
+        Constructor
+
+        Attributes:
+            connect         callable returning a new S3 connection
+            part_size       size of a single part in bytes
+            concurrency     number of parts uploaded at the same time
+            max_buffers     maximum number of parts held in memory
+            retries         number of retries of a failed part
+            backoff         delay before the first retry in seconds
+            throttle        token bucket limiting the upload rate, if any
+            log             callable(level, message) receiving events
+            limiter         IOLimiter uploaded files are read through, if any
+        """
+        self.connect = connect or boto.connect_s3
+        self.part_size = max(int(part_size), MIN_PART_SIZE)
+        self.concurrency = max(int(concurrency), 1)
+        self.max_buffers = max(int(max_buffers or self.concurrency * 2), 1)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.throttle = throttle
+        self.log = log or (lambda level, message: None)
+        self.limiter = limiter
+        self.etags = {}
+        self.local = threading.local()
+        self.pending_lock = threading.Lock()
+
+    def upload(self, path, key_name, buckets, resume=None, on_part=None):
+        """
+        Upload a file to key_name in all buckets
+
+            path        local file to upload
+            key_name    name of the key in the buckets
+            buckets     list of bucket names
+            resume      bucket name -> (upload id, {part number: etag}) of uploads to continue
+            on_part     callable(bucket, upload id, part number, etag) called after every part;
+                        uploads are not cancelled on failure when it is given, so they can be resumed
+
+        Returns a dict of bucket name -> {part number: etag}.
+        """
+        with open(path, 'rb') as fp:
+            if self.limiter is not None:
+                fp = self.limiter.reader(fp)
+            return self.upload_stream(fp, key_name, buckets, resume, on_part)
+
+    def upload_stream(self, fp, key_name, buckets, resume=None, on_part=None):
+        """Upload the contents of a readable stream to key_name in all buckets, see upload"""
+        conn = self.connect()
+        uploads = {}
+        resume = resume or {}
+        self.etags = dict((bucket, {}) for bucket in buckets)
+        for bucket in buckets:
+            if bucket in resume:
+                upload_id, parts = resume[bucket]
+                uploads[bucket] = mp = MultiPartUpload(conn.get_bucket(bucket, validate=False))
+                mp.key_name = key_name
+                mp.id = upload_id
+                self.etags[bucket].update(parts)
+                self.log('info', 'Resuming upload of ' + key_name + ' to bucket ' + bucket + ' with ' +
+                         str(len(parts)) + ' parts already uploaded')
+            else:
+                uploads[bucket] = conn.get_bucket(bucket).initiate_multipart_upload(key_name)
+
+        tasks = Queue.Queue()
+        slots = threading.BoundedSemaphore(self.max_buffers)
+        errors = []
+        pool = []
+        for i in range(min(self.concurrency, self.max_buffers * len(buckets)) or 1):
+            worker = threading.Thread(target=self.__worker, args=(tasks, slots, uploads, errors, on_part))
+            worker.daemon = True
+            worker.start()
+            pool.append(worker)
+
+        part_num = 0
+        try:
+            for part_num, data in self.parts(fp, self.part_size, slots, errors):
+                missing = [bucket for bucket in buckets if part_num not in self.etags[bucket]]
+                if not missing:
+                    slots.release()
+                    continue
+                pending = [len(missing)]
+                for bucket in missing:
+                    tasks.put((part_num, data, bucket, pending))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for worker in pool:
+                tasks.put(None)
+            for worker in pool:
+                worker.join()
+
+        if errors and on_part is not None:
+            self.log('error', 'Upload of ' + key_name + ' failed, keeping the uploaded parts to resume it')
+            raise errors[0]
+        if errors:
+            for bucket, mp in uploads.items():
+                self.log('error', 'Cancelling upload of ' + key_name + ' to bucket ' + bucket)
+                try:
+                    mp.cancel_upload()
+                except Exception as e:
+                    self.log('error', 'Unable to cancel upload to bucket ' + bucket + ': ' + str(e))
+            raise errors[0]
+
+        for bucket, mp in uploads.items():
+            mp.complete_upload()
+            self.log('info', 'Uploaded ' + str(part_num) + ' parts of ' + key_name + ' to bucket ' + bucket)
+        return self.etags
+
+    def __worker(self, tasks, slots, uploads, errors, on_part):
+        """Upload parts from the task queue until a None task is received"""
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            part_num, data, bucket, pending = task
+            try:
+                if not errors:
+                    etag = self.__upload_part(uploads[bucket], bucket, part_num, data)
+                    self.etags[bucket][part_num] = etag
+                    if on_part is not None:
+                        on_part(bucket, uploads[bucket].id, part_num, etag)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                with self.pending_lock:
+                    pending[0] -= 1
+                    done = pending[0] == 0
+                if done:
+                    slots.release()
+
+    def __upload_part(self, upload, bucket, part_num, data):
+        """Upload a single part, retrying with exponential backoff"""
+        attempt = 0
+        while True:
+            try:
+                if self.throttle is not None:
+                    self.throttle.consume(len(data))
+                mp = self.__thread_upload(upload, bucket)
+                key = mp.upload_part_from_file(StringIO(data), part_num=part_num, size=len(data))
+                return key.etag if key is not None else None
+            except Exception as e:
+                if attempt >= self.retries:
+                    self.log('error', 'Part ' + str(part_num) + ' to bucket ' + bucket + ' failed: ' + str(e))
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                self.log('warning', 'Part ' + str(part_num) + ' to bucket ' + bucket + ' failed, retrying in ' +
+                         str(delay) + 's: ' + str(e))
+                time.sleep(delay)
+                attempt += 1
+                self.local.conn = None
+
+    def __thread_upload(self, upload, bucket):
+        """Return a handle of the multipart upload bound to this thread's connection"""
+        if getattr(self.local, 'conn', None) is None:
+            self.local.conn = self.connect()
+            self.local.uploads = {}
+        mp = self.local.uploads.get(bucket)
+        if mp is None:
+            mp = MultiPartUpload(self.local.conn.get_bucket(bucket, validate=False))
+            mp.key_name = upload.key_name
+            mp.id = upload.id
+            self.local.uploads[bucket] = mp
+        return mp
+
+    def uploaded_parts(self, bucket, key_name, upload_id):
+        """
+        List the parts of an unfinished multipart upload
+
+        Returns a dict of part number -> (etag, size), or None if the
+        upload does not exist anymore.
+        """
+        mp = MultiPartUpload(self.connect().get_bucket(bucket, validate=False))
+        mp.key_name = key_name
+        mp.id = upload_id
+        try:
+            return dict((part.part_number, (part.etag, part.size)) for part in mp)
+        except S3ResponseError as e:
+            if e.status != 404:
+                raise
+            return None
+
+    @staticmethod
+    def parts(fp, part_size, slots, errors):
+        """
+        Read a stream in parts of part_size bytes
+
+        A slot is taken for every part before it is read, so no more
+        parts than there are slots are ever buffered. An empty stream
+        still yields one empty part as S3 requires at least one.
+        """
+        part_num = 0
+        while not errors:
+            slots.acquire()
+            data = ''
+            while len(data) < part_size:
+                chunk = fp.read(part_size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            if not data and part_num > 0:
+                slots.release()
+                return
+            part_num += 1
+            yield part_num, data
+            if len(data) < part_size:
+                return
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import Queue
+import hashlib
+import zipfile
+import binascii
+import threading
+import Archive
+import Restore
+import LocalCopy
+from ChunkStore import Deduplicator
+
+
+class HashingWriter:
+    """
+    HashingWriter class
+
+    Write-only file object passing everything to another file object
+    while hashing it, so the archive is hashed as it is produced and
+    never read back for it. Besides the sha256 of the whole archive it
+    keeps the md5 of every part_size part, which gives the ETag S3
+    assigns to a multipart upload in parts of that size.
+    """
+
+    def __init__(self, fp, part_size):
+        self.fp = fp
+        self.part_size = part_size
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.parts = []
+        self.part = hashlib.md5()
+        self.part_fill = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.update(data)
+
+    def update(self, data):
+        """Hash data without writing it, for data already in the output"""
+        self.sha.update(data)
+        self.size += len(data)
+        while data:
+            take = data[:self.part_size - self.part_fill]
+            self.part.update(take)
+            self.part_fill += len(take)
+            data = data[len(take):]
+            if self.part_fill == self.part_size:
+                self.parts.append(self.part.hexdigest())
+                self.part = hashlib.md5()
+                self.part_fill = 0
+
+    def result(self):
+        """Return the sha256, size, part size and multipart ETag of everything written"""
+        parts = self.parts
+        if self.part_fill or not parts:
+            parts = parts + [self.part.hexdigest()]
+        return {
+            'sha256': self.sha.hexdigest(),
+            'size': self.size,
+            'part_size': self.part_size,
+            'etag': multipart_etag(parts),
+            'parts': parts,
+        }
+
+
+def multipart_etag(parts):
+    """ETag of a multipart upload from the hex md5 digests of its parts"""
+    return hashlib.md5(''.join(binascii.unhexlify(p) for p in parts)).hexdigest() + '-' + str(len(parts))
+
+
+def check_archive(path):
+    """Check that a zip archive is complete, raises IOError if it is truncated or corrupt"""
+    size = os.path.getsize(path)
+    try:
+        members = Archive.read_members(path)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+        raise IOError('Archive ' + path + ' is corrupt: ' + str(e))
+    for m in members:
+        if m['data_offset'] + m['csize'] > size:
+            raise IOError('Archive ' + path + ' is truncated at member ' + m['name'])
+    return members
+
+
+def rehash(paths, workers=4, limiter=None):
+    """
+    Compute the sha256 of several files in a thread pool, returns a dict of path -> digest or exception
+
+    With a limiter the files are read through it, see LocalCopy.file_hash.
+    """
+    tasks = Queue.Queue()
+    for path in paths:
+        tasks.put(path)
+    results = {}
+
+    def work():
+        while True:
+            try:
+                path = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[path] = LocalCopy.file_hash(path, limiter)
+            except (IOError, OSError) as e:
+                results[path] = e
+
+    pool = [threading.Thread(target=work) for i in range(max(min(int(workers), len(paths)), 1))]
+    for worker in pool:
+        worker.daemon = True
+        worker.start()
+    for worker in pool:
+        worker.join()
+    return results
+
+
+class Verifier:
+    """
+    Verifier class
+
+    Re-checks snapshots at a destination against the hashes recorded
+    in their indexes without restoring them: archives at local
+    destinations are re-hashed through memory maps, archives in S3 are
+    compared by size and ETag with a HEAD request. A deep check also
+    reads every member, decompresses it and compares its crc; streams
+    of wrapped codecs are decompressed and checked as well.
+    """
+
+    def __init__(self, location, source_name, workers=4, deep=False, log=None):
+        """
+        Constructor
+
+        Attributes:
+            location    LocalLocation or S3Location holding the snapshots
+            source_name name of the source directory
+            workers     number of snapshots checked at the same time
+            deep        decompress all members and check their crc
+            log         callable(level, message) receiving events
+        """
+        self.restore = Restore.Restore(location, source_name, 1, log)
+        self.location = location
+        self.workers = max(int(workers), 1)
+        self.deep = deep
+        self.log = log or (lambda level, message: None)
+
+    def verify(self, snapshot_time=None):
+        """
+        Check snapshots, all of them or the chain of one snapshot
+
+        Returns a list of (archive name, problem) tuples, empty if all is well.
+        """
+        if snapshot_time is not None:
+            names = self.restore.chain(snapshot_time)
+        else:
+            names = [name for t, (kind, name) in sorted(self.restore.snapshots().items(), key=lambda s: int(s[0]))]
+        tasks = Queue.Queue()
+        for name in names:
+            tasks.put(name)
+        problems = []
+        pool = [threading.Thread(target=self.__worker, args=(tasks, problems)) for i in range(self.workers)]
+        for worker in pool:
+            worker.daemon = True
+            worker.start()
+        for worker in pool:
+            worker.join()
+        self.location.close()
+        return sorted(problems)
+
+    def __worker(self, tasks, problems):
+        while True:
+            try:
+                name = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                index = Archive.read_index(self.location.read(name))
+                problem = self.check(index)
+            except Exception as e:
+                index = {'archive': name}
+                problem = str(e)
+            if problem is None:
+                self.log('info', 'Verified ' + index['archive'])
+            else:
+                self.log('error', 'Verification of ' + index['archive'] + ' failed: ' + problem)
+                problems.append((index['archive'], problem))
+
+    def check(self, index):
+        """Check a single snapshot against its index, returns a problem description or None"""
+        for volume in index.get('volumes', []):
+            problem = self.check(Archive.read_index(self.location.read(volume['index'])))
+            if problem is not None:
+                return volume['archive'] + ': ' + problem
+        if 'volumes' in index:
+            return None
+        archive = index['archive']
+        if 'sha256' in index:
+            problem = self.location.check(archive, index)
+            if problem is not None:
+                return problem
+        elif not self.deep:
+            return 'no archive hashes recorded, use a deep check'
+        if self.deep:
+            for entry in index['members']:
+                try:
+                    for data in self.restore.member_data(archive, entry):
+                        pass
+                except IOError as e:
+                    return str(e)
+        return None
+
+
+class DedupVerifier:
+    """
+    DedupVerifier class
+
+    Re-checks snapshots at a deduplicating destination: every chunk
+    their indexes reference has to be in the store, a deep check also
+    reads every chunk and compares its sha256. Chunks shared by
+    several snapshots are checked only once.
+    """
+
+    def __init__(self, store, source_name, workers=4, deep=False, log=None):
+        """
+        Constructor
+
+        Attributes:
+            store       LocalChunkStore or S3ChunkStore holding the snapshots
+            source_name name of the source directory
+            workers     number of chunks checked at the same time
+            deep        read all chunks and check their sha256
+            log         callable(level, message) receiving events
+        """
+        self.restore = Restore.DedupRestore(store, source_name, 1, log)
+        self.store = store
+        self.workers = max(int(workers), 1)
+        self.deep = deep
+        self.log = log or (lambda level, message: None)
+
+    def verify(self, snapshot_time=None):
+        """
+        Check snapshots, all of them or the one at snapshot_time
+
+        Returns a list of (index name, problem) tuples, empty if all is well.
+        """
+        if snapshot_time is not None:
+            names = self.restore.chain(snapshot_time)
+        else:
+            names = [name for t, (kind, name) in sorted(self.restore.snapshots().items(), key=lambda s: int(s[0]))]
+        indexes = {}
+        problems = []
+        digests = set()
+        for name in names:
+            try:
+                indexes[name] = Deduplicator.load_index(self.store, name)
+            except Exception as e:
+                self.log('error', 'Verification of ' + name + ' failed: ' + str(e))
+                problems.append((name, 'index cannot be read: ' + str(e)))
+                continue
+            for entry in indexes[name]['files']:
+                digests.update(entry['chunks'])
+        tasks = Queue.Queue()
+        for digest in digests:
+            tasks.put(digest)
+        results = {}
+        pool = [threading.Thread(target=self.__worker, args=(tasks, results)) for i in range(self.workers)]
+        for worker in pool:
+            worker.daemon = True
+            worker.start()
+        for worker in pool:
+            worker.join()
+
+        for name in sorted(indexes):
+            problem = None
+            for entry in indexes[name]['files']:
+                for digest in entry['chunks']:
+                    if results.get(digest) is not None:
+                        problem = 'chunk ' + digest + ' of ' + entry['path'] + ' ' + results[digest]
+                        break
+                if problem is not None:
+                    break
+            if problem is None:
+                self.log('info', 'Verified ' + name)
+            else:
+                self.log('error', 'Verification of ' + name + ' failed: ' + problem)
+                problems.append((name, problem))
+        return sorted(problems)
+
+    def __worker(self, tasks, results):
+        """Check queued chunks, results maps every checked digest to a problem or None"""
+        while True:
+            try:
+                digest = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if not self.deep:
+                    results[digest] = None if self.store.has(digest) else 'is missing'
+                elif hashlib.sha256(self.store.get(digest)).hexdigest() != digest:
+                    results[digest] = 'is corrupt'
+                else:
+                    results[digest] = None
+            except Exception as e:
+                results[digest] = 'cannot be read: ' + str(e)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import stat
+import Queue
+import threading
+import Archive
+import Verify
+
+
+def volume_name(name, number):
+    """Name of a volume of the snapshot archive name, <source>-<time>-<kind>.<number>.zip"""
+    return '%s.%04d.zip' % (name, number)
+
+
+class VolumeWriter:
+    """
+    VolumeWriter class
+
+    Packs files into archives of about volume_size bytes each, so a
+    snapshot is not a single huge object. Files are added in walk
+    order and a volume is cut as soon as the next file would make it
+    larger than volume_size, a larger file gets a volume of its own.
+    Full volumes are compressed by a pool of threads while the next
+    ones are filled; at most two volumes per thread are queued, so the
+    file lists held in memory stay bounded. Every volume is hashed
+    while it is written and gets its own index.
+    """
+
+    def __init__(self, directory, name, volume_size, workers, make_writer, part_size, info=None, first=1,
+                 on_file=None, on_error=None, on_volume=None, limiter=None, root=''):
+        """
+        Constructor
+
+        Attributes:
+            directory   directory volumes are written to
+            name        snapshot name, <source>-<time>-<kind>
+            volume_size target size of a volume in bytes (uncompressed)
+            workers     number of volumes compressed at the same time
+            make_writer callable(fp) returning the ArchiveWriter of a volume
+            part_size   S3 part size the volume hashes are computed for
+            info        fields written to every volume index (time, kind, base)
+            first       number of the first volume
+            on_file     callable(path, stat result, member) called for every archived file
+            on_error    callable(path, exception) called for every file that could not be archived
+            on_volume   callable(record) called for every finished volume, see close
+            limiter     IOLimiter volumes are written through, if any
+            root        directory the added paths are relative to, they are archived by those paths
+        """
+        self.directory = directory
+        self.name = name
+        self.volume_size = max(int(volume_size), 1)
+        self.workers = max(int(workers), 1)
+        self.make_writer = make_writer
+        self.part_size = part_size
+        self.info = info or {}
+        self.number = first
+        self.on_file = on_file or (lambda path, st, member: None)
+        self.on_error = on_error or (lambda path, e: None)
+        self.on_volume = on_volume or (lambda record: None)
+        self.limiter = limiter
+        self.root = root
+        self.entries = []
+        self.filled = 0
+        self.volumes = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(self.workers * 2)
+        self.pool = []
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.__worker)
+            worker.daemon = True
+            worker.start()
+            self.pool.append(worker)
+
+    def add(self, path, st):
+        """Add a file or directory to the volume being filled, by its path and stat result"""
+        if self.errors:
+            raise self.errors[0]
+        size = 0 if stat.S_ISDIR(st.st_mode) else st.st_size
+        if self.entries and self.filled + size > self.volume_size:
+            self.__cut()
+        self.entries.append((path, st))
+        self.filled += size
+
+    def close(self):
+        """
+        Compress the last volume and wait for all of them
+
+        Returns the records of all volumes ordered by number, dicts of
+        number, path of the archive, its hashes (see HashingWriter), the
+        paths of its members and the paths that could not be archived.
+        """
+        if self.entries:
+            self.__cut()
+        for worker in self.pool:
+            self.queue.put(None)
+        for worker in self.pool:
+            worker.join()
+        if self.errors:
+            raise self.errors[0]
+        return sorted(self.volumes, key=lambda record: record['number'])
+
+    def __cut(self):
+        """Queue the volume being filled for compression and start the next one"""
+        self.queue.put((self.number, self.entries))
+        self.number += 1
+        self.entries = []
+        self.filled = 0
+
+    def __worker(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            if self.errors:
+                continue
+            try:
+                record = self.__write(*task)
+                with self.lock:
+                    self.volumes.append(record)
+                self.on_volume(record)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+
+    def __write(self, number, entries):
+        """Write a volume and its index, a volume that could not be finished is removed"""
+        path = self.directory + '/' + volume_name(self.name, number)
+        try:
+            return self.__write_volume(path, number, entries)
+        except Exception:
+            for leftover in (path, path + Archive.INDEX_SUFFIX):
+                if os.path.isfile(leftover):
+                    os.remove(leftover)
+            raise
+
+    def __write_volume(self, path, number, entries):
+        """Write the volume at path and its index"""
+        paths = []
+        failed = []
+        with open(path, 'wb') as fp:
+            hashing = Verify.HashingWriter(fp if self.limiter is None else self.limiter.writer(fp), self.part_size)
+            writer = self.make_writer(hashing)
+            for entry_path, st in entries:
+                try:
+                    source = os.path.join(self.root, entry_path)
+                    if stat.S_ISDIR(st.st_mode):
+                        writer.add_directory(source, entry_path, st)
+                    else:
+                        self.on_file(entry_path, st, writer.add_file(source, entry_path, st))
+                    paths.append(entry_path)
+                except (IOError, OSError) as e:
+                    failed.append(entry_path)
+                    self.on_error(entry_path, e)
+            writer.close()
+        hashes = hashing.result()
+        Archive.write_index(path + Archive.INDEX_SUFFIX, Archive.index_entries(writer.members),
+                            archive=os.path.basename(path), volume=number, sha256=hashes['sha256'],
+                            size=hashes['size'], part_size=hashes['part_size'], etag=hashes['etag'], **self.info)
+        return {'number': number, 'path': path, 'hashes': hashes, 'paths': paths, 'failed': failed}
@@ -30,12 +30,69 @@ Author: Vladimir Strackovski <vlado@nv3.org>
 import os
 import sys
 import json
-from Snapshot import Snapshot
+import signal
+import argparse
+import Restore
+import Verify
+import ChunkStore
+import Daemon
+import Throttle
+import multiprocessing
+from Metrics import Profiler
+from Scheduler import Scheduler
 
 __author__ = 'vstrackovski'
 
 cfgFile = os.path.dirname(os.path.realpath(__file__)) + '/backup.json'
 
+parser = argparse.ArgumentParser(description='Create snapshots of all sources configured in backup.json, '
+                                             'restore files from them or verify them.')
+parser.add_argument('command', nargs='?', default='backup', choices=['backup', 'restore', 'verify', 'daemon'],
+                    help='backup all sources (default), restore files of one source, verify snapshots or '
+                         'keep backing up changes continuously')
+parser.add_argument('--config', default=cfgFile, help='configuration file (default: backup.json next to this script)')
+parser.add_argument('--cpu-jobs', type=int, default=1, help='sources archived at the same time (default: 1)')
+parser.add_argument('--disk-jobs', type=int, default=1, help='sources copied to local destinations at the same time (default: 1)')
+parser.add_argument('--net-jobs', type=int, default=2, help='sources uploaded at the same time (default: 2)')
+parser.add_argument('--jobs', type=int, help='sources in progress at the same time (default: sum of the above)')
+parser.add_argument('--bandwidth', type=float, help='upload bandwidth cap in MB/s shared by all sources')
+gentle = parser.add_argument_group('gentle mode', 'keep backups from slowing down a live server')
+gentle.add_argument('--gentle', action='store_true', help='drop backup data from the page cache, lower the CPU and I/O '
+                                                          'priority and pause while the load average is high')
+gentle.add_argument('--read-rate', type=float, help='disk read cap in MB/s shared by all sources')
+gentle.add_argument('--write-rate', type=float, help='disk write cap in MB/s shared by all sources')
+gentle.add_argument('--iops', type=int, help='cap of disk requests per second shared by all sources')
+gentle.add_argument('--max-load', type=float, help='pause disk I/O while the 1 minute load average is above this '
+                                                   '(default with --gentle: number of CPUs)')
+gentle.add_argument('--nice', type=int, default=10, help='niceness added with --gentle (default: 10)')
+gentle.add_argument('--ionice', choices=['best-effort', 'idle'], default='best-effort',
+                    help='I/O scheduling class with --gentle, best-effort at the lowest priority (default) or idle')
+daemon = parser.add_argument_group('daemon')
+daemon.add_argument('--interval', type=float, default=15, help='minutes after the last snapshot of a source its '
+                                                               'changes are backed up (default: 15)')
+daemon.add_argument('--batch-size', type=float, default=64, help='MB of changed files backed up right away '
+                                                                 '(default: 64)')
+daemon.add_argument('--max-changes', type=int, default=100000, help='changed paths recorded per source before '
+                                                                    'it is scanned whole again (default: 100000)')
+daemon.add_argument('--full-days', type=float, default=7, help='days of snapshots taken every interval between '
+                                                                'full snapshots (default: 7)')
+parser.add_argument('--profile', help='profile the run with cProfile and write the stats to this file')
+restore = parser.add_argument_group('restore and verify')
+restore.add_argument('--source', help='source to restore or verify, its path or name '
+                                      '(default: the only configured source, all sources for verify)')
+restore.add_argument('--location', help='local destination path or s3://bucket to restore from or verify '
+                                        '(default: the first configured destination, all of them for verify)')
+restore.add_argument('--time', help='use the newest snapshot taken at or before this time '
+                                    '(default: newest for restore, all snapshots for verify)')
+restore.add_argument('--target', help='directory files are restored to')
+restore.add_argument('--path', action='append', help='file, child directory or glob to restore, may be repeated '
+                                                      '(default: everything)')
+restore.add_argument('--workers', type=int, default=8, help='files restored or archives verified at the same time '
+                                                             '(default: 8)')
+restore.add_argument('--deep', action='store_true', help='verify also decompresses every file and checks its crc')
+args = parser.parse_args()
+cfgFile = args.config
+
 if not os.path.isfile(cfgFile):
     message = "Configuration is expected to be stored in " + cfgFile + ", but no such file was found!\n"
     message += "Please run the setup tool (setup.py) to configure your backup instance."
@@ -44,7 +101,99 @@ if not os.path.isfile(cfgFile):
 with open(cfgFile) as data_file:
     configs = json.load(data_file)
 
+
+def source_config(configs, source):
+    """Find the configuration of a source by its path or name"""
+    for config in configs:
+        name = os.path.basename(os.path.normpath(config['source']))
+        if (source is None and len(configs) == 1) or source in (config['source'], name):
+            return config
+    sys.exit('ERROR: Source ' + str(source) + ' is not configured, use --source to pick one')
+
+
+if args.command == 'restore':
+    if not args.target:
+        sys.exit('ERROR: Restore needs a --target directory')
+    config = source_config(configs, args.source)
+    destinations = config['destinations']
+    location = args.location
+    if location is None:
+        location = (destinations['local'] or ['s3://' + b for b in destinations['s3']] or
+                    destinations.get('dedup') or [None])[0]
+    if location is None:
+        sys.exit('ERROR: Source ' + config['source'] + ' has no destinations to restore from')
+    print "Restoring " + config['source'] + " from " + location + " to " + args.target + "..."
+    name = os.path.basename(os.path.normpath(config['source']))
+    if location in destinations.get('dedup', []):
+        restorer = Restore.DedupRestore(ChunkStore.open_store(location), name, args.workers)
+    else:
+        restorer = Restore.Restore(Restore.open_location(location), name, args.workers)
+    count = restorer.restore(args.target, args.path, args.time)
+    print "Restored " + str(count) + " files successfully!"
+    sys.exit(0)
+
+if args.command == 'verify':
+    failed = []
+    for config in configs if args.source is None else [source_config(configs, args.source)]:
+        name = os.path.basename(os.path.normpath(config['source']))
+        destinations = config['destinations']
+        for location in [args.location] if args.location else \
+                destinations['local'] + ['s3://' + b for b in destinations['s3']] + destinations.get('dedup', []):
+            print "Verifying snapshots of " + config['source'] + " at " + location + "..."
+            if location in destinations.get('dedup', []):
+                verifier = Verify.DedupVerifier(ChunkStore.open_store(location), name, args.workers, args.deep)
+            else:
+                verifier = Verify.Verifier(Restore.open_location(location), name, args.workers, args.deep)
+            problems = verifier.verify(args.time)
+            for archive, problem in problems:
+                print "FAILED: " + location + "/" + archive + ": " + problem
+                failed.append(archive)
+    if failed:
+        sys.exit('ERROR: Verification of ' + str(len(failed)) + ' snapshots failed')
+    print "All snapshots verified successfully!"
+    sys.exit(0)
+
+limiter = None
+if args.gentle or args.read_rate or args.write_rate or args.iops or args.max_load:
+    max_load = args.max_load or (multiprocessing.cpu_count() if args.gentle else None)
+    limiter = Throttle.IOLimiter(args.read_rate * 1048576 if args.read_rate else None,
+                                 args.write_rate * 1048576 if args.write_rate else None,
+                                 args.iops, max_load, args.gentle)
+if args.gentle:
+    # Before the scheduler starts any threads, they inherit the priorities
+    for name in Throttle.lower_priority(args.nice, args.ionice):
+        print "WARNING: Unable to set " + name + ", running at the current priority"
+
+
+def make_scheduler():
+    return Scheduler(args.cpu_jobs, args.disk_jobs, args.net_jobs, args.jobs,
+                     args.bandwidth * 1048576 if args.bandwidth else None, limiter)
+
+
+if args.command == 'daemon':
+    if not Daemon.available():
+        sys.exit('ERROR: The daemon needs inotify, which is not available on this system')
+    try:
+        daemon = Daemon.Daemon(configs, make_scheduler, args.interval * 60, args.batch_size * 1048576,
+                               args.max_changes, args.full_days)
+    except Exception as e:
+        sys.exit('ERROR: ' + str(e))
+    print "Watching " + str(len(configs)) + " sources for changes..."
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    daemon.run()
+
+scheduler = make_scheduler()
 for config in configs:
-    snapshot = Snapshot(config['source'], config['destinations'])
-    snapshot.make()
-    snapshot.transfer()
+    scheduler.add(config)
+
+profiler = None
+if args.profile:
+    profiler = Profiler(args.profile)
+    profiler.start()
+failed = scheduler.run()
+if limiter is not None and limiter.paused:
+    print "Paused disk I/O for " + str(int(limiter.paused)) + " seconds while the load average was high"
+if profiler is not None:
+    profiler.stop().sort_stats('cumulative').print_stats(20)
+if failed:
+    sys.exit('ERROR: Snapshots of ' + ', '.join(source for source, error in failed) + ' failed')
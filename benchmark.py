@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+
+"""
+Snapshot benchmark
+~~~~~~~~~~~~~~~~~~
+Author: Vladimir Strackovski <vlado@nv3.org>
+"""
+
+import os
+import sys
+import json
+import time
+import Queue
+import random
+import shutil
+import argparse
+import binascii
+import platform
+import resource
+import tempfile
+import multiprocessing
+
+__author__ = 'vstrackovski'
+
+# Synthetic datasets: number of files, file size in KB, share of compressible data,
+# directory depth and width below the children, number of children
+DATASETS = {
+    'small-files': {'files': 20000, 'size': 4, 'compressible': 0.5, 'depth': 2, 'width': 20, 'children': 8},
+    'huge-files': {'files': 4, 'size': 131072, 'compressible': 0.5, 'depth': 0, 'width': 1, 'children': 2},
+    'compressible': {'files': 400, 'size': 1024, 'compressible': 1.0, 'depth': 1, 'width': 10, 'children': 4},
+    'random': {'files': 400, 'size': 1024, 'compressible': 0.0, 'depth': 1, 'width': 10, 'children': 4},
+    'deep': {'files': 5000, 'size': 8, 'compressible': 0.5, 'depth': 10, 'width': 2, 'children': 4},
+}
+
+# Snapshot options of the benchmarked configurations
+CONFIGS = {
+    'zip': {'engine': 'zip'},
+    'stream': {'engine': 'stream'},
+    'pipeline': {'engine': 'stream', 'pipeline': True, 'upload_part_size': 8},
+    'zstd': {'engine': 'stream', 'codec': 'zstd'},
+    'volume': {'engine': 'volume', 'volume_size': 64},
+}
+
+POOL_SIZE = 16777216
+BLOCK_SIZE = 65536
+# Seconds between samples of the disk space taken by a running configuration
+DISK_INTERVAL = 0.25
+WORDS = ['backup', 'snapshot', 'archive', 'source', 'destination', 'bucket', 'upload', 'manifest', 'child',
+         'directory', 'file', 'chunk', 'index', 'restore', 'verify', 'the', 'of', 'and', 'to', 'in', 'is',
+         '0', '1', '2', '42', '2015', '{', '}', '=', ';', '\n', '    ', '<div>', '</div>', 'null', 'true']
+
+
+class Generator:
+    """
+    Generator class
+
+    Writes reproducible synthetic trees. File contents are slices of a
+    random and a text-like pool generated once from the seed, mixed per
+    64 KB block in the ratio given by compressible; slices start at
+    random offsets, so compressors see no repetition within their
+    windows unless the data is meant to be compressible.
+    """
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        bits = self.random.getrandbits(POOL_SIZE * 8)
+        self.noise = binascii.unhexlify('%0*x' % (POOL_SIZE * 2, bits))
+        text = []
+        length = 0
+        while length < POOL_SIZE:
+            word = self.random.choice(WORDS)
+            text.append(word + ' ')
+            length += len(word) + 1
+        self.text = ''.join(text)[:POOL_SIZE]
+
+    def generate(self, path, files, size, compressible=0.5, depth=1, width=10, children=4):
+        """Write a tree of files of size KB each to path, returns the total size in bytes"""
+        total = 0
+        for n in range(files):
+            child = 'child-%02d' % (n % children)
+            parts = [child]
+            for level in range(depth):
+                parts.append('d%d-%d' % (level, self.random.randrange(width)))
+            directory = os.path.join(path, *parts)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(os.path.join(directory, 'file-%06d.dat' % n), 'wb') as f:
+                left = size * 1024
+                while left > 0:
+                    block = min(left, BLOCK_SIZE)
+                    pool = self.text if self.random.random() < compressible else self.noise
+                    offset = self.random.randrange(POOL_SIZE - block)
+                    f.write(pool[offset:offset + block])
+                    left -= block
+            total += size * 1024
+        return total
+
+
+def disk_usage(path):
+    """Number of bytes used by all files below path, or by path itself if it is a file"""
+    if os.path.isfile(path):
+        return os.lstat(path).st_blocks * 512
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            # Temporary files come and go while a snapshot is running
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def scenario_usage(source, dest):
+    """Bytes used by the temporary files of a snapshot of source (next to it) and by its destination"""
+    parent, name = os.path.split(os.path.normpath(source))
+    temporary = [os.path.join(parent, n) for n in os.listdir(parent) if n.startswith(name + '-')]
+    return sum(disk_usage(path) for path in temporary) + disk_usage(dest)
+
+
+def s3_stand_in():
+    """Start an in-process S3 stand-in (moto), returns None if it is not installed"""
+    try:
+        import moto
+    except ImportError:
+        return None
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    mock = getattr(moto, 'mock_s3_deprecated', None) or moto.mock_s3
+    stand_in = mock()
+    stand_in.start()
+    return stand_in
+
+
+class Phase:
+    """
+    Measures wall time and CPU time of a block of code
+
+    Peak RSS is only known for the whole process (ru_maxrss never goes
+    down), so it is reported once per configuration, see run_scenario.
+    """
+
+    def __init__(self, results, name, size):
+        self.results = results
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+        self.started = time.time()
+        self.cpu = sum(os.times()[:4])
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        seconds = time.time() - self.started
+        self.results[self.name] = {
+            'seconds': round(seconds, 4),
+            'cpu_seconds': round(sum(os.times()[:4]) - self.cpu, 4),
+            'mb_per_second': round(self.size / 1048576.0 / max(seconds, 0.0001), 2),
+        }
+
+
+def run_scenario(workdir, source, size, config_name, s3, queue):
+    """
+    Run make, transfers, restore and verify of one configuration in a child process
+
+    The process only runs this configuration, so its peak RSS is the
+    peak of the configuration.
+    """
+    from Snapshot import Snapshot
+    import Restore
+    import Verify
+    sys.stdout = open(os.devnull, 'w')
+    results = {}
+    try:
+        stand_in = s3_stand_in() if s3 else None
+        dest = os.path.join(workdir, 'dest-' + config_name)
+        options = dict(CONFIGS[config_name], state_dir=os.path.join(workdir, 'state-' + config_name))
+        destinations = {'local': [dest], 's3': ['benchmark-' + config_name] if stand_in else []}
+        snapshot = Snapshot(source, destinations, options)
+        with Phase(results, 'make', size):
+            snapshot.make()
+        if not snapshot.pipeline:
+            with Phase(results, 'transfer_local', size):
+                snapshot.transfer_local()
+            if stand_in is not None:
+                with Phase(results, 'transfer_s3', size):
+                    snapshot.transfer_remote()
+        else:
+            snapshot.transfer_local()
+            snapshot.transfer_remote()
+        if snapshot.volumes:
+            results['archive_bytes'] = sum(hashes['size'] for path, hashes in snapshot.volumes)
+        else:
+            results['archive_bytes'] = snapshot.hashes['size']
+        snapshot.finish()
+        name = os.path.basename(os.path.normpath(source))
+        target = os.path.join(workdir, 'restore-' + config_name)
+        with Phase(results, 'restore', size):
+            Restore.Restore(Restore.LocalLocation(dest), name, 8).restore(target)
+        with Phase(results, 'verify', size):
+            Verify.Verifier(Restore.LocalLocation(dest), name).verify()
+        results['destination_bytes'] = disk_usage(dest)
+        results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if stand_in is not None:
+            stand_in.stop()
+    except Exception as e:
+        results['error'] = repr(e)
+    queue.put(results)
+
+
+def wait_sampling(worker, queue, source, dest):
+    """
+    Wait for the results of a configuration, sampling the disk space it takes meanwhile
+
+    Sampling from the parent process keeps it out of the measured
+    process. Returns the results with the peak number of bytes taken
+    by temporary files and the destination.
+    """
+    peak = 0
+    while True:
+        peak = max(peak, scenario_usage(source, dest))
+        try:
+            results = queue.get(timeout=DISK_INTERVAL)
+            break
+        except Queue.Empty:
+            if not worker.is_alive():
+                results = {'error': 'exited with code ' + str(worker.exitcode)}
+                break
+    results['peak_disk_bytes'] = peak
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print phases slower than the baseline by more than threshold percent, returns their number"""
+    regressions = 0
+    for scenario, phases in sorted(results['results'].items()):
+        for phase, current in sorted(phases.items()):
+            if not isinstance(current, dict):
+                continue
+            before = baseline.get('results', {}).get(scenario, {}).get(phase)
+            # Phases this short are mostly noise
+            if not before or before['seconds'] < 0.05:
+                continue
+            change = (current['seconds'] / before['seconds'] - 1) * 100
+            marker = ''
+            if change > threshold:
+                marker = '  REGRESSION'
+                regressions += 1
+            print '%-28s %-15s %9.3fs %9.3fs %+7.1f%%%s' % (scenario, phase, before['seconds'],
+                                                            current['seconds'], change, marker)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark snapshots of synthetic datasets.')
+    parser.add_argument('--datasets', default=','.join(sorted(DATASETS)), help='comma separated datasets')
+    parser.add_argument('--configs', default='zip,stream,pipeline', help='comma separated configurations')
+    parser.add_argument('--scale', type=float, default=0.1, help='scale of the number of files')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the dataset generator')
+    parser.add_argument('--workdir', help='directory for datasets and destinations (default: a temporary one)')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory')
+    parser.add_argument('--s3', action='store_true', help='also upload to an in-process S3 stand-in (needs moto)')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare results with this JSON file')
+    parser.add_argument('--threshold', type=float, default=10, help='regression threshold in percent')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='dir-copy-benchmark-')
+    generator = Generator(args.seed)
+    results = {
+        'version': 1,
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'seed': args.seed,
+        'results': {},
+    }
+    try:
+        for dataset in args.datasets.split(','):
+            spec = dict(DATASETS[dataset])
+            spec['files'] = max(int(spec['files'] * args.scale), spec['children'])
+            source = os.path.join(workdir, 'data', dataset)
+            size = generator.generate(source, **spec)
+            print "Generated " + dataset + ": " + str(spec['files']) + " files, " + str(size) + " bytes"
+            for config_name in args.configs.split(','):
+                queue = multiprocessing.Queue()
+                worker = multiprocessing.Process(target=run_scenario,
+                                                 args=(workdir, source, size, config_name, args.s3, queue))
+                worker.start()
+                scenario = wait_sampling(worker, queue, source, os.path.join(workdir, 'dest-' + config_name))
+                worker.join()
+                scenario['input_bytes'] = size
+                results['results'][dataset + '/' + config_name] = scenario
+                if 'error' in scenario:
+                    print "  " + config_name + ": FAILED " + scenario['error']
+                else:
+                    print "  " + config_name + ": " + ', '.join(
+                        '%s %.3fs' % (phase, scenario[phase]['seconds'])
+                        for phase in ('make', 'transfer_local', 'transfer_s3', 'restore', 'verify')
+                        if phase in scenario)
+                for name in os.listdir(workdir):
+                    if name.endswith('-' + config_name):
+                        shutil.rmtree(os.path.join(workdir, name))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit('ERROR: Some phases are more than ' + str(args.threshold) + '% slower than the baseline')
+
+
+if __name__ == '__main__':
+    main()
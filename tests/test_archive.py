@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+import Archive
+
+
+class ArchiveWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, members, codec=None):
+        with open(self.path, 'wb') as fp:
+            writer = Archive.ArchiveWriter(fp, codec)
+            for name, data in members:
+                writer.add_bytes(name, data, 1400000000)
+            writer.close()
+        return writer
+
+    def test_round_trip(self):
+        members = [('a/one.txt', 'hello ' * 1000), ('a/empty', ''), ('b/random', os.urandom(70000))]
+        writer = self.write(members)
+        records = Archive.read_members(self.path)
+        self.assertEqual([r['name'] for r in records], [name for name, data in members])
+        for record, member in zip(records, writer.members):
+            self.assertEqual(record['data_offset'], member['data_offset'])
+            self.assertEqual(record['crc'], member['crc'])
+        z = zipfile.ZipFile(self.path)
+        self.assertIsNone(z.testzip())
+        for name, data in members:
+            self.assertEqual(z.read(name), data)
+
+    def test_store_codec(self):
+        self.write([('a.bin', 'x' * 5000)], Archive.codec('store'))
+        self.assertEqual(Archive.read_members(self.path)[0]['csize'], 5000)
+
+    def test_gzip_suffix_only_for_files(self):
+        with open(self.path, 'wb') as fp:
+            writer = Archive.ArchiveWriter(fp, Archive.codec('gzip'))
+            writer.add_bytes('a/file', 'x' * 5000, 1400000000)
+            writer.add_bytes('.internal', 'y' * 5000, 1400000000, writer.store)
+            writer.close()
+        z = zipfile.ZipFile(self.path)
+        self.assertEqual(z.namelist(), ['a/file.gz', '.internal'])
+        self.assertEqual(z.getinfo('.internal').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(z.read('.internal'), 'y' * 5000)
+        # The codec of wrapped members is recorded in the central directory
+        records = Archive.read_members(self.path)
+        self.assertEqual([r['codec'] for r in records], ['gzip', 'store'])
+        entries = Archive.index_entries(records)
+        self.assertEqual([Archive.file_name(e) for e in entries], ['a/file', '.internal'])
+        Archive.write_index(self.path + Archive.INDEX_SUFFIX, entries)
+        with open(self.path + Archive.INDEX_SUFFIX, 'rb') as f:
+            index = Archive.read_index(f.read())
+        self.assertEqual([e['codec'] for e in index['members']], ['gzip', 'store'])
+
+    def test_utf8_name(self):
+        name = u'd/čokolada.txt'.encode('utf-8')
+        writer = self.write([(name, 'data')])
+        self.assertEqual(writer.members[0]['flags'] & 0x800, 0x800)
+        record = Archive.read_members(self.path)[0]
+        self.assertEqual(record['name'], name.decode('utf-8'))
+        self.assertEqual(zipfile.ZipFile(self.path).read(record['name']), 'data')
+
+    def test_latin1_name(self):
+        # Not valid UTF-8, must not be flagged as such or zipfile cannot read it
+        name = u'd/caf\xe9.txt'.encode('latin-1')
+        writer = self.write([(name, 'data')])
+        self.assertEqual(writer.members[0]['flags'] & 0x800, 0)
+        record = Archive.read_members(self.path)[0]
+        self.assertEqual(record['name'], name)
+        self.assertEqual(zipfile.ZipFile(self.path).read(name), 'data')
+
+    def test_index_names(self):
+        names = ['a/plain', u'a/čokolada'.encode('utf-8'), u'a/caf\xe9'.encode('latin-1'), 'a/tab\tnew\nline']
+        writer = self.write([(name, 'data') for name in names])
+        # read_members returns names flagged as UTF-8 as unicode, both kinds must be written
+        entries = Archive.index_entries(Archive.read_members(self.path))
+        Archive.write_index(self.path + Archive.INDEX_SUFFIX, entries, deleted=['b/gone\xff', 'b/'])
+        with open(self.path + Archive.INDEX_SUFFIX, 'rb') as f:
+            index = Archive.read_index(f.read())
+        self.assertEqual([entry['name'] for entry in index['members']], names)
+        self.assertEqual([entry['offset'] for entry in index['members']], [m['data_offset'] for m in writer.members])
+        self.assertEqual(index['deleted'], ['b/gone\xff', 'b/'])
+
+
+if __name__ == '__main__':
+    unittest.main()
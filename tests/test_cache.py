@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import shutil
+import tempfile
+import unittest
+from Cache import ArchiveCache
+from Throttle import IOLimiter
+
+
+class ArchiveCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def archive(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_names_survive_the_index(self):
+        children = ['plain', u'čokolada'.encode('utf-8'), 'caf\xe9']
+        cache = ArchiveCache(os.path.join(self.dir, 'cache'), 1048576)
+        for child in children:
+            cache.put(child, 'fp-' + child.encode('hex'), self.archive(child.encode('hex') + '.zip', child))
+        cache.save()
+
+        cache = ArchiveCache(os.path.join(self.dir, 'cache'), 1048576)
+        for child in children:
+            target = os.path.join(self.dir, child.encode('hex') + '.out')
+            self.assertTrue(cache.get(child, 'fp-' + child.encode('hex'), target))
+            with open(target, 'rb') as f:
+                self.assertEqual(f.read(), child)
+        self.assertFalse(cache.get('plain', 'other', os.path.join(self.dir, 'miss')))
+
+    def test_eviction(self):
+        cache = ArchiveCache(os.path.join(self.dir, 'cache'), 150)
+        cache.put('old', 'fp', self.archive('old.zip', 'x' * 100))
+        cache.index['old']['used'] = 0
+        cache.put('new', 'fp', self.archive('new.zip', 'y' * 100))
+        cache.save()
+        self.assertEqual(sorted(cache.index), ['new'])
+
+    def test_copy_through_limiter(self):
+        limiter = IOLimiter(drop_cache=True)
+        cache = ArchiveCache(os.path.join(self.dir, 'cache'), 1048576, limiter)
+        link = os.link
+
+        def cross_device(source, target):
+            raise OSError(18, 'Invalid cross-device link')
+
+        os.link = cross_device
+        try:
+            cache.put('child', 'fp', self.archive('child.zip', 'z' * 1000))
+            self.assertTrue(cache.get('child', 'fp', os.path.join(self.dir, 'out.zip')))
+        finally:
+            os.link = link
+        with open(os.path.join(self.dir, 'out.zip'), 'rb') as f:
+            self.assertEqual(f.read(), 'z' * 1000)
+
+    def test_fingerprint_covers_settings(self):
+        source = os.path.join(self.dir, 'source')
+        os.makedirs(source)
+        self.archive('source/a', 'a' * 100)
+        entries = [('a', os.lstat(os.path.join(source, 'a')))]
+        deflate = ArchiveCache.fingerprint(entries, repr(('deflate', None)))
+        self.assertEqual(deflate, ArchiveCache.fingerprint(entries, repr(('deflate', None))))
+        self.assertEqual(deflate[1], 100)
+        self.assertNotEqual(deflate[0], ArchiveCache.fingerprint(entries, repr(('deflate', 9)))[0])
+        self.assertNotEqual(deflate[0], ArchiveCache.fingerprint(entries, repr(('store', None)))[0])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import random
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from cStringIO import StringIO
+import ChunkStore
+from ChunkStore import LocalChunkStore, Deduplicator
+
+
+class LocalChunkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = LocalChunkStore(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def leftovers(self):
+        return [name for root, dirs, files in os.walk(self.dir) for name in files if name.endswith('.tmp')]
+
+    def test_concurrent_puts(self):
+        data = 'chunk' * 100000
+        digest = hashlib.sha256(data).hexdigest()
+        errors = []
+
+        def put():
+            try:
+                for i in range(20):
+                    self.store.put(digest, data)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=put) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.store.get(digest), data)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_existing_destination(self):
+        digest = hashlib.sha256('data').hexdigest()
+        self.store.put(digest, 'data')
+        rename = os.rename
+
+        def failing(src, dst):
+            raise OSError(17, 'File exists')
+
+        os.rename = failing
+        try:
+            self.store.put(digest, 'data')
+        finally:
+            os.rename = rename
+        self.assertEqual(self.store.get(digest), 'data')
+        self.assertEqual(self.leftovers(), [])
+
+    def test_index(self):
+        self.store.put_index('src-1-master.gz', 'index')
+        self.assertEqual(self.store.get_index('src-1-master.gz'), 'index')
+        self.assertEqual(self.store.list_indexes('src-'), ['src-1-master.gz'])
+        self.assertEqual(self.leftovers(), [])
+
+
+class DeduplicatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'source')
+        self.store = LocalChunkStore(os.path.join(self.dir, 'store'))
+        self.random = random.Random(3)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def data(self, size):
+        return ''.join(chr(self.random.randint(0, 255)) for i in xrange(size))
+
+    def write(self, name, data):
+        path = os.path.join(self.source, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def snapshot(self, time, chunkers=1):
+        dedup = Deduplicator(self.store, 'src-', 4096, 2, chunkers=chunkers)
+        dedup.start()
+        for root, dirs, files in os.walk(self.source):
+            for name in files:
+                path = os.path.join(root, name)
+                dedup.add_file(path, os.lstat(path), os.path.relpath(path, self.source))
+        return dedup, Deduplicator.load_index(self.store, dedup.finish(time))
+
+    def contents(self, index):
+        result = {}
+        for entry in index['files']:
+            result[entry['path']] = ''.join(Deduplicator.file_data(self.store, entry))
+        return result
+
+    def test_boundaries_match_the_gear_hash(self):
+        data = self.data(100000)
+        # Straightforward 32 bit gear hash the boundaries are defined by
+        expected = []
+        rest = data
+        while rest:
+            h = 0
+            for i in range(1024, min(len(rest), 16384)):
+                h = ((h << 1) + ChunkStore.GEAR[ord(rest[i])]) & 0xFFFFFFFF
+                if not h & 2047:
+                    cut = i + 1
+                    break
+            else:
+                cut = min(len(rest), 16384)
+            expected.append(rest[:cut])
+            rest = rest[cut:]
+        self.assertEqual(list(ChunkStore.chunks(StringIO(data), 4096)), expected)
+
+    def test_unchanged_files_keep_their_chunks(self):
+        files = {'a/one': self.data(30000), 'a/two': self.data(20000), 'b/caf\xe9': self.data(10000)}
+        for name, data in files.items():
+            self.write(name, data)
+        dedup, first = self.snapshot('1', chunkers=3)
+        self.assertEqual(dedup.reused, 0)
+        self.assertEqual(self.contents(first), files)
+
+        files['a/two'] = files['a/two'][:5000] + 'changed' + files['a/two'][5000:]
+        self.write('a/two', files['a/two'])
+        os.utime(os.path.join(self.source, 'a/two'), (1400000000, 1400000000))
+        chunked = []
+        chunks = ChunkStore.chunks
+
+        def counting(fp, *args, **kwargs):
+            chunked.append(fp.name)
+            return chunks(fp, *args, **kwargs)
+
+        ChunkStore.chunks = counting
+        try:
+            dedup, second = self.snapshot('2', chunkers=3)
+        finally:
+            ChunkStore.chunks = chunks
+        self.assertEqual(chunked, [os.path.join(self.source, 'a/two')])
+        self.assertEqual(dedup.reused, 2)
+        self.assertEqual(dedup.total_bytes, sum(len(data) for data in files.values()))
+        self.assertEqual(self.contents(second), files)
+        self.assertEqual([entry['path'] for entry in second['files']], sorted(files))
+
+    def test_unreadable_file_is_left_out(self):
+        self.write('a/good', 'good')
+        self.write('a/bad', 'bad')
+        dedup = Deduplicator(self.store, 'src-', 4096, 2, chunkers=2)
+        dedup.start()
+        dedup.add_file(os.path.join(self.source, 'a/good'), os.lstat(os.path.join(self.source, 'a/good')), 'a/good')
+        dedup.add_file(os.path.join(self.source, 'a/gone'), os.lstat(os.path.join(self.source, 'a/bad')), 'a/gone')
+        index = Deduplicator.load_index(self.store, dedup.finish('1'))
+        self.assertEqual(self.contents(index), {'a/good': 'good'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import shutil
+import tempfile
+import unittest
+import Daemon
+from Daemon import ChangeJournal, Watcher
+from Scanner import Rules
+
+
+class ChangeJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state', 'changes.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_take_and_ship(self):
+        journal = ChangeJournal(self.path)
+        journal.add('c/a', 10)
+        journal.add('c/a', 20)
+        journal.add('c/b')
+        journal.add('c/a')
+        self.assertEqual(journal.changes, {'c/a': 20, 'c/b': 0})
+        self.assertEqual(journal.bytes, 20)
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        self.assertEqual(journal.take(), ['c/a', 'c/b'])
+        self.assertTrue(os.path.isfile(self.path + '.batch'))
+        self.assertFalse(os.path.isfile(self.path))
+        self.assertEqual((journal.changes, journal.bytes), ({}, 0))
+        # Changes made while the batch is shipped go to a new journal
+        journal.add('c/new', 5)
+        self.assertEqual(journal.take(), ['c/a', 'c/b'])
+        journal.shipped()
+        self.assertFalse(os.path.isfile(self.path + '.batch'))
+        self.assertEqual(journal.take(), ['c/new'])
+        journal.shipped()
+        self.assertEqual(journal.take(), [])
+
+    def test_overflow(self):
+        journal = ChangeJournal(self.path, 2)
+        journal.add('c/a', 1)
+        journal.add('c/b', 2)
+        self.assertFalse(journal.overflowed)
+        journal.add('c/c', 3)
+        self.assertTrue(journal.overflowed)
+        self.assertEqual((journal.changes, journal.bytes), ({}, 0))
+        journal.add('c/d', 4)
+        self.assertEqual(journal.changes, {})
+        # The whole source is scanned until the batch is shipped
+        self.assertIsNone(journal.take())
+        self.assertIsNone(journal.take())
+        self.assertFalse(journal.overflowed)
+        journal.add('c/e')
+        journal.shipped()
+        self.assertEqual(journal.take(), ['c/e'])
+
+        journal.shipped()
+        journal.overflow()
+        self.assertTrue(journal.overflowed)
+        self.assertIsNone(journal.take())
+
+    def test_load_and_clear(self):
+        journal = ChangeJournal(self.path)
+        journal.add('c/caf\xe9', 1)
+        journal.add('c/a\nb', 2)
+        journal.take()
+        journal.add('c/caf\xe9', 3)
+        journal.add('c/x')
+        # A daemon that died while writing leaves a torn last line
+        with open(self.path, 'a') as f:
+            f.write('{"path": "c/y')
+        self.assertEqual(ChangeJournal(self.path).load(), 3)
+        journal.clear()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.batch'))
+        self.assertEqual(ChangeJournal(self.path).load(), 0)
+        self.assertEqual(journal.take(), [])
+
+
+@unittest.skipUnless(Daemon.available(), 'inotify is not available')
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, 'src')
+        for path in ('c/sub/deep', 'd'):
+            os.makedirs(os.path.join(self.root, path))
+        self.journal = ChangeJournal(os.path.join(self.dir, 'changes.journal'))
+        self.watcher = Watcher(self.root, Rules(['*.tmp']), self.journal)
+        # Watches are set up as start does, events are handed over without the reading thread
+        self.watcher._Watcher__watch('')
+        for child in self.watcher.scanner.children():
+            self.watcher._Watcher__watch_tree(child)
+
+    def tearDown(self):
+        os.close(self.watcher.fd)
+        shutil.rmtree(self.dir)
+
+    def event(self, directory, mask, name):
+        wd = dict((path, wd) for wd, path in self.watcher.watches.items())[directory]
+        self.watcher._Watcher__event(wd, mask, name)
+
+    def write(self, path, data):
+        with open(os.path.join(self.root, path), 'wb') as f:
+            f.write(data)
+
+    def test_watches(self):
+        self.assertEqual(sorted(self.watcher.watches.values()), ['', 'c', 'c/sub', 'c/sub/deep', 'd'])
+        self.assertTrue(self.watcher.complete)
+
+    def test_files(self):
+        self.write('c/a', 'data')
+        self.event('c', Daemon.IN_CLOSE_WRITE, 'a')
+        self.event('c/sub', Daemon.IN_DELETE, 'gone')
+        self.event('c', Daemon.IN_ATTRIB, 'a')
+        self.write('d/moved', 'moved in')
+        self.event('d', Daemon.IN_MOVED_TO, 'moved')
+        self.event('d', Daemon.IN_MOVED_FROM, 'old')
+        # Files in root are not part of any child, excluded files are not recorded
+        self.event('', Daemon.IN_CLOSE_WRITE, 'top')
+        self.event('c', Daemon.IN_CLOSE_WRITE, 'a.tmp')
+        self.assertEqual(self.journal.changes, {'c/a': 4, 'c/sub/gone': 0, 'd/moved': 8, 'd/old': 0})
+        self.assertEqual(self.journal.bytes, 12)
+
+    def test_directories(self):
+        os.makedirs(os.path.join(self.root, 'c', 'new', 'inner'))
+        self.event('c', Daemon.IN_MOVED_TO | Daemon.IN_ISDIR, 'new')
+        self.event('c', Daemon.IN_MOVED_FROM | Daemon.IN_ISDIR, 'sub')
+        os.makedirs(os.path.join(self.root, 'e'))
+        self.event('', Daemon.IN_CREATE | Daemon.IN_ISDIR, 'e')
+        self.event('d', Daemon.IN_DELETE | Daemon.IN_ISDIR, 'empty')
+        self.assertEqual(sorted(self.journal.changes), ['c/new', 'c/sub', 'd/empty', 'e'])
+        self.assertEqual(sorted(self.watcher.watches.values()), ['', 'c', 'c/new', 'c/new/inner', 'd', 'e'])
+
+    def test_ignored_and_overflow(self):
+        wd = dict((path, wd) for wd, path in self.watcher.watches.items())['d']
+        self.watcher._Watcher__event(wd, Daemon.IN_IGNORED, '')
+        self.assertNotIn('d', self.watcher.watches.values())
+        # Events of directories no longer watched are dropped
+        self.watcher._Watcher__event(wd, Daemon.IN_CLOSE_WRITE, 'late')
+        self.assertEqual(self.journal.changes, {})
+        self.watcher._Watcher__event(-1, Daemon.IN_Q_OVERFLOW, '')
+        self.assertTrue(self.journal.overflowed)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import random
+import hashlib
+import shutil
+import tempfile
+import unittest
+import LocalCopy
+from Throttle import IOLimiter
+
+
+class DeltaCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.random = random.Random(7)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def data(self, size):
+        return ''.join(chr(self.random.randint(0, 255)) for i in xrange(size))
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_without_basis(self):
+        src = self.write('src', self.data(5000))
+        dst = os.path.join(self.dir, 'dst')
+        self.assertEqual(LocalCopy.delta_copy(src, dst, None, 1024), (5000, 0))
+        self.assertEqual(self.read(dst), self.read(src))
+        self.assertEqual(LocalCopy.read_signature(dst)[0], 1024)
+        self.assertEqual(len(LocalCopy.read_signature(dst)[1]), 4)
+
+    def test_reuses_shifted_blocks(self):
+        old = self.data(64 * 1024)
+        basis = os.path.join(self.dir, 'basis')
+        LocalCopy.delta_copy(self.write('old', old), basis, None, 1024)
+        new = old[:10000] + 'inserted' + old[10000:40000] + old[41000:] + 'tail'
+        src = self.write('src', new)
+        dst = os.path.join(self.dir, 'dst')
+        written, reused = LocalCopy.delta_copy(src, dst, basis, 1024, fsync=True, limiter=IOLimiter())
+        self.assertEqual(self.read(dst), new)
+        self.assertEqual(written + reused, len(new))
+        self.assertTrue(reused >= 60 * 1024)
+        self.assertFalse(os.path.exists(dst + '.part'))
+
+    def test_gives_up_on_new_data(self):
+        basis = os.path.join(self.dir, 'basis')
+        LocalCopy.delta_copy(self.write('old', self.data(64 * 1024)), basis, None, 1024)
+        new = self.data(64 * 1024)
+        dst = os.path.join(self.dir, 'dst')
+        self.assertEqual(LocalCopy.delta_copy(self.write('src', new), dst, basis, 1024), (len(new), 0))
+        self.assertEqual(self.read(dst), new)
+
+    def test_matches_again_after_new_data(self):
+        old = self.data(256 * 1024)
+        basis = os.path.join(self.dir, 'basis')
+        LocalCopy.delta_copy(self.write('old', old), basis, None, 1024)
+        # Half the file matched before the rewritten part, which must not stop the scan for good
+        new = old[:128 * 1024] + self.data(64 * 1024) + old[192 * 1024:]
+        dst = os.path.join(self.dir, 'dst')
+        written, reused = LocalCopy.delta_copy(self.write('src', new), dst, basis, 1024)
+        self.assertEqual(self.read(dst), new)
+        self.assertEqual((written, reused), (64 * 1024, 192 * 1024))
+
+    def test_other_block_size(self):
+        basis = os.path.join(self.dir, 'basis')
+        old = self.data(8192)
+        LocalCopy.delta_copy(self.write('old', old), basis, None, 1024)
+        dst = os.path.join(self.dir, 'dst')
+        self.assertEqual(LocalCopy.delta_copy(self.write('src', old), dst, basis, 2048), (8192, 0))
+        self.assertEqual(self.read(dst), old)
+
+    def test_delta_through_limiter(self):
+        old = self.data(64 * 1024)
+        basis = os.path.join(self.dir, 'basis')
+        LocalCopy.delta_copy(self.write('old', old), basis, None, 1024)
+        new = 'head' + old
+        dst = os.path.join(self.dir, 'dst')
+        written, reused = LocalCopy.delta_copy(self.write('src', new), dst, basis, 1024,
+                                               limiter=IOLimiter(drop_cache=True))
+        self.assertEqual((written, reused), (4, len(old)))
+        self.assertEqual(self.read(dst), new)
+
+    def test_file_hash_through_limiter(self):
+        src = self.write('src', self.data(100000))
+        self.assertEqual(LocalCopy.file_hash(src, IOLimiter(drop_cache=True)), LocalCopy.file_hash(src))
+        self.assertEqual(LocalCopy.file_hash(src), hashlib.sha256(self.read(src)).hexdigest())
+
+    def test_copy_file_through_limiter(self):
+        src = self.write('src', self.data(100000))
+        dst = os.path.join(self.dir, 'dst')
+        LocalCopy.copy_file(src, dst, True, IOLimiter(drop_cache=True))
+        self.assertEqual(self.read(dst), self.read(src))
+
+
+class FanoutCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # Small blocks so the copies take more blocks than the queues hold
+        self.copy_size = LocalCopy.COPY_SIZE
+        LocalCopy.COPY_SIZE = 4096
+        self.src = os.path.join(self.dir, 'src')
+        with open(self.src, 'wb') as f:
+            f.write(os.urandom(100000))
+        os.utime(self.src, (1400000000, 1400000000))
+
+    def tearDown(self):
+        LocalCopy.COPY_SIZE = self.copy_size
+        shutil.rmtree(self.dir)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_identical_copies(self):
+        # In-kernel copies without a limiter, a reader thread with one
+        for limiter in (None, IOLimiter(drop_cache=True)):
+            dsts = [os.path.join(self.dir, 'dst%d' % i) for i in range(3)]
+            results = LocalCopy.fanout_copy(self.src, dsts, fsync=True, verify=True, limiter=limiter)
+            self.assertEqual(sorted(results), dsts)
+            for dst in dsts:
+                self.assertEqual(results[dst][1:], (100000, None))
+                self.assertEqual(self.read(dst), self.read(self.src))
+                self.assertEqual(os.stat(dst).st_mtime, 1400000000)
+                os.remove(dst)
+
+    def test_failed_destination(self):
+        for limiter in (None, IOLimiter()):
+            good = [os.path.join(self.dir, 'good1'), os.path.join(self.dir, 'good2')]
+            bad = os.path.join(self.dir, 'missing', 'dst')
+            results = LocalCopy.fanout_copy(self.src, [good[0], bad, good[1]], limiter=limiter)
+            self.assertEqual(results[bad][1], 0)
+            self.assertTrue(isinstance(results[bad][2], OSError))
+            for dst in good:
+                self.assertEqual(results[dst][1:], (100000, None))
+                self.assertEqual(self.read(dst), self.read(self.src))
+                os.remove(dst)
+            self.assertEqual(sorted(os.listdir(self.dir)), ['src'])
+
+    def test_source_read_error(self):
+        class FailingReader:
+            def __init__(self, fp):
+                self.fp = fp
+                self.reads = 0
+
+            def read(self, size):
+                self.reads += 1
+                if self.reads > 5:
+                    raise IOError('Input/output error')
+                return self.fp.read(size)
+
+        limiter = IOLimiter()
+        limiter.reader = FailingReader
+        dsts = [os.path.join(self.dir, 'dst1'), os.path.join(self.dir, 'dst2')]
+        results = LocalCopy.fanout_copy(self.src, dsts, limiter=limiter)
+        for dst in dsts:
+            self.assertEqual(str(results[dst][2]), 'Input/output error')
+        self.assertEqual(sorted(os.listdir(self.dir)), ['src'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import shutil
+import tempfile
+import unittest
+from Manifest import Manifest
+
+
+class Stat:
+    def __init__(self, size, mtime, ino):
+        self.st_size = size
+        self.st_mtime = mtime
+        self.st_ino = ino
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.previous = Manifest('100')
+        self.previous.add('a/kept', Stat(10, 1000.5, 1), 'h1')
+        self.previous.add('a/grown', Stat(10, 1000.5, 2))
+        self.previous.add('a/touched', Stat(10, 1000.5, 3))
+        self.previous.add('a/replaced', Stat(10, 1000.5, 4))
+        self.previous.add('b/gone', Stat(10, 1000.5, 5))
+
+    def test_changed(self):
+        self.assertFalse(self.previous.changed('a/kept', Stat(10, 1000.5, 1)))
+        self.assertTrue(self.previous.changed('a/grown', Stat(11, 1000.5, 2)))
+        self.assertTrue(self.previous.changed('a/touched', Stat(10, 1000.6, 3)))
+        self.assertTrue(self.previous.changed('a/replaced', Stat(10, 1000.5, 40)))
+        self.assertTrue(self.previous.changed('a/new', Stat(10, 1000.5, 6)))
+        self.assertEqual(self.previous.digest('a/kept'), 'h1')
+        self.assertIsNone(self.previous.digest('a/new'))
+
+    def test_deleted(self):
+        current = Manifest('200', self.previous.base, 1)
+        for path in ('a/kept', 'a/grown', 'a/touched', 'a/replaced', 'a/new'):
+            current.add(path, Stat(1, 1, 1))
+        self.assertEqual(self.previous.deleted(current), ['b/gone'])
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'state', 'manifest.gz')
+            manifest = Manifest('200', '100', 3)
+            manifest.add('a/tab\there', Stat(1, 2.25, 3), 'digest')
+            manifest.add('a/caf\xe9\n', Stat(4, 5, 6))
+            manifest.save(path)
+            loaded = Manifest.load(path)
+            self.assertEqual((loaded.time, loaded.base, loaded.chain), ('200', '100', 3))
+            self.assertEqual(loaded.entries, manifest.entries)
+            self.assertIsNone(Manifest.load(os.path.join(directory, 'missing.gz')))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
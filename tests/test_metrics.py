@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import re
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from Metrics import Metrics, Profiler
+
+SAMPLE = re.compile(r'^([a-z_]+)\{(.*)\} (\S+)$')
+
+
+def spin(count):
+    """Work done in a profiled thread"""
+    return sum(i * i for i in range(count))
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'metrics.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def lines(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_json_lines(self):
+        metrics = Metrics(self.path, {'source': 'src', 'snapshot': '1400000000'})
+        metrics.event('info', 'Archiving caf\xe9', child='c')
+        with metrics.span('compress', child='c') as span:
+            span.add(2097152, 1048576)
+        # Errors are flushed right away
+        metrics.record('upload', 0.5, bytes_out=100, error='IOError()', destination='bucket')
+        self.assertEqual(len(self.lines()), 3)
+        metrics.close()
+
+        event, compress, upload = self.lines()
+        self.assertEqual(event['level'], 'info')
+        self.assertEqual(event['message'], u'Archiving caf\ufffd')
+        self.assertEqual(event['child'], 'c')
+        self.assertEqual((compress['phase'], compress['bytes_in'], compress['bytes_out']), ('compress', 2097152, 1048576))
+        self.assertGreater(compress['mb_per_second'], 0)
+        self.assertEqual((upload['seconds'], upload['error'], upload['destination']), (0.5, 'IOError()', 'bucket'))
+        self.assertEqual(upload['mb_per_second'], round(100 / 1048576.0 / 0.5, 3))
+        for line in (event, compress, upload):
+            self.assertEqual((line['source'], line['snapshot']), ('src', '1400000000'))
+            self.assertIn('time', line)
+
+    def test_failed_span(self):
+        metrics = Metrics(self.path)
+        try:
+            with metrics.span('transfer', destination='/mnt/backup'):
+                raise IOError('disk full')
+        except IOError:
+            pass
+        line = self.lines()[0]
+        self.assertEqual(line['phase'], 'transfer')
+        self.assertIn('disk full', line['error'])
+        self.assertEqual(metrics.phases[('transfer', '/mnt/backup')]['count'], 1)
+        metrics.close()
+
+    def test_textfile(self):
+        metrics = Metrics(self.path, {'source': 'my "src"', 'snapshot': '1400000000'})
+        metrics.record('compress', 2.0, 300, 100)
+        metrics.record('compress', 1.0, 30, 10)
+        metrics.record('upload', 4.0, 0, 110, destination='s3://bucket')
+        metrics.close()
+        textfile = os.path.join(self.dir, 'collector', 'dir_copy.prom')
+        metrics.write_textfile(textfile, True)
+        self.assertFalse(os.path.exists(textfile + '.tmp'))
+        with open(textfile) as f:
+            text = f.read()
+        self.assertTrue(text.endswith('\n'))
+
+        samples = {}
+        described = set()
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                described.add(line.split()[2])
+                continue
+            if line.startswith('# TYPE '):
+                self.assertEqual(line.split()[3], 'gauge')
+                self.assertIn(line.split()[2], described)
+                continue
+            match = SAMPLE.match(line)
+            self.assertIsNotNone(match, line)
+            # Every sample follows the HELP and TYPE lines of its metric
+            self.assertIn(match.group(1), described)
+            samples[match.group(1), match.group(2)] = float(match.group(3))
+
+        # Only exported labels are attached, run-specific ones are left out
+        base = 'source="my \\"src\\""'
+        self.assertEqual(samples['dir_copy_phase_seconds', base + ',phase="compress"'], 3.0)
+        self.assertEqual(samples['dir_copy_phase_bytes_in', base + ',phase="compress"'], 330)
+        self.assertEqual(samples['dir_copy_phase_bytes_out', base + ',phase="compress"'], 110)
+        self.assertEqual(samples['dir_copy_phase_count', base + ',phase="compress"'], 2)
+        self.assertEqual(samples['dir_copy_phase_seconds', base + ',phase="upload",destination="s3://bucket"'], 4.0)
+        self.assertEqual(samples['dir_copy_last_run_success', base], 1)
+        self.assertEqual(samples['dir_copy_last_run_timestamp_seconds', base], metrics.started)
+        self.assertGreaterEqual(samples['dir_copy_last_run_duration_seconds', base], 0)
+        self.assertEqual(len(samples), 4 * 2 + 3)
+
+        metrics.write_textfile(textfile, False)
+        with open(textfile) as f:
+            self.assertIn('dir_copy_last_run_success{' + base + '} 0\n', f.read())
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def test_threads_are_profiled(self):
+        path = os.path.join(tempfile.mkdtemp(), 'profile.stats')
+        try:
+            profiler = Profiler(path)
+            profiler.start()
+            thread = threading.Thread(target=spin, args=(1000,))
+            thread.start()
+            thread.join()
+            stats = profiler.stop()
+            self.assertTrue(os.path.isfile(path))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        self.assertIn('spin', [function for filename, line, function in stats.stats])
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import time
+import threading
+import unittest
+from Pipeline import Pipeline
+
+
+class PipelineTest(unittest.TestCase):
+
+    def reader(self, results, name):
+        """Consumer storing everything it reads under name"""
+        def consume(reader):
+            results[name] = reader.read()
+        return consume
+
+    def test_cuts_parts(self):
+        parts = []
+
+        def consume(reader):
+            while True:
+                part = reader.queue.get()
+                if part is None:
+                    reader.eof = True
+                    return
+                parts.append(part)
+
+        pipeline = Pipeline(10)
+        pipeline.add_consumer('parts', consume)
+        data = ''
+        for size in (3, 4, 25, 1, 0, 9):
+            chunk = ''.join(chr(65 + (len(data) + i) % 26) for i in range(size))
+            pipeline.write(chunk)
+            data += chunk
+        pipeline.close()
+        self.assertEqual([len(part) for part in parts], [10, 10, 10, 10, 2])
+        self.assertEqual(''.join(parts), data)
+
+    def test_every_consumer_reads_everything(self):
+        results = {}
+        pipeline = Pipeline(7, 2)
+        for name in ('a', 'b', 'c'):
+            pipeline.add_consumer(name, self.reader(results, name))
+        pipeline.write('x' * 50)
+        pipeline.write('y' * 3)
+        pipeline.close()
+        self.assertEqual(results, dict((name, 'x' * 50 + 'y' * 3) for name in 'abc'))
+
+    def test_slow_consumer_blocks_writer(self):
+        go = threading.Event()
+        results = {}
+
+        def slow(reader):
+            go.wait()
+            results['slow'] = reader.read()
+
+        pipeline = Pipeline(1, 3)
+        pipeline.add_consumer('slow', slow)
+        writer = threading.Thread(target=pipeline.write, args=('z' * 10,))
+        writer.daemon = True
+        writer.start()
+        time.sleep(0.1)
+        # Three parts are queued and the writer waits for room for the fourth
+        self.assertTrue(writer.is_alive())
+        self.assertEqual(pipeline.consumers[0][1].queue.qsize(), 3)
+        go.set()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        pipeline.close()
+        self.assertEqual(results['slow'], 'z' * 10)
+
+    def test_consumer_error_is_raised_on_close(self):
+        results = {}
+
+        def failing(reader):
+            reader.read(1)
+            raise ValueError('disk full')
+
+        pipeline = Pipeline(1, 1)
+        pipeline.add_consumer('failing', failing)
+        pipeline.add_consumer('good', self.reader(results, 'good'))
+        # The failing consumer is drained, the writer does not block on it
+        pipeline.write('w' * 20)
+        self.assertRaises(ValueError, pipeline.close)
+        self.assertEqual(results['good'], 'w' * 20)
+        self.assertEqual([name for name, e in pipeline.errors], ['failing'])
+
+    def test_abort_fails_consumers(self):
+        seen = []
+
+        def consume(reader):
+            try:
+                reader.read()
+            except IOError as e:
+                seen.append(e)
+                raise
+
+        pipeline = Pipeline(4)
+        pipeline.add_consumer('a', consume)
+        pipeline.add_consumer('b', consume)
+        pipeline.write('abcdefgh')
+        pipeline.abort()
+        self.assertEqual(len(seen), 2)
+        self.assertEqual(sorted(name for name, e in pipeline.errors), ['a', 'b'])
+        # Closing an aborted pipeline does nothing
+        pipeline.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+import Archive
+from Restore import Restore, DedupRestore, LocalLocation
+from ChunkStore import LocalChunkStore
+from Snapshot import Snapshot
+
+
+class RestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'src')
+        self.dest = os.path.join(self.dir, 'dest')
+        os.makedirs(self.dest)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.dir)
+
+    def write(self, path, data):
+        path = os.path.join(self.source, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def backup(self, engine, codec='deflate'):
+        snapshot = Snapshot(self.source, {'local': [self.dest], 's3': []},
+                            {'engine': engine, 'incremental': True, 'codec': codec})
+        snapshot.make()
+        snapshot.transfer_local()
+        snapshot.finish()
+        # Snapshots are named by the second they are taken in
+        time.sleep(1.1)
+        return snapshot
+
+    def restore(self, contents=None):
+        target = os.path.join(self.dir, 'restored')
+        Restore(LocalLocation(self.dest), 'src').restore(target)
+        result = []
+        for root, dirs, files in os.walk(target):
+            result.extend(os.path.relpath(os.path.join(root, name), target) + '/' for name in dirs)
+            result.extend(os.path.relpath(os.path.join(root, name), target) for name in files)
+        for path, data in (contents or {}).items():
+            with open(os.path.join(target, path), 'rb') as f:
+                self.assertEqual(f.read(), data)
+        shutil.rmtree(target)
+        return sorted(result)
+
+    def test_incremental_deletions(self):
+        for engine in ('stream', 'volume'):
+            self.write('c/keep', 'keep')
+            self.write('c/sub/deep/a', 'a')
+            self.write('c/sub/b', 'b')
+            self.write('d/gone', 'gone')
+            self.assertEqual(self.backup(engine).kind, 'master')
+            shutil.rmtree(os.path.join(self.source, 'c', 'sub'))
+            shutil.rmtree(os.path.join(self.source, 'd'))
+            os.remove(os.path.join(self.source, 'c', 'keep'))
+            self.write('c/new', 'new')
+            snapshot = self.backup(engine)
+            self.assertEqual(snapshot.kind, 'incr')
+            self.assertEqual(snapshot.deleted,
+                             ['c/keep', 'c/sub/b', 'c/sub/deep/a', 'd/gone', 'c/sub/', 'c/sub/deep/', 'd/'])
+            self.assertEqual(self.restore(), ['c/', 'c/new'])
+            # Start over, the manifest of the previous run is kept next to the source
+            shutil.rmtree(self.dir)
+            os.makedirs(self.dest)
+
+    def test_codecs(self):
+        for codec in ['store', 'deflate', 'gzip', 'zstd'] + (['xz'] if Archive.lzma is not None else []):
+            if codec == 'zstd' and Archive.zstandard is None:
+                continue
+            self.write('c/a.txt', 'a' * 100000)
+            self.write('c/b.txt', 'b' * 1000)
+            self.write('c/photo.jpg', 'jpg')
+            self.backup('stream', codec)
+            self.assertEqual(self.restore({'c/a.txt': 'a' * 100000, 'c/photo.jpg': 'jpg'}),
+                             ['c/', 'c/a.txt', 'c/b.txt', 'c/photo.jpg'])
+            os.remove(os.path.join(self.source, 'c', 'b.txt'))
+            self.write('c/new.txt', 'new')
+            self.assertEqual(self.backup('stream', codec).kind, 'incr')
+            # Deleted files stay deleted and the tombstones are not restored, whatever the codec
+            self.assertEqual(self.restore({'c/a.txt': 'a' * 100000, 'c/new.txt': 'new'}),
+                             ['c/', 'c/a.txt', 'c/new.txt', 'c/photo.jpg'])
+            shutil.rmtree(self.dir)
+            os.makedirs(self.dest)
+
+    def test_gzip_child_archives(self):
+        # Child archives of the zip engine are indexed from the archives on disk
+        self.write('c/a.txt', 'a' * 100000)
+        self.write('d/b.txt', 'b')
+        snapshot = Snapshot(self.source, {'local': [self.dest], 's3': []}, {'engine': 'zip', 'codec': 'gzip'})
+        snapshot.make()
+        snapshot.transfer_local()
+        snapshot.finish()
+        self.assertEqual(self.restore({'c/a.txt': 'a' * 100000, 'd/b.txt': 'b'}), ['c/', 'c/a.txt', 'd/', 'd/b.txt'])
+
+    def test_dedup(self):
+        store = os.path.join(self.dir, 'store')
+        self.write('c/a', 'a' * 5000)
+        self.write('c/sub/caf\xe9', 'b')
+        os.chmod(os.path.join(self.source, 'c/a'), 0600)
+        os.utime(os.path.join(self.source, 'c/a'), (1400000000, 1400000000))
+        first = Snapshot(self.source, {'local': [], 's3': [], 'dedup': [store]}, {})
+        first.make()
+        first.transfer_remote()
+        first.finish()
+        time.sleep(1.1)
+        self.write('c/a', 'changed')
+        second = Snapshot(self.source, {'local': [], 's3': [], 'dedup': [store]}, {})
+        second.make()
+        second.transfer_remote()
+        second.finish()
+
+        target = os.path.join(self.dir, 'restored')
+        restore = DedupRestore(LocalChunkStore(store), 'src')
+        self.assertEqual(sorted(restore.snapshots()), [first.time, second.time])
+        self.assertEqual(restore.restore(target, ['c/a'], first.time), 1)
+        self.assertEqual(os.listdir(target), ['c'])
+        with open(os.path.join(target, 'c/a'), 'rb') as f:
+            self.assertEqual(f.read(), 'a' * 5000)
+        self.assertEqual(os.stat(os.path.join(target, 'c/a')).st_mode & 07777, 0600)
+        self.assertEqual(os.stat(os.path.join(target, 'c/a')).st_mtime, 1400000000)
+        shutil.rmtree(target)
+        self.assertEqual(DedupRestore(LocalChunkStore(store), 'src').restore(target), 2)
+        with open(os.path.join(target, 'c/a'), 'rb') as f:
+            self.assertEqual(f.read(), 'changed')
+        with open(os.path.join(target, 'c/sub/caf\xe9'), 'rb') as f:
+            self.assertEqual(f.read(), 'b')
+
+
+if __name__ == '__main__':
+    unittest.main()
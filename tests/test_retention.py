@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import shutil
+import tempfile
+import unittest
+import Retention
+
+DAY = 86400
+# Monday, 2020-09-14 00:00 UTC
+MONDAY = 1600041600
+
+
+def kinds(*snapshots):
+    """Snapshot dict from (time, kind) tuples"""
+    return dict((str(t), kind) for t, kind in snapshots)
+
+
+class ChainsTest(unittest.TestCase):
+
+    def test_chains(self):
+        snapshots = kinds((5, 'incr'), (10, 'master'), (11, 'incr'), (12, 'incr'), (20, 'master'), (100, 'incr'))
+        self.assertEqual(Retention.chains(snapshots), [['5'], ['10', '11', '12'], ['20', '100']])
+
+    def test_numeric_order(self):
+        self.assertEqual(Retention.chains(kinds((9, 'master'), (10, 'incr'))), [['9', '10']])
+
+
+class ExpiredTest(unittest.TestCase):
+
+    def test_keep_last(self):
+        snapshots = kinds((1, 'master'), (2, 'incr'), (3, 'master'), (4, 'master'), (5, 'incr'))
+        self.assertEqual(Retention.expired(snapshots, None, keep_last=2), ['1', '2'])
+        self.assertEqual(Retention.expired(snapshots, None, keep_last=1), ['1', '2', '3'])
+        self.assertEqual(Retention.expired(snapshots, None, keep_last=3), [])
+
+    def test_chains_kept_whole(self):
+        snapshots = kinds((1, 'master'), (2, 'incr'), (3, 'incr'), (4, 'master'))
+        self.assertEqual(Retention.expired(snapshots, None, keep_last=1), ['1', '2', '3'])
+
+    def test_pinned(self):
+        snapshots = kinds((1, 'master'), (2, 'incr'), (3, 'master'), (4, 'master'))
+        self.assertEqual(Retention.expired(snapshots, '4', keep_last=1), ['1', '2', '3'])
+        self.assertEqual(Retention.expired(snapshots, '3', keep_last=1), ['1', '2'])
+        # The chain of 1 ends with 2, which the current run is based on
+        self.assertEqual(Retention.expired(snapshots, '2', keep_last=1), [])
+
+    def test_daily(self):
+        # Two full snapshots a day for four days
+        snapshots = kinds(*[(MONDAY + day * DAY + hour * 3600, 'master') for day in range(4) for hour in (1, 13)])
+        expired = Retention.expired(snapshots, None, keep_last=1, keep_daily=3)
+        # The newest chain of each of the last three days is kept
+        self.assertEqual(expired, [str(MONDAY + 3600), str(MONDAY + 13 * 3600), str(MONDAY + DAY + 3600),
+                                   str(MONDAY + 2 * DAY + 3600), str(MONDAY + 3 * DAY + 3600)])
+
+    def test_weekly(self):
+        # A full snapshot every day for three weeks
+        snapshots = kinds(*[(MONDAY + day * DAY, 'master') for day in range(21)])
+        expired = Retention.expired(snapshots, None, keep_last=1, keep_weekly=2)
+        kept = sorted(set(snapshots) - set(expired), key=int)
+        # The last day of the last two weeks
+        self.assertEqual(kept, [str(MONDAY + 13 * DAY), str(MONDAY + 20 * DAY)])
+
+    def test_gfs(self):
+        snapshots = kinds(*[(MONDAY + day * DAY, 'master') for day in range(21)] +
+                          [(MONDAY + day * DAY + 3600, 'incr') for day in range(21)])
+        expired = Retention.expired(snapshots, None, keep_last=2, keep_daily=3, keep_weekly=3)
+        kept = sorted(set(snapshots) - set(expired), key=int)
+        # Three weeks by their last day, three days and the two newest chains among them
+        days = [6 * DAY, 13 * DAY, 18 * DAY, 19 * DAY, 20 * DAY]
+        self.assertEqual(kept, [str(MONDAY + day + hour) for day in days for hour in (0, 3600)])
+        self.assertEqual(expired, sorted(expired, key=int))
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_add_remove_save(self):
+        path = os.path.join(self.dir, 'state', 'catalog.json')
+        catalog = Retention.Catalog(path, 'bucket', 'src')
+        self.assertTrue(catalog.add('src-10-master.zip', 100))
+        self.assertTrue(catalog.add('src-10-master.zip.idx', 10))
+        self.assertTrue(catalog.add('src-20-incr.0001.zip', 50))
+        self.assertFalse(catalog.add('other-10-master.zip', 1))
+        self.assertFalse(catalog.add('src-notes.txt', 1))
+        self.assertEqual(catalog.size(), 160)
+        catalog.save()
+
+        loaded = Retention.Catalog(path, 'bucket', 'src')
+        self.assertEqual(loaded.snapshots, catalog.snapshots)
+        self.assertEqual(loaded.snapshots['20']['kind'], 'incr')
+        self.assertEqual(loaded.remove('10'), ['src-10-master.zip', 'src-10-master.zip.idx'])
+        self.assertEqual(loaded.size(), 50)
+        self.assertEqual(Retention.Catalog(path, 'other-bucket', 'src').snapshots, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
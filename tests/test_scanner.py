@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import shutil
+import tempfile
+import unittest
+from Scanner import Scanner, Rules, translate
+
+
+class ScannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'c', 'sub'))
+        for path in ('c/a', 'c/sub/b'):
+            with open(os.path.join(self.dir, path), 'w') as f:
+                f.write(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_scan_order(self):
+        entries, errors = Scanner(self.dir).scan('c')
+        self.assertEqual([path for path, st in entries], ['c', 'c/a', 'c/sub', 'c/sub/b'])
+        self.assertEqual(errors, [])
+
+    def test_fifo_is_skipped(self):
+        os.mkfifo(os.path.join(self.dir, 'c', 'pipe'))
+        os.symlink('pipe', os.path.join(self.dir, 'c', 'link'))
+        scanner = Scanner(self.dir)
+        entries, errors = scanner.scan('c')
+        self.assertEqual([path for path, st in entries], ['c', 'c/a', 'c/sub', 'c/sub/b'])
+        self.assertEqual(scanner.skipped, 2)
+        entries, errors = scanner.scan_paths(['c/pipe', 'c/a'])
+        self.assertEqual([path for path, st in entries], ['c/a'])
+
+
+class TranslateTest(unittest.TestCase):
+
+    def matches(self, pattern, path):
+        return translate(pattern)[0].match(path) is not None
+
+    def test_blank_and_comments(self):
+        self.assertIsNone(translate(''))
+        self.assertIsNone(translate('   \n'))
+        self.assertIsNone(translate('# comment'))
+        self.assertTrue(self.matches('\\#file', '#file'))
+
+    def test_flags(self):
+        self.assertEqual(translate('*.log')[1:], (False, False))
+        self.assertEqual(translate('!keep.log')[1:], (True, False))
+        self.assertEqual(translate('cache/')[1:], (False, True))
+        self.assertEqual(translate('\\!literal')[1:], (False, False))
+        self.assertTrue(self.matches('\\!literal', '!literal'))
+        self.assertTrue(self.matches('trailing   ', 'trailing'))
+
+    def test_unanchored(self):
+        for path in ('a.log', 'c/a.log', 'c/d/.log'):
+            self.assertTrue(self.matches('*.log', path), path)
+        for path in ('a.logx', 'a.log/b', 'a/b'):
+            self.assertFalse(self.matches('*.log', path), path)
+
+    def test_anchored(self):
+        self.assertTrue(self.matches('/build', 'build'))
+        self.assertFalse(self.matches('/build', 'c/build'))
+        self.assertTrue(self.matches('doc/*.txt', 'doc/a.txt'))
+        self.assertFalse(self.matches('doc/*.txt', 'c/doc/a.txt'))
+        self.assertFalse(self.matches('doc/*.txt', 'doc/sub/a.txt'))
+
+    def test_double_star(self):
+        for path in ('foo', 'a/foo', 'a/b/foo'):
+            self.assertTrue(self.matches('**/foo', path), path)
+        self.assertTrue(self.matches('a/**', 'a/x/y'))
+        self.assertFalse(self.matches('a/**', 'b/x'))
+        for path in ('a/b', 'a/x/b', 'a/x/y/b'):
+            self.assertTrue(self.matches('a/**/b', path), path)
+        self.assertFalse(self.matches('a/**/b', 'a/xb'))
+
+    def test_character_classes(self):
+        self.assertTrue(self.matches('file?.txt', 'file1.txt'))
+        self.assertFalse(self.matches('file?.txt', 'file10.txt'))
+        self.assertFalse(self.matches('file?', 'file/'))
+        self.assertTrue(self.matches('[ab].txt', 'a.txt'))
+        self.assertFalse(self.matches('[ab].txt', 'c.txt'))
+        self.assertTrue(self.matches('[!ab].txt', 'c.txt'))
+        self.assertFalse(self.matches('[!ab].txt', 'a.txt'))
+        self.assertTrue(self.matches('[a-c]x', 'bx'))
+        self.assertTrue(self.matches('a[b', 'a[b'))
+        self.assertTrue(self.matches('a.b', 'a.b'))
+        self.assertFalse(self.matches('a.b', 'axb'))
+
+
+class RulesTest(unittest.TestCase):
+
+    def test_last_match_wins(self):
+        rules = Rules(['*.log', 'tmp/'], ['important.log'], skip_caches=False)
+        self.assertTrue(rules.excluded('c/a.log', False))
+        self.assertFalse(rules.excluded('c/important.log', False))
+        self.assertTrue(rules.excluded('c/tmp', True))
+        self.assertFalse(rules.excluded('c/tmp', False))
+        self.assertFalse(rules.excluded('c/a.txt', False))
+
+    def test_cache_patterns(self):
+        self.assertTrue(Rules().excluded('c/node_modules', True))
+        self.assertFalse(Rules(skip_caches=False).excluded('c/node_modules', True))
+        self.assertTrue(Rules().excluded('c/.gradle/caches', True))
+        self.assertFalse(Rules().excluded('c/caches', True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import time
+import threading
+import unittest
+import Scheduler
+from Scheduler import Resource
+
+
+class FakeSnapshot:
+    """Snapshot stand-in recording its phases in the log of its scheduler test"""
+
+    test = None
+
+    def __init__(self, source, destinations, config, throttle=None, limiter=None, changes=None):
+        self.source = source
+        self.config = config
+        self.pipeline = config.get('pipeline', False)
+        self.reported = None
+        self.finished = False
+
+    def phase(self, name):
+        test = FakeSnapshot.test
+        key = 'pipeline' if self.pipeline and name == 'make' else name
+        with test.lock:
+            test.log.append((self.source, name))
+            if sum(test.active.values()) and (key == 'pipeline' or test.active.get('pipeline')):
+                test.overlaps += 1
+            test.active[key] = test.active.get(key, 0) + 1
+            test.peak[key] = max(test.peak.get(key, 0), test.active[key])
+        time.sleep(self.config.get('delay', 0))
+        with test.lock:
+            test.active[key] -= 1
+        if self.config.get('fail') == name:
+            raise IOError('failed ' + name)
+
+    def make(self):
+        self.phase('make')
+
+    def transfer_local(self):
+        self.phase('local')
+
+    def transfer_remote(self):
+        self.phase('remote')
+
+    def report(self, success):
+        self.reported = success
+        FakeSnapshot.test.reports.append((self.source, success))
+
+    def finish(self):
+        FakeSnapshot.test.reports.append((self.source, 'finished'))
+
+
+class ResourceTest(unittest.TestCase):
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.005)
+
+    def test_priority_order(self):
+        resource = Resource('cpu', 1)
+        resource.acquire()
+        order = []
+
+        def waiter(name, priority):
+            resource.acquire(priority)
+            order.append(name)
+            resource.release()
+
+        threads = []
+        for name, priority in (('a', 1), ('b', 5), ('c', 3), ('d', 5)):
+            thread = threading.Thread(target=waiter, args=(name, priority))
+            thread.start()
+            threads.append(thread)
+            self.wait_for(lambda: len(resource.waiting) == len(threads))
+        resource.release()
+        for thread in threads:
+            thread.join(5)
+        # Highest priority first, equal priorities in the order they came
+        self.assertEqual(order, ['b', 'd', 'c', 'a'])
+        self.assertEqual(resource.used, 0)
+
+    def test_slot_limit(self):
+        resource = Resource('net', 2)
+        lock = threading.Lock()
+        counts = {'active': 0, 'peak': 0}
+
+        def worker():
+            resource.acquire()
+            try:
+                with lock:
+                    counts['active'] += 1
+                    counts['peak'] = max(counts['peak'], counts['active'])
+                time.sleep(0.02)
+                with lock:
+                    counts['active'] -= 1
+            finally:
+                resource.release()
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(counts['peak'], 2)
+        self.assertEqual(resource.used, 0)
+
+    def test_at_least_one_slot(self):
+        self.assertEqual(Resource('disk', 0).slots, 1)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = Scheduler.Snapshot
+        Scheduler.Snapshot = FakeSnapshot
+        FakeSnapshot.test = self
+        self.lock = threading.Lock()
+        self.log = []
+        self.active = {}
+        self.peak = {}
+        self.overlaps = 0
+        self.reports = []
+
+    def tearDown(self):
+        Scheduler.Snapshot = self.snapshot
+        FakeSnapshot.test = None
+
+    def config(self, source, **kwargs):
+        config = {'source': source, 'destinations': {}}
+        config.update(kwargs)
+        return config
+
+    def test_priority_order(self):
+        scheduler = Scheduler.Scheduler(jobs=1)
+        scheduler.add(self.config('low'))
+        scheduler.add(self.config('high', priority=9))
+        scheduler.add(self.config('middle'), priority=4)
+        scheduler.add(self.config('later', priority=9))
+        self.assertEqual(scheduler.run(), [])
+        made = [source for source, name in self.log if name == 'make']
+        self.assertEqual(made, ['high', 'later', 'middle', 'low'])
+        self.assertEqual(len(self.log), 12)
+
+    def test_slot_limits(self):
+        scheduler = Scheduler.Scheduler(cpu=1, disk=1, net=2, jobs=6)
+        for i in range(6):
+            scheduler.add(self.config('source%d' % i, delay=0.02))
+        self.assertEqual(scheduler.run(), [])
+        self.assertEqual(self.peak['make'], 1)
+        self.assertEqual(self.peak['local'], 1)
+        self.assertLessEqual(self.peak['remote'], 2)
+        self.assertEqual(len([report for report in self.reports if report[1] == 'finished']), 6)
+
+    def test_pipeline_takes_every_resource(self):
+        scheduler = Scheduler.Scheduler(cpu=1, disk=1, net=1, jobs=4)
+        for i in range(2):
+            scheduler.add(self.config('source%d' % i, delay=0.02))
+        scheduler.add(self.config('pipeline', pipeline=True, delay=0.05))
+        scheduler.add(self.config('source2', delay=0.02))
+        self.assertEqual(scheduler.run(), [])
+        self.assertEqual(self.peak['pipeline'], 1)
+        # No phase of another job runs while the pipeline snapshot holds a slot of every resource
+        self.assertEqual(self.overlaps, 0)
+        self.assertEqual(len(self.log), 12)
+
+    def test_failed_job(self):
+        scheduler = Scheduler.Scheduler(jobs=2)
+        scheduler.add(self.config('broken', fail='local'))
+        scheduler.add(self.config('fine'))
+        failed = scheduler.run()
+        self.assertEqual([source for source, e in failed], ['broken'])
+        self.assertIsInstance(failed[0][1], IOError)
+        self.assertIn(('broken', False), self.reports)
+        self.assertNotIn(('broken', 'finished'), self.reports)
+        self.assertIn(('fine', 'finished'), self.reports)
+        self.assertNotIn(('broken', 'remote'), self.log)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+import Archive
+from Archive import ArchiveWriter
+from Snapshot import Snapshot
+from Scheduler import Scheduler
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.dir, 'dest')
+        os.makedirs(self.dest)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def source(self, name, files):
+        """Create a source directory from a dict of path -> contents"""
+        root = os.path.join(self.dir, name)
+        for path, data in files.items():
+            path = os.path.join(root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+        return root
+
+    def backup(self, source, **options):
+        snapshot = Snapshot(source, {'local': [self.dest], 's3': []}, options)
+        snapshot.make()
+        snapshot.transfer_local()
+        snapshot.finish()
+        return snapshot
+
+    def members(self, name, engine):
+        """Names and contents of all files of a snapshot at dest, child archives of the zip engine included"""
+        result = {}
+        z = zipfile.ZipFile(os.path.join(self.dest, name))
+        for name in z.namelist():
+            if engine == 'zip':
+                child = zipfile.ZipFile(StringIO(z.read(name)))
+                for member in child.namelist():
+                    if not member.endswith('/'):
+                        result[member] = child.read(member)
+            elif not name.endswith('/'):
+                result[name] = z.read(name)
+        return result
+
+    def test_fifo_is_skipped(self):
+        for engine in ('zip', 'stream'):
+            source = self.source('src-' + engine, {'c/a': 'a', 'c/sub/b': 'b'})
+            os.mkfifo(os.path.join(source, 'c', 'pipe'))
+            snapshot = self.backup(source, engine=engine)
+            self.assertEqual(self.members(os.path.basename(snapshot.master_file), engine),
+                             {'c/a': 'a', 'c/sub/b': 'b'})
+            self.assertEqual(snapshot.failed, [])
+
+    def test_worker_error_fails_snapshot(self):
+        add_file = ArchiveWriter.add_file
+
+        def failing(writer, path, *args, **kwargs):
+            if path.endswith('bad'):
+                raise RuntimeError('disk on fire')
+            return add_file(writer, path, *args, **kwargs)
+
+        ArchiveWriter.add_file = failing
+        try:
+            for engine in ('zip', 'volume'):
+                source = self.source('src-' + engine, {'c/a': 'a', 'd/bad': 'b'})
+                snapshot = Snapshot(source, {'local': [self.dest], 's3': []}, {'engine': engine})
+                self.assertRaises(Exception, snapshot.make)
+                if engine == 'zip':
+                    self.assertFalse(os.path.exists(os.path.join(snapshot.temp_dir_path, 'd.zip')))
+                    self.assertEqual(snapshot.failed, ['d'])
+                    self.assertEqual(snapshot.archived, ['c'])
+                else:
+                    self.assertEqual([name for name in os.listdir(snapshot.source_root)
+                                      if name.endswith('.zip') or name.endswith(Archive.INDEX_SUFFIX)], [])
+        finally:
+            ArchiveWriter.add_file = add_file
+
+    def test_concurrent_snapshots(self):
+        scheduler = Scheduler(cpu=4)
+        engines = ['zip', 'stream', 'zip', 'stream']
+        files = {}
+        for i, engine in enumerate(engines):
+            name = 'src%d' % i
+            files[name] = dict(('c%d/f%d' % (c, f), name + ' file %d' % f) for c in range(3) for f in range(50))
+            scheduler.add({'source': self.source(name, files[name]), 'destinations': {'local': [self.dest], 's3': []},
+                           'engine': engine, 'workers': 2})
+        self.assertEqual(scheduler.run(), [])
+        for i, engine in enumerate(engines):
+            name = 'src%d' % i
+            archive = [n for n in os.listdir(self.dest) if n.startswith(name + '-') and n.endswith('-master.zip')]
+            self.assertEqual(len(archive), 1)
+            self.assertEqual(self.members(archive[0], engine), files[name])
+
+    def test_non_utf8_names(self):
+        files = {'caf\xe9/men\xfc': 'latin-1', 'plain/a': 'a'}
+        for engine in ('zip', 'stream', 'volume'):
+            snapshot = self.backup(self.source('src-' + engine, files), engine=engine)
+            self.assertEqual(snapshot.failed, [])
+            if engine != 'volume':
+                self.assertEqual(self.members(os.path.basename(snapshot.master_file), engine), files)
+
+    def test_resume_non_utf8_names(self):
+        files = {'a\xe9/f\xff': 'first', 'b/f': 'second'}
+        # Source names come from backup.json and are UTF-8
+        source = self.source('src\xc4\x8d', files)
+        add_file = ArchiveWriter.add_file
+
+        def interrupted(writer, path, *args, **kwargs):
+            if path.endswith('b/f'):
+                raise KeyboardInterrupt()
+            return add_file(writer, path, *args, **kwargs)
+
+        ArchiveWriter.add_file = interrupted
+        try:
+            snapshot = Snapshot(source, {'local': [self.dest], 's3': []}, {'engine': 'stream'})
+            self.assertRaises(KeyboardInterrupt, snapshot.make)
+        finally:
+            ArchiveWriter.add_file = add_file
+        snapshot = self.backup(source, engine='stream')
+        self.assertTrue(snapshot.resumed)
+        self.assertEqual(snapshot.archived, ['a\xe9', 'b'])
+        self.assertEqual(self.members(os.path.basename(snapshot.master_file), 'stream'), files)
+        with open(os.path.join(self.dest, os.path.basename(snapshot.index_file)), 'rb') as f:
+            index = Archive.read_index(f.read())
+        self.assertEqual(sorted(entry['name'] for entry in index['members'] if not entry['name'].endswith('/')),
+                         sorted(files))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import time
+import threading
+import unittest
+from Throttle import TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_is_free(self):
+        bucket = TokenBucket(1000, 50000)
+        start = time.time()
+        bucket.consume(50000)
+        self.assertLess(time.time() - start, 0.1)
+
+    def test_rate(self):
+        bucket = TokenBucket(200000, 20000)
+        start = time.time()
+        for i in range(5):
+            bucket.consume(20000)
+        # The burst is taken right away, the other 80000 bytes at 200000 per second
+        elapsed = time.time() - start
+        self.assertGreaterEqual(elapsed, 0.35)
+        self.assertLess(elapsed, 0.8)
+
+    def test_large_amount(self):
+        bucket = TokenBucket(100000, 10000)
+        bucket.consume(10000)
+        start = time.time()
+        bucket.consume(30000)
+        elapsed = time.time() - start
+        self.assertGreaterEqual(elapsed, 0.25)
+        self.assertLess(elapsed, 0.6)
+
+    def test_shared_by_threads(self):
+        bucket = TokenBucket(100000, 10000)
+
+        def consume():
+            for i in range(5):
+                bucket.consume(5000)
+
+        threads = [threading.Thread(target=consume) for i in range(2)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        elapsed = time.time() - start
+        self.assertGreaterEqual(elapsed, 0.35)
+        self.assertLess(elapsed, 0.8)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import time
+import hashlib
+import threading
+import unittest
+from cStringIO import StringIO
+import Uploader
+from Uploader import MultipartUploader
+
+
+class FakeS3:
+    """Stand-in for S3 keeping the parts of multipart uploads in memory"""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.buckets = {}
+        self.failures = {}
+        self.attempts = {}
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        with self.lock:
+            self.connections += 1
+        return FakeConnection(self)
+
+    def fail(self, bucket, part_num, times):
+        """Make the next times uploads of a part to a bucket fail"""
+        self.failures[(bucket, part_num)] = times
+
+    def uploads(self, bucket):
+        return self.buckets.setdefault(bucket, {})
+
+    def done(self, buckets, part_num):
+        """Tell whether a part reached all buckets"""
+        with self.lock:
+            return all(any(part_num in upload['parts'] for upload in self.uploads(bucket).values())
+                       for bucket in buckets)
+
+    def data(self, bucket):
+        """Contents of the only upload to a bucket, joined from its parts"""
+        upload = self.uploads(bucket).values()[0]
+        return ''.join(upload['parts'][n] for n in sorted(upload['parts']))
+
+
+class FakeConnection:
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def get_bucket(self, name, validate=True):
+        return FakeBucket(self.s3, name)
+
+
+class FakeBucket:
+
+    def __init__(self, s3, name):
+        self.s3 = s3
+        self.name = name
+
+    def initiate_multipart_upload(self, key_name):
+        with self.s3.lock:
+            uploads = self.s3.uploads(self.name)
+            upload = FakeUpload(self, key_name, str(len(uploads) + 1))
+            uploads[upload.id] = {'key': key_name, 'parts': {}, 'state': 'open'}
+        return upload
+
+    def new_key(self, key_name):
+        return FakeKey(self)
+
+
+class FakeUpload:
+
+    def __init__(self, bucket, key_name, upload_id):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = upload_id
+
+    def complete_upload(self):
+        self.bucket.s3.uploads(self.bucket.name)[self.id]['state'] = 'completed'
+
+    def cancel_upload(self):
+        self.bucket.s3.uploads(self.bucket.name)[self.id]['state'] = 'cancelled'
+
+
+class FakeKey:
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.etag = None
+
+    def set_contents_from_file(self, fp, query_args=None, size=None, **kwargs):
+        s3 = self.bucket.s3
+        args = dict(arg.split('=') for arg in query_args.split('&'))
+        part = (self.bucket.name, int(args['partNumber']))
+        data = fp.read(size)
+        time.sleep(s3.delay)
+        with s3.lock:
+            s3.attempts[part] = s3.attempts.get(part, 0) + 1
+            if s3.failures.get(part):
+                s3.failures[part] -= 1
+                raise IOError('Connection reset by peer')
+            s3.uploads(self.bucket.name)[args['uploadId']]['parts'][part[1]] = data
+        self.etag = '"' + hashlib.md5(data).hexdigest() + '"'
+
+
+class CheckedStream:
+    """Readable stream checking that parts are not read ahead of the buffer limit"""
+
+    def __init__(self, data, s3, buckets, part_size, max_buffers):
+        self.fp = StringIO(data)
+        self.s3 = s3
+        self.buckets = buckets
+        self.part_size = part_size
+        self.max_buffers = max_buffers
+        self.most = 0
+
+    def read(self, size):
+        started = self.fp.tell() // self.part_size + 1
+        # Parts may reach all buckets in any order
+        done = len([n for n in range(1, started) if self.s3.done(self.buckets, n)])
+        self.most = max(self.most, started - done)
+        assert started - done <= self.max_buffers, 'More than max_buffers parts buffered'
+        return self.fp.read(size)
+
+
+class MultipartUploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.min_part_size = Uploader.MIN_PART_SIZE
+        Uploader.MIN_PART_SIZE = 1
+        self.data = ''.join(chr(i % 251) for i in xrange(10000))
+
+    def tearDown(self):
+        Uploader.MIN_PART_SIZE = self.min_part_size
+
+    def test_fans_out_to_all_buckets(self):
+        s3 = FakeS3()
+        uploader = MultipartUploader(s3.connect, part_size=1000, concurrency=3)
+        etags = uploader.upload_stream(StringIO(self.data), 'key', ['a', 'b', 'c'])
+        for bucket in ('a', 'b', 'c'):
+            self.assertEqual(s3.data(bucket), self.data)
+            self.assertEqual(s3.uploads(bucket).values()[0]['state'], 'completed')
+            self.assertEqual(sorted(etags[bucket]), range(1, 11))
+            self.assertEqual(etags[bucket][3], '"' + hashlib.md5(self.data[2000:3000]).hexdigest() + '"')
+        self.assertEqual(s3.attempts, dict(((bucket, n), 1) for bucket in 'abc' for n in range(1, 11)))
+
+    def test_empty_stream_uploads_one_part(self):
+        s3 = FakeS3()
+        MultipartUploader(s3.connect, part_size=1000).upload_stream(StringIO(''), 'key', ['a'])
+        self.assertEqual(s3.uploads('a').values()[0]['parts'], {1: ''})
+
+    def test_retries_failed_parts(self):
+        s3 = FakeS3()
+        s3.fail('b', 4, 2)
+        events = []
+        uploader = MultipartUploader(s3.connect, part_size=1000, concurrency=2, retries=3, backoff=0.01,
+                                     log=lambda level, message: events.append(level))
+        started = time.time()
+        uploader.upload_stream(StringIO(self.data), 'key', ['a', 'b'])
+        self.assertEqual(s3.data('b'), self.data)
+        self.assertEqual(s3.attempts[('b', 4)], 3)
+        self.assertEqual(s3.attempts[('a', 4)], 1)
+        self.assertEqual(events.count('warning'), 2)
+        # Backoff doubles, 0.01 then 0.02 seconds
+        self.assertTrue(time.time() - started >= 0.03)
+        # A failed connection is not reused
+        self.assertTrue(s3.connections >= 4)
+
+    def test_cancels_uploads_when_retries_run_out(self):
+        s3 = FakeS3()
+        s3.fail('a', 2, 10)
+        uploader = MultipartUploader(s3.connect, part_size=1000, retries=2, backoff=0.001)
+        self.assertRaises(IOError, uploader.upload_stream, StringIO(self.data), 'key', ['a', 'b'])
+        self.assertEqual(s3.attempts[('a', 2)], 3)
+        for bucket in ('a', 'b'):
+            self.assertEqual(s3.uploads(bucket).values()[0]['state'], 'cancelled')
+
+    def test_keeps_parts_to_resume(self):
+        s3 = FakeS3()
+        s3.fail('a', 2, 10)
+        parts = []
+        uploader = MultipartUploader(s3.connect, part_size=1000, concurrency=1, retries=0)
+        self.assertRaises(IOError, uploader.upload_stream, StringIO(self.data), 'key', ['a'],
+                          on_part=lambda bucket, upload_id, part_num, etag: parts.append(part_num))
+        self.assertEqual(s3.uploads('a').values()[0]['state'], 'open')
+        self.assertEqual(parts, [1])
+
+    def test_bounds_buffered_parts(self):
+        s3 = FakeS3(delay=0.005)
+        buckets = ['a', 'b']
+        stream = CheckedStream(self.data, s3, buckets, 1000, 2)
+        uploader = MultipartUploader(s3.connect, part_size=1000, concurrency=4, max_buffers=2)
+        uploader.upload_stream(stream, 'key', buckets)
+        for bucket in buckets:
+            self.assertEqual(s3.data(bucket), self.data)
+        self.assertEqual(stream.most, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Vladimir Strackovski vlado@nv3.org
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish, dis-
+# tribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the fol-
+# lowing conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABIL-
+# ITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHOR BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+__author__ = 'vstrackovski'
+
+import os
+import zlib
+import shutil
+import struct
+import tempfile
+import unittest
+import Archive
+from ChunkStore import LocalChunkStore, Deduplicator
+from Restore import LocalLocation
+from Verify import Verifier, DedupVerifier
+
+
+class VerifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.dir, 'src-1-master.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def codecs(self):
+        codecs = ['store', 'deflate', 'gzip']
+        if Archive.lzma is not None:
+            codecs.append('xz')
+        if Archive.zstandard is not None:
+            codecs.append('zstd')
+        return codecs
+
+    def write(self, codec):
+        """Write an archive and an index without archive hashes, so only deep checks pass"""
+        with open(self.archive, 'wb') as fp:
+            writer = Archive.ArchiveWriter(fp, Archive.codec(codec))
+            writer.add_bytes('c/a.txt', 'a' * 100000, 1400000000)
+            writer.add_bytes('c/b.txt', ''.join(chr(i % 251) for i in range(5000)), 1400000000)
+            writer.close()
+        entries = Archive.index_entries(writer.members)
+        self.write_index(entries)
+        return entries
+
+    def write_index(self, entries):
+        Archive.write_index(self.archive + Archive.INDEX_SUFFIX, entries, archive='src-1-master.zip',
+                            time='1', kind='master')
+
+    def verify(self, deep=True):
+        return Verifier(LocalLocation(self.dir), 'src', deep=deep).verify()
+
+    def corrupt(self, offset, data):
+        with open(self.archive, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+
+    def test_deep_check(self):
+        for codec in self.codecs():
+            entries = self.write(codec)
+            self.assertEqual(self.verify(), [], codec)
+            self.assertEqual(self.verify(False), [('src-1-master.zip', 'no archive hashes recorded, use a deep check')])
+            entry = entries[0]
+            self.corrupt(entry['offset'] + entry['csize'] // 2, '\xff\x00\xff')
+            problems = self.verify()
+            self.assertEqual([archive for archive, problem in problems], ['src-1-master.zip'], codec)
+            self.assertIn(entry['name'], problems[0][1])
+
+    def test_gzip_stream_is_checked(self):
+        entries = self.write('gzip')
+        entry = entries[0]
+        self.assertEqual(entry['name'], 'c/a.txt.gz')
+        # Break the crc in the gzip trailer and make the zip crc match the broken stream
+        trailer = entry['offset'] + entry['csize'] - 8
+        with open(self.archive, 'rb') as f:
+            f.seek(trailer)
+            crc = struct.unpack('<L', f.read(4))[0]
+        self.corrupt(trailer, struct.pack('<L', crc ^ 1))
+        with open(self.archive, 'rb') as f:
+            f.seek(entry['offset'])
+            entry['crc'] = zlib.crc32(f.read(entry['csize'])) & 0xFFFFFFFF
+        self.write_index(entries)
+        problems = self.verify()
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0][1].startswith('Unable to decompress c/a.txt.gz'), problems[0][1])
+
+
+class DedupVerifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = LocalChunkStore(os.path.join(self.dir, 'store'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def snapshot(self, time, files):
+        dedup = Deduplicator(self.store, 'src-', 4096)
+        dedup.start()
+        for name, data in sorted(files.items()):
+            path = os.path.join(self.dir, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            dedup.add_file(path, os.lstat(path), name)
+        return Deduplicator.load_index(self.store, dedup.finish(time))
+
+    def chunk_path(self, digest):
+        return os.path.join(self.dir, 'store', 'chunks', digest[:2], digest)
+
+    def test_missing_and_corrupt_chunks(self):
+        first = self.snapshot('1', {'a': 'a' * 10000, 'b': 'b'})
+        second = self.snapshot('2', {'a': 'a' * 10000, 'c': 'c'})
+        self.assertEqual(DedupVerifier(self.store, 'src', deep=True).verify(), [])
+
+        # A chunk of c, only the second snapshot references it
+        digest = [e for e in second['files'] if e['path'] == 'c'][0]['chunks'][0]
+        with open(self.chunk_path(digest), 'wb') as f:
+            f.write(zlib.compress('x'))
+        self.assertEqual(DedupVerifier(self.store, 'src').verify(), [])
+        self.assertEqual(DedupVerifier(self.store, 'src', deep=True).verify(),
+                         [('src-2.json.gz', 'chunk ' + digest + ' of c is corrupt')])
+
+        digest = [e for e in first['files'] if e['path'] == 'b'][0]['chunks'][0]
+        os.remove(self.chunk_path(digest))
+        self.assertEqual(DedupVerifier(self.store, 'src').verify('1'),
+                         [('src-1.json.gz', 'chunk ' + digest + ' of b is missing')])
+
+
+if __name__ == '__main__':
+    unittest.main()